@@ -5,8 +5,9 @@ from plot_data import PlotData
 from analysis_classes.utilities import create_dictionary
 from analysis_classes import Calibration
 from analysis_classes import NoiseAnalysis
-from analysis_classes import MainAnalysis
-from analysis_classes.utilities import save_all_plots, save_dict, read_meas_files
+from analysis_classes.batch_executor import BatchExecutor
+from analysis_classes.main_analysis import MainAnalysis
+from analysis_classes.utilities import save_all_plots, save_dict, read_meas_files, StageCache
 import matplotlib.pyplot as plt
 
 def main(args):
@@ -18,51 +19,118 @@ def main(args):
         print("AliSys needs at least the --config parameter. Type AliSys --help to see all params")
         sys.exit(0)
     plot = PlotData(os.path.join(os.getcwd(),ext,cfg.get("plot_config_file", "plot_cfg.yml")))
-    results = {}
+    if args.results:
+        reanalyse(plot, cfg, args.results)
+        if args.show_plots and len(args.results) == 1:
+            plot.show_plots()
+        plt.close("all")
+        return
 
-    meas_files = read_meas_files(cfg)
-    it = 0
-    for ped, cal, run in meas_files:
-        it+=1
+    # Pedestal and calibration files shared by several runs are only analysed once
+    cache = StageCache(cfg.get("Cache_folder", ""))
+    batch = BatchExecutor(cfg.get("Batch_processes", 1), cfg.get("Batch_memory", 0))
 
-        ped_data = NoiseAnalysis(ped, configs=cfg)
+    meas_files = list(read_meas_files(cfg))
+    # With several runs every run gets its own output files
+    several = len([run for _, _, run in meas_files if run]) > 1
+    used_names = set()
+    for ped, cal, run in meas_files:
 
-        results["NoiseAnalysis"] = ped_data
+        ped_key = cache.key("NoiseAnalysis", ped, cfg, NoiseAnalysis.CONFIG_KEYS)
+        ped_data = cache.get(ped_key, lambda: NoiseAnalysis(ped, configs=cfg))
 
-        cal_data = Calibration(cal, Noise_calc=ped_data, configs=cfg)
+        cal_key = cache.key("Calibration", cal, cfg, Calibration.CONFIG_KEYS, ped_key)
+        cal_data = cache.get(cal_key, lambda: Calibration(cal, Noise_calc=ped_data, configs=cfg))
 
-        results["Calibration"] = cal_data
+        run_cfg = dict(cfg, calibration=cal_data, noise_analysis=ped_data)
+        if run and save_output(cfg):
+            run_cfg["output_name"] = unique_output_name(cfg, run, several, used_names)
+            if str(cfg.get("Pickle_output", "")).lower() == "hdf5":
+                # The analysis writes the results file itself, stage by stage
+                run_cfg["results_file"] = os.path.join(cfg["Output_folder"], "{}.hdf5".format(run_cfg["output_name"]))
+        if run:
+            batch.submit(run, run, run_cfg)
+        else:
+            # Only the pedestal and calibration to plot
+            plot_results(plot, run_cfg, {"NoiseAnalysis": ped_data, "Calibration": cal_data}, "")
 
-        cfg.update({"calibration": cal_data,
-                    "noise_analysis": ped_data})
+    # The runs are plotted and saved as soon as they are done
+    batch.run(lambda run, run_cfg, outputdata: plot_results(
+        plot, run_cfg, {"NoiseAnalysis": run_cfg["noise_analysis"], "Calibration": run_cfg["calibration"],
+                        "MainAnalysis": outputdata}, run))
+    if len(batch.summary) > 1:
+        print(batch.report())
 
-        if run:
-            run_data = MainAnalysis(run, configs=cfg)
-            results["MainAnalysis"] = run_data.results
-
-        # Start plotting all results
-        if it > 1:  # Closing the old files
-            plt.close("all")
-        plot.start_plotting(cfg, results, group="from_file")
-
-        if cfg.get("Output_folder", "") and cfg.get("Output_name", "") and cfg.get("Save_output", False):
-            if cfg["Output_name"] == "generic":
-                fileName = os.path.basename(os.path.splitext(run)[0])
-            else:
-                fileName = cfg["Output_name"]
-            save_all_plots(fileName, cfg["Output_folder"], dpi=300)
-            if cfg.get("Pickle_output", False):
-                save_dict(run_data.outputdata,
-                          cfg["Output_folder"],
-                          cfg["Output_name"],
-                          cfg["Pickle_output"])
-
-
-    if args.show_plots and it==1:
+    if args.show_plots and len(meas_files) == 1:
         plot.show_plots()
 
     plt.close("all")
 
+def reanalyse(plot, cfg, results_files):
+    """Runs the additional analyses and the plots on the saved results (hdf5) of runs, without the raw data.
+    The pedestal, calibration and clustering are taken from the files, so only the plugins (with the
+    parameters of the current config) and the plots are done again."""
+    from analysis_classes.results_store import load_hdf5_results, restore_object
+    several = len(results_files) > 1
+    used_names = set()
+    for results_file in results_files:
+        saved = load_hdf5_results(results_file)
+        try:
+            ped_data = restore_object(NoiseAnalysis, saved["NoiseAnalysis"])
+            cal_data = restore_object(Calibration, saved["Calibration"])
+            # The results read from the file can only be saved as hdf5 again
+            run_cfg = dict(cfg, calibration=cal_data, noise_analysis=ped_data, Pickle_output=False)
+            if save_output(cfg):
+                name = run_cfg["output_name"] = unique_output_name(cfg, results_file, several, used_names)
+                if str(cfg.get("Pickle_output", "")).lower() == "hdf5":
+                    if os.path.normpath(os.path.join(cfg["Output_folder"], name + ".hdf5")) == os.path.normpath(results_file):
+                        name += "_reanalysis"  # The file is still read
+                    run_cfg["results_file"] = os.path.join(cfg["Output_folder"], "{}.hdf5".format(name))
+            outputdata = MainAnalysis(results_file, configs=run_cfg, saved_results=saved).outputdata
+            plot_results(plot, run_cfg, {"NoiseAnalysis": ped_data, "Calibration": cal_data,
+                                         "MainAnalysis": outputdata}, results_file)
+        finally:
+            saved.close()
+
+def save_output(cfg):
+    """Returns if the plots and results should be saved"""
+    return cfg.get("Output_folder", "") and cfg.get("Output_name", "") and cfg.get("Save_output", False)
+
+def output_name(cfg, run, unique=False):
+    """Returns the file name of the outputs of a run. If unique is set (several runs), the name of the run
+    is appended to the Output_name, so the runs do not overwrite each others files"""
+    run_name = os.path.basename(os.path.splitext(run)[0])
+    if cfg["Output_name"] == "generic":
+        return run_name
+    if unique and run_name:
+        return "{}_{}".format(cfg["Output_name"], run_name)
+    return cfg["Output_name"]
+
+def unique_output_name(cfg, run, several, used_names):
+    """Returns the file name of the outputs of a run (see output_name, unique if several runs are analysed),
+    runs with the same name get a counter. The name is added to used_names"""
+    name = base_name = output_name(cfg, run, several)
+    number = 1
+    while name in used_names:
+        number += 1
+        name = "{}_{}".format(base_name, number)
+    used_names.add(name)
+    return name
+
+def plot_results(plot, cfg, results, run):
+    """Plots the results of a run and saves the plots and the results, if configured"""
+    plt.close("all")  # Closing the old files
+    plot.start_plotting(cfg, results, group="from_file")
+
+    if save_output(cfg):
+        fileName = cfg.get("output_name") or output_name(cfg, run)
+        save_all_plots(fileName, cfg["Output_folder"], dpi=300)
+        if cfg.get("Pickle_output", False) and "MainAnalysis" in results and "results_file" not in cfg:
+            save_dict(results["MainAnalysis"],
+                      cfg["Output_folder"],
+                      fileName,
+                      cfg["Pickle_output"])
+
 if __name__ == "__main__":
 
     PARSER = ArgumentParser()
@@ -72,4 +140,8 @@ if __name__ == "__main__":
     PARSER.add_argument("--show_plots",
                         help="Show all generated plots when analysis is done",
                         type=bool, default=True)
+    PARSER.add_argument("--results",
+                        help="Saved results (hdf5) of runs, the analyses and plots are done again from them "
+                             "without the raw data",
+                        nargs="*", default=[])
     main(PARSER.parse_args())
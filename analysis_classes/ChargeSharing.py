@@ -2,7 +2,6 @@
 #pylint: disable=C0103,E1111
 import logging
 import numpy as np
-from tqdm import tqdm
 from scipy.stats import norm
 import matplotlib.pyplot as plt
 from .utilities import set_attributes
@@ -22,7 +21,13 @@ class ChargeSharing:
           Eta is in my opinion not as good as the theta since eta is a projection on a plane and theta a
           projection in polar coordinates. The distribution looks in most cases better and is way more easy to interpret.
 
+    # ChargeSharing Analysis specific params
+        - numClus: list[int] - Number of clusters per event of the considered events, a negative value takes
+          the clusters of all events ([1])
+
     """
+    # The results this analysis reads (see PluginScheduler)
+    INPUTS = ("base",)
 
     def __init__(self, main_analysis, configs, logger = None):
         """Initialize some important parameters"""
@@ -33,46 +38,27 @@ class ChargeSharing:
         self.log = logger or logging.getLogger(__class__.__name__)
         self.main = main_analysis
         self.clustersize = 2  # Other thing would not make sense for interstrip analysis
-        self.data = self.main.outputdata.copy()
+        self.numClus = configs.get("numClus", [1])
+        self.data = self.main.results_view()
         self.results_dict = {}  # Containing all data processed
 
     def run(self):
         """Runs the analysis"""
         self.results_dict = {}
-        # Get clustersizes of 2 and only events which show only one cluster in its data (just to be sure
-
-        # Indizes of events with the desired clusternumbers
-        indizes_clusters = np.nonzero(self.data["base"]["Numclus"] == 1)
-        # Take the desired clusters
-        clusters_raw = np.take(self.data["base"]["Clustersize"], indizes_clusters)
-        clusters_flattend = np.concatenate(clusters_raw).ravel()  # so that they are easy accessible
-        # Now take only the events with clustersize 2
-        indizes_clustersize = np.nonzero(clusters_flattend == 2)
-        # Here we need to do a little detour, since we have derived indizes from Clustersize we do not have the same
-        # Index order as we need, therefore we need to get indizes from indizes_clusters to get the indizes
-        # from the real data
-        indizes = np.take(indizes_clusters, indizes_clustersize)[0]
-
-        # Data containing the al and ar values as list entries data[0] --> al
-        # Take the data from the Signal data
-        raw = np.take(self.data["base"]["Signal"], indizes)
-        raw = np.reshape(np.concatenate(raw), (len(raw), self.main.numChan))
-        # Find the channels with the hits
-        hits = np.concatenate(np.take(self.data["base"]["Clusters"], indizes))
-        al = np.zeros(len(indizes))  # Amplitude left and right
-        ar = np.zeros(len(indizes))
-        strl = np.zeros(len(indizes)) # Strips hits for left side
-        strr = np.zeros(len(indizes)) # Strips hits for left side
-        # Order the hits assecnding (they are channel numbers)
-        il = np.min(hits, axis=1)  # Indizes of left and right
-        ir = np.max(hits, axis=1)
-        # final_data = np.zeros((len(indizes), 2))
-
-        for i, event, ali, ari, l, r in zip(range(len(al)), raw, al, ar, il, ir):
-            al[i] = event[l]  # So always the left strip is choosen
-            ar[i] = event[r]  # Same with the right strip
-            strl[i] = l
-            strr[i] = r
+        # Get clustersizes of 2 and only events which show the desired number of clusters (just to be sure)
+        base = self.data["base"]
+        selected = base["cluster_size"] == self.clustersize
+        if not any(num < 0 for num in self.numClus):
+            selected &= np.isin(base["numclus"][base["cluster_event"]], self.numClus)
+
+        # Take the amplitudes and channels of both strips directly from the cluster table
+        first = base["cluster_offset"][:-1][selected]
+        channels = np.stack((base["cluster_channels"][first], base["cluster_channels"][first+1]))
+        signals = np.stack((base["cluster_signal"][first], base["cluster_signal"][first+1]))
+        # Order the hits assecnding (they are channel numbers), so always the left strip is choosen first
+        order = np.argsort(channels, axis=0)
+        strl, strr = np.take_along_axis(channels, order, axis=0)  # Strips hit left and right
+        al, ar = np.take_along_axis(signals, order, axis=0)  # Amplitude left and right
 
         # Convert ADC to actual energy
         al = self.main.calibration.convert_ADC_to_e(al, strl)
@@ -0,0 +1,125 @@
+"""This file contains the class for the scan of the clustering parameters"""
+#pylint: disable=C0103,R0902,R0914
+import logging
+from itertools import product
+from time import time
+import numpy as np
+import numba
+from .nb_analysis_funcs import nb_clustering_all_events, nb_preprocess_all_events
+
+
+class ClusterScan:
+    """ClusterScan reruns the clustering for a grid of clustering parameters.
+
+    Only the clustering depends on the cuts, so the pedestal and common mode corrected
+    signal and SN of all events are calculated only once (or taken from the base analysis if
+    the signal matrix was kept). Afterwards the parallel clustering kernel is run for every
+    combination of the passed parameters. This way threshold studies do not need a
+    complete rerun of the analysis.
+
+    The result is a compact table (numpy structured array) with one row per parameter point:
+        - SN_cut, SN_ratio, SN_cluster, max_cluster_size: The parameters of the point
+        - clusters: Total number of clusters
+        - mean_numclus: Mean number of clusters per event
+        - cluster_events: Fraction of events with at least one cluster
+        - clustersize: Number of clusters per clustersize (index 0 is clustersize 1)
+        - seed_mpv: Most probable value of the seed signal (maximum of the seed signal histogram)
+
+    # ClusterScan Analysis specific params
+        - SN_cut: list[float] - SN cuts to scan (default the SN_cut of the analysis)
+        - SN_ratio: list[float] - SN ratios to scan (default the SN_ratio of the analysis)
+        - SN_cluster: list[float] - Cluster SN cuts to scan (default the SN_cluster of the analysis)
+        - max_cluster_size: list[int] - Maximum clustersizes to scan (default the max_cluster_size of the analysis)
+        - bins: int - Bin count of the seed signal histogram (200)
+        - Charge_scale: bool - Convert the seed signal from ADC to electrons (False)
+    """
+    # The results this analysis reads (see PluginScheduler)
+    INPUTS = ("base",)
+
+    def __init__(self, main_analysis, configs, logger=None):
+        """
+        Init for the ClusterScan analysis class
+
+        :param main_analysis: The main analysis with all its parameters
+        :param configs: The dictionary with the ClusterScan specific parameters
+        :param logger: A specific logger if you want
+        """
+        self.log = logger or logging.getLogger(__class__.__name__)
+        self.main = main_analysis
+        self.data = self.main.results_view()
+        self.SN_cut = configs.get("SN_cut", [self.main.SN_cut])
+        self.SN_ratio = configs.get("SN_ratio", [self.main.SN_ratio])
+        self.SN_cluster = configs.get("SN_cluster", [self.main.SN_cluster])
+        self.max_cluster_size = configs.get("max_cluster_size", [self.main.max_cluster_size])
+        self.bins = configs.get("bins", 200)
+        self.Charge_scale = configs.get("Charge_scale", False)
+        self.results_dict = {}
+
+    def run(self):
+        """Runs the clustering for all parameter points"""
+        signal, SN = self.get_signal_and_SN()
+        noise = self.main.noise
+        maxsize = int(max(self.max_cluster_size))
+        table = np.zeros(len(self.SN_cut)*len(self.SN_ratio)*len(self.SN_cluster)*len(self.max_cluster_size),
+                         dtype=[("SN_cut", np.float64), ("SN_ratio", np.float64), ("SN_cluster", np.float64),
+                                ("max_cluster_size", np.int64), ("clusters", np.int64),
+                                ("mean_numclus", np.float64), ("cluster_events", np.float64),
+                                ("clustersize", np.int64, (maxsize,)), ("seed_mpv", np.float64)])
+
+        for row, (SN_cut, SN_ratio, SN_cluster, max_clustersize) in zip(table, product(
+                self.SN_cut, self.SN_ratio, self.SN_cluster, self.max_cluster_size)):
+            start = time()
+            _, _, event_offset, cluster_size, cluster_offset, cluster_channels, _, _ = \
+                nb_clustering_all_events(signal, SN, noise, SN_cut, SN_ratio, SN_cluster,
+                                         self.main.numChan, max_clustersize, self.main.automasking,
+                                         self.main.material, numba.config.NUMBA_NUM_THREADS)
+            numclus = np.diff(event_offset)
+            row["SN_cut"], row["SN_ratio"], row["SN_cluster"] = SN_cut, SN_ratio, SN_cluster
+            row["max_cluster_size"] = max_clustersize
+            row["clusters"] = len(cluster_size)
+            row["mean_numclus"] = np.mean(numclus) if len(numclus) else 0.
+            row["cluster_events"] = np.mean(numclus > 0) if len(numclus) else 0.
+            row["clustersize"] = np.bincount(cluster_size, minlength=maxsize+1)[1:maxsize+1]
+
+            # The seed is the first channel of every cluster
+            seed_channel = cluster_channels[cluster_offset[:-1]]
+            seed_signal = signal[np.repeat(np.arange(len(numclus)), numclus), seed_channel]
+            row["seed_mpv"] = self.most_probable_value(seed_signal, seed_channel)
+            self.log.debug("Clustering for SN_cut: %s, SN_ratio: %s, SN_cluster: %s, max_cluster_size: %s "
+                           "took %.2f s", SN_cut, SN_ratio, SN_cluster, max_clustersize, time()-start)
+
+        self.results_dict["table"] = table
+        self.results_dict["bins"] = self.bins
+        return self.results_dict.copy()
+
+    def get_signal_and_SN(self):
+        """Returns the signal and SN of all events with good timing. If the base analysis did not keep them,
+        the events are preprocessed again"""
+        base = self.data["base"]
+        if "signal" in base:
+            return base["signal"], base["sn"]
+
+        if self.main.events is None:
+            # e.g. the reanalysis of saved results, which do not contain the raw events
+            raise ValueError("The signal matrix was not kept by the base analysis (keep_signal_matrix) and the raw "
+                             "events are not available, the clustering can not be scanned")
+        self.log.info("Signal matrix was not kept by the base analysis, preprocessing the events again...")
+        gtime = np.nonzero(np.logical_and(self.main.timing >= self.main.timingWindow[0],
+                                          self.main.timing <= self.main.timingWindow[1]))[0]
+        events = np.array(self.main.events[gtime], dtype=np.float32)
+        signal, SN, _, _ = nb_preprocess_all_events(events, self.main.pedestal, np.mean(self.main.CMN),
+                                                    np.mean(self.main.CMsig), self.main.noise, self.main.numChan,
+                                                    np.asarray(self.main.noise_analysis.noisy_strips, dtype=np.int64))
+        return signal, SN
+
+    def most_probable_value(self, seed_signal, seed_channel):
+        """Calculates the most probable value of the seed signals as the center of the fullest bin"""
+        if not len(seed_signal):
+            return 0.
+        if self.Charge_scale:
+            values = self.main.calibration.convert_ADC_to_e(seed_signal, seed_channel)
+        else:
+            values = np.abs(seed_signal)
+        hist, edges = np.histogram(values, bins=self.bins)
+        ind = np.argmax(hist)
+        return (edges[ind]+edges[ind+1])/2.
@@ -3,12 +3,14 @@
 import logging
 import warnings
 import time
+import hashlib
+import threading
+from collections import OrderedDict
 import numpy as np
 from scipy.optimize import curve_fit
 from tqdm import tqdm
 import pylandau
-from joblib import Parallel, delayed
-from .utilities import set_attributes
+from .utilities import set_attributes, binned_statistics, HistogramAccumulator, survival_function, efficiency_curve
 
 
 class Langau:
@@ -30,9 +32,22 @@ class Langau:
             - energyCutOff: int - High energy cut of for calculations (100 000)
             - numClus: int - How many clusters per event should be considered (1)
             - bins: int - Bin count for langau (200)
+            - warm_start: bool - Start the fits from the result of the previous run (True)
+            - fit_cache: bool - Reuse the fit of an identical histogram (True)
+            - fit_clustersizes: bool - Fit a langau to every clustersize as well (False)
+            - accumulate: bool - Only keep histograms with fixed binning instead of all signals, they are filled
+                                 while the events are clustered (False)
+            - histogram_range: list[float] - Range of the histograms in accumulate mode ([0, energyCutOff])
+            - Efficiency: dict - The seed cut efficiency vs. threshold curve:
+                aim_eff: float - Target efficiency (0.95)
+                max_range: float - Highest threshold of the curve (energyCutOff)
+                step_size: float - Threshold step of the curve, in accumulate mode the bin edges are used (1)
 
     Written by Dominic Bloech
     """
+    # The results this analysis reads (see PluginScheduler)
+    INPUTS = ("base",)
+
     def __init__(self, main_analysis, configs, logger=None):
         """
         Init for the Langau analysis class
@@ -47,7 +62,7 @@ class Langau:
 
         self.log = logger or logging.getLogger(__class__.__name__)
         self.main = main_analysis
-        self.data = self.main.outputdata.copy()
+        self.data = self.main.results_view()
         self.results_dict = {}  # Containing all data processed
         self.pedestal = self.main.pedestal
         self.pool = self.main.Pool
@@ -58,238 +73,277 @@ class Langau:
         self.cluster_size_list = self.clustersize
         self.results_dict = {"bins": self.bins}
         self.seed_cut_langau = self.seed_cut_langau
-
+        self.warm_start = configs.get("warm_start", True)
+        self.fitter = LANGAU_FITTER
+        self.fit_cache = configs.get("fit_cache", True)
+        self.fit_clustersizes = configs.get("fit_clustersizes", False)
+        self.accumulate = configs.get("accumulate", False)
+        self.histogram_range = configs.get("histogram_range", [0, self.Ecut])
+        efficiency = configs.get("Efficiency", {}) or {}
+        self.aim_eff = efficiency.get("aim_eff", 0.95)
+        self.efficiency_range = efficiency.get("max_range", self.Ecut)
+        self.efficiency_step = efficiency.get("step_size", 1)
+        if self.accumulate:
+            self.histograms = {"cluster": HistogramAccumulator(self.bins, self.histogram_range),
+                               "Clustersize": [HistogramAccumulator(self.bins, self.histogram_range)
+                                               for _ in self.cluster_size_list],
+                               "SC": HistogramAccumulator(self.bins, self.histogram_range)}
+            self.filled = False
+
+    @staticmethod
+    def accumulates(configs):
+        """Whether the analysis fills its histograms while the events are clustered (see PluginScheduler)"""
+        return configs.get("accumulate", False)
 
     def run(self):
         """Runs the routines to generate all langau specific data"""
 
-        # Here events with only one cluster are choosen or two, you decide
-        indNumClus = self.get_num_clusters(self.data, self.numClusters)
-        indizes = np.concatenate(indNumClus)
+        # All fits are independent, they are send to the scheduler together and run in parallel if a pool exists
+        scheduler = LangauFitScheduler(self.fitter, self.pool, warm_start=self.warm_start, use_cache=self.fit_cache)
+        if self.accumulate:
+            histograms = self.accumulated_histograms()
+        else:
+            # Here events with only one cluster are choosen or two, you decide
+            indizes = np.concatenate(self.get_num_clusters(self.data, self.numClusters))
+            histograms = self.signal_histograms(indizes)
 
-        # Slice the data from the bas analysis for further calculations
-        valid_events_clustersize = np.take(self.data["base"]["Clustersize"], indizes)
-        valid_events_clusters = np.take(self.data["base"]["Clusters"], indizes)
-        valid_events_Signal = np.take(self.data["base"]["Signal"],indizes)
-        self.results_dict["Clustersize"] = []
+        # Fit the langau to the summ of all individual clusters
+        scheduler.submit("cluster", *histograms["cluster"], self.ClusterCut)
+        if self.fit_clustersizes:
+            for size in self.cluster_size_list:
+                scheduler.submit("clustersize_{}".format(size), *histograms["clustersize_{}".format(size)],
+                                 self.ClusterCut)
+        if self.seed_cut_langau:
+            scheduler.submit("SC", *histograms["SC"], self.SCCut)
+            self.results_dict["efficiency_SC"] = self.seed_cut_efficiency()
+
+        for spectrum, (coeff, _, info) in scheduler.collect().items():
+            self.log.info("Langau fit of the {} spectrum took {:.2f} s and {} fit(s){}".format(
+                spectrum, info["time"], info["iterations"], " (cached)" if info["cached"] else ""))
+            edges = histograms[spectrum][1]
+            plotxrange = np.arange(0., edges[-1], edges[-1] / 1000.)
+            fit = {"langau_coeff": coeff,
+                   "langau_data": [plotxrange, pylandau.langau(plotxrange, *coeff)],  # aka x and y data
+                   "fit_info": info}
+            if spectrum == "cluster":
+                self.results_dict.update(fit)
+            elif spectrum == "SC":
+                self.results_dict.update({key+"_SC": value for key, value in fit.items()})
+            else:
+                self.results_dict["Clustersize"][self.cluster_size_list.index(int(spectrum.split("_")[1]))].update(fit)
 
-        # TODO: here a non numba optimized version is used. We should use numba here!
-        # Calculate the energy deposition PER Clustersize and add it to self.results_dict["Clustersize"]
-        self.cluster_analysis(valid_events_Signal,
-                              valid_events_clusters,
-                              valid_events_clustersize)
+        return self.results_dict.copy()
 
-        # With all the data from every clustersize add all together and fit the main langau to it
-        finalE = np.zeros(0)
-        finalNoise = np.zeros(0)
-        for cluster in self.results_dict["Clustersize"]:
-            # Clean up and extra energy cut
-            indi = np.nonzero(cluster["signal"] > 0)[0]
-            nogarbage = cluster["signal"][indi]
-            # ultra_high_energy_cut
-            indi = np.nonzero(nogarbage < self.Ecut)[0]
-            cluster["signal"] = cluster["signal"][indi]
-            finalE = np.append(finalE, cluster["signal"])
-            finalNoise = np.append(finalNoise, cluster["noise"])
+    def signal_histograms(self, indizes):
+        """Calculates the signals of all clusters and the seed cut hits and keeps them in the results.
 
-        # Fit the langau to the summ of all individual clusters
-        coeff, _, _, error_bins, edges= self.fit_langau(finalE,
-                                                  finalNoise,
-                                                  bins=self.results_dict["bins"],
-                                                  cut = self.ClusterCut)
+        :param indizes: The events which should be considered
+        :return: dict of spectrum: (hist, edges)
+        """
+        # Calculate the energy deposition PER Clustersize
+        self.results_dict["Clustersize"] = self.cluster_analysis(indizes)
 
+        # With all the data from every clustersize add all together and fit the main langau to it
+        for cluster in self.results_dict["Clustersize"]:
+            # Clean up and extra energy cut (ultra_high_energy_cut), the noise is cut equally
+            valid = (cluster["signal"] > 0) & (cluster["signal"] < self.Ecut)
+            cluster["signal"] = cluster["signal"][valid]
+            cluster["noise"] = cluster["noise"][valid]
+        finalE = np.concatenate([np.zeros(0)] + [cluster["signal"] for cluster in self.results_dict["Clustersize"]])
+        finalNoise = np.concatenate([np.zeros(0)] + [cluster["noise"] for cluster in self.results_dict["Clustersize"]])
         self.results_dict["signal"] = finalE
         self.results_dict["noise"] = finalNoise
-        self.results_dict["langau_coeff"] = coeff
-        plotxrange = np.arange(0., edges[-1], edges[-1] / 1000.)
-        self.results_dict["langau_data"] = [
-            plotxrange,pylandau.langau(plotxrange,*coeff)
-        ]  # aka x and y data
-        self.results_dict["data_error"] = error_bins
+
+        histograms = {}
+        hist, edges, self.results_dict["data_error"] = self.histogram(finalE, finalNoise)
+        histograms["cluster"] = (hist, edges)
+        if self.fit_clustersizes:
+            for size, cluster in zip(self.cluster_size_list, self.results_dict["Clustersize"]):
+                histograms["clustersize_{}".format(size)] = self.histogram(cluster["signal"])[:2]
 
         # Seed cut langau, taking only the bare hit channels which are above seed cut levels
         if self.seed_cut_langau:
-            seed_cut_channels = self.data["base"]["Channel_hit"]
-            signals = self.data["base"]["Signal"]
-            seedcutADC = []
-            seedcutChannels = []
-            for i, signal in enumerate(tqdm(signals, desc="(langau SC) Processing events")):
-                if signal[seed_cut_channels[i]].any():
-                    seedcutADC.append(signal[seed_cut_channels[i]])
-                    seedcutChannels.append(seed_cut_channels[i])
+            self.log.info("Calculating the SC Langau...")
+            self.results_dict["signal_SC"] = self.seed_cut_signals(self.data["base"])
+            histograms["SC"] = self.histogram(self.results_dict["signal_SC"])[:2]
+        return histograms
 
+    def fill(self, table):
+        """Fills the signals of the clusters and the seed cut hits of a cluster table into the histograms of the
+        accumulate mode. Is called by the base analysis with the cluster table of every chunk, as soon as it is
+        clustered (see PluginScheduler.accumulators), so the signals themselves are never kept.
 
-            if self.Charge_scale:
-                self.log.info("Converting ADC to electrons for SC Langau...")
-                converted = self.main.calibration.convert_ADC_to_e(np.concatenate(seedcutADC), np.concatenate(seedcutChannels))
-            else:
-                converted = np.absolute(np.concatenate(seedcutADC))
-            finalE = np.array(converted, dtype=np.float32)
-
-            # get rid of 0 events
-            indizes = np.nonzero(finalE > 0)[0]
-            nogarbage = finalE[indizes]
-            indizes = np.nonzero(nogarbage < self.Ecut)[0]  # ultra_high_energy_cut
-            coeff, _, _, error_bins, edges = self.fit_langau(
-                nogarbage[indizes], bins=self.results_dict["bins"], cut = self.SCCut)
-            self.results_dict["signal_SC"] = nogarbage[indizes]
-            self.results_dict["langau_coeff_SC"] = coeff
-            plotxrange = np.arange(0., edges[-1], edges[-1]/1000.)
-            self.results_dict["langau_data_SC"] = [
-                plotxrange,pylandau.langau(plotxrange,*coeff)
-            ]  # aka x and y data
-
-#         Old attempts for multiprocessing, no speed up seen here
-#             # Try joblib
-#             #start = time()
-#             #arg_instances = [(size, valid_events_clustersize,
-#             #                  valid_events_Signal, valid_events_clusters,
-#             #                  noise, charge_cal) for size in clustersize_list]
-#             #results = Parallel(n_jobs=4, backend="threading")(map(delayed(self.process_cluster_size),
-#             #                                                           arg_instances))
-#             #for res in results:
-#             #    self.results_dict[data]["Clustersize"].append(res)
-        #
-        # !!!!!!!!!!!!!!! NO SPEED BOOST HERE!!!!!!!!!!!!!!!!!!!!
-        # General langau, where all clustersizes are considered
-        # if self.poolsize > 1:
-        #    paramslist = []
-        #    for size in self.cluster_size_list:
-        #        cls_ind = np.nonzero(valid_events_clustersize == size)[0]
-        #        paramslist.append((cls_ind, valid_events_Signal,
-        #                           valid_events_clusters,
-        #                           self.main.calibration.convert_ADC_to_e,
-        #                           self.main.noise))
-
-        # COMMENT: lagau_cluster not defined!!!!
-        # Here multiple cpu calculate the energy of the events per clustersize
-        #    results = self.pool.starmap(self.langau_cluster, paramslist,
-        #                                chunksize=1)
-
-        #    self.results_dict["Clustersize"] = results
+        :param table: The cluster table of a chunk (see build_cluster_table or chunk_table)
+        """
+        indizes = np.concatenate(self.get_num_clusters({"base": table}, self.numClusters))
+        for histogram, cluster in zip(self.histograms["Clustersize"],
+                                      self.cluster_analysis(indizes, table=table, progress=False)):
+            # Clean up and extra energy cut (ultra_high_energy_cut)
+            valid = (cluster["signal"] > 0) & (cluster["signal"] < self.Ecut)
+            histogram.fill(cluster["signal"][valid])
+            self.histograms["cluster"].fill(cluster["signal"][valid], weights=cluster["noise"][valid])
+        if self.seed_cut_langau:
+            self.histograms["SC"].fill(self.seed_cut_signals(table))
+        self.filled = True
 
+    def accumulated_histograms(self):
+        """Stores the histograms of the accumulate mode (HistogramAccumulator) in the results, they can be
+        merged with the ones of other runs. If they were not filled while the events were clustered (e.g. for
+        saved results), they are filled from the cluster table of the base analysis, chunk by chunk.
 
-        return self.results_dict.copy()
+        :return: dict of spectrum: (hist, edges)
+        """
+        if not self.filled:
+            base = self.data["base"]
+            chunk_size = max(self.main.chunk_size or len(base), 1)
+            for start in tqdm(range(0, max(len(base), 1), chunk_size), desc="(langau) Processing chunk"):
+                self.fill(self.chunk_table(base, start, start+chunk_size))
+
+        total, sizes, seed_cut = self.histograms["cluster"], self.histograms["Clustersize"], self.histograms["SC"]
+        for size, histogram in zip(self.cluster_size_list, sizes):
+            if not histogram.counts.any():
+                self.log.critical("Clustersize analysis of size: {} seems to have no entries. "
+                                  "Warning this is VERY uncommon please make sure the other data is correct!!!".format(size))
+        self.results_dict["histogram"] = total
+        self.results_dict["data_error"] = total.mean
+        self.results_dict["Clustersize"] = [{"histogram": histogram} for histogram in sizes]
+        histograms = {"cluster": (total.counts, total.edges)}
+        histograms.update({"clustersize_{}".format(size): (histogram.counts, histogram.edges)
+                           for size, histogram in zip(self.cluster_size_list, sizes)})
+        if self.seed_cut_langau:
+            self.results_dict["histogram_SC"] = seed_cut
+            histograms["SC"] = (seed_cut.counts, seed_cut.edges)
+        return histograms
+
+    def seed_cut_efficiency(self):
+        """Calculates the efficiency of the seed cut signals vs. the applied threshold (the survival function
+        of the seed signals) and the highest threshold with an efficiency of at least aim_eff.
+        The thresholds span 0 to max_range, in accumulate mode the efficiency is calculated at the bin
+        edges of the seed cut histogram (up to max_range).
+
+        :return: dict with "threshold", "efficiency", "aim_eff", "aim_threshold" (nan if never reached) and "events"
+        """
+        if self.accumulate:
+            histogram = self.results_dict["histogram_SC"]
+            thresholds = histogram.edges
+            above = np.append(np.cumsum(histogram.counts[::-1])[::-1], 0)
+            events = int(above[0])
+            efficiency = above/events if events else np.zeros(len(thresholds))
+            in_range = thresholds <= self.efficiency_range
+            thresholds, efficiency = thresholds[in_range], efficiency[in_range]
+        else:
+            signals = self.results_dict["signal_SC"]
+            thresholds = np.arange(0, self.efficiency_range+self.efficiency_step, self.efficiency_step)
+            efficiency = survival_function(signals, thresholds)
+            events = len(signals)
+        return efficiency_curve(thresholds, efficiency, self.aim_eff, events)
+
+    @classmethod
+    def chunk_table(cls, table, start, stop):
+        """Returns the events start to stop of a cluster table as a new table, which can be passed to fill.
+        The cluster columns are not sliced (no copies), the event offsets still point into them."""
+        chunk = cls.hit_table(table, start, stop)
+        chunk["event_offset"] = table["event_offset"][start:stop+1]
+        for column in ("cluster_size", "cluster_offset", "cluster_signal", "cluster_channels"):
+            chunk[column] = table[column]
+        return chunk
+
+    @staticmethod
+    def hit_table(table, start, stop):
+        """Returns the hit columns of the events start to stop of a cluster table (as a new table)"""
+        first, last = table["hit_offset"][start], table["hit_offset"][min(stop, len(table))]
+        return {"numclus": table["numclus"][start:stop],
+                "hit_event": table["hit_event"][first:last] - start,
+                "hit_channel": table["hit_channel"][first:last],
+                "hit_signal": table["hit_signal"][first:last]}
+
+    def seed_cut_signals(self, table):
+        """Calculates the signals of all hit channels (above the seed cut) of a cluster table.
+        Works on the table of the whole run as well as on the table of a single chunk.
+
+        :param table: The cluster table (or the Bdata object) of the base analysis
+        :return: The signals of the hits (electrons or ADC), with the energy cuts applied
+        """
+        hit_event = table["hit_event"]
+        hit_signal = table["hit_signal"]
+
+        # Events where all hits have zero signal are skipped (as a whole)
+        valid_events = np.bincount(hit_event, weights=hit_signal != 0, minlength=len(table["numclus"])) > 0
+        valid = valid_events[hit_event]
+
+        if self.Charge_scale:
+            converted = self.main.calibration.convert_ADC_to_e(hit_signal[valid], table["hit_channel"][valid])
+        else:
+            converted = np.absolute(hit_signal[valid])
+        finalE = np.array(converted, dtype=np.float32)
 
-    def cluster_analysis(self, valid_events_Signal,
-                         valid_events_clusters, valid_events_clustersize):
+        # get rid of 0 events and the ultra_high_energy_cut
+        return finalE[(finalE > 0) & (finalE < self.Ecut)]
+
+    def cluster_analysis(self, indizes, table=None, progress=True):
         """Calculates the energies for different cluster sizes
-         (like a Langau per clustersize) - non optimized version """
-        #TODO: Formerly in the numba function!!! We should use numba here not native python!!!
-        for size in tqdm(self.cluster_size_list, desc="(langau) Processing clustersize"):
-            # get the events with the different clustersizes
-            ClusInd = [[], []]
-            for i, event in enumerate(valid_events_clustersize):
-                for j, clus in enumerate(event):
-                    if clus == size:
-                        ClusInd[0].extend([i])
-                        ClusInd[1].extend([j])
-
-            signal_clst_event = np.zeros([len(ClusInd[0]), size])
-            noise_clst_event = np.zeros([len(ClusInd[0]), size])
-            channels_hit_event = np.zeros([len(ClusInd[0]), size])
-            #for i, ind in enumerate(tqdm(ClusInd[0], desc="(langau) Processing event")):
-            for i, ind in enumerate(ClusInd[0]):
-                y = ClusInd[1][i]
-                # Signal calculations
-                signal_clst_event[i] = np.take(valid_events_Signal[ind], valid_events_clusters[ind][y])
-                # Noise Calculations
-                noise_clst_event[i] = np.take(self.main.noise, valid_events_clusters[ind][y])  # Get the Noise of an event
-                # Save channels at which the hit happend
-                channels_hit_event[i] = np.array(valid_events_clusters[ind][y])
+         (like a Langau per clustersize) directly from the flat cluster table of the base analysis
+
+        :param indizes: The events which should be considered, the clusters keep this order
+        :param table: The cluster table, default is the one of the base analysis
+        :param progress: Show a progress bar over the clustersizes and warn about empty ones (off for chunks)
+        :return: list of dicts with the signal and noise of every clustersize
+        """
+        base = self.data["base"] if table is None else table
+        cluster_size = base["cluster_size"]
+        cluster_offset = base["cluster_offset"]
+
+        # All clusters of the valid events, in the order of the events
+        numclus = base["numclus"][indizes]
+        shift = np.repeat(base["event_offset"][indizes] - np.cumsum(numclus) + numclus, numclus)
+        valid_clusters = shift + np.arange(len(shift))
+        valid_sizes = cluster_size[valid_clusters]
+
+        results = []
+        for size in tqdm(self.cluster_size_list, desc="(langau) Processing clustersize", disable=not progress):
+            clusters = valid_clusters[valid_sizes == size]
+            if not len(clusters):
+                if progress:
+                    self.log.critical("Clustersize analysis of size: {} seems to have no entries skipping this clustersize. "
+                                      "Warning this is VERY uncommon please make sure the other data is correct!!!".format(size))
+                results.append({"signal": np.zeros(0), "noise": np.zeros(0)})
+                continue
+
+            # Gather all channels of all clusters of this size as blocks of shape (clusters, size)
+            positions = cluster_offset[clusters][:, None] + np.arange(size)
+            signal_clst_event = base["cluster_signal"][positions]
+            channels_hit_event = base["cluster_channels"][positions]
+            noise_clst_event = self.main.noise[channels_hit_event]
 
             # Todo: Due to the sum of all channels prior to conversion a need to choose a channel for
             # the gain. Therefore, in the future it would be good to separately calculate the gain for
             # every channel and then build the sum. But the error should be minimal.
-
-            try:
-                totalE = np.zeros([len(channels_hit_event[0]), len(channels_hit_event)])
-                for part in range(len(channels_hit_event[0])):
-                    if self.Charge_scale:
-                        totalE[part] = self.main.calibration.convert_ADC_to_e(signal_clst_event[:,part], channels_hit_event[:,part])
-                    else:
-                        totalE[part] = np.absolute(signal_clst_event[:,part])
-                totalE = np.sum(totalE, axis=0)
-
-
+            if self.Charge_scale:
+                totalE = self.main.calibration.convert_ADC_to_e(signal_clst_event.ravel(),
+                                                                channels_hit_event.ravel()).reshape(-1, size)
                 # eError is a list containing electron signal noise
-                if self.Charge_scale:
-                    totalNoise = np.sqrt(
-                        self.main.calibration.convert_ADC_to_e(np.sum(noise_clst_event,axis=1), channels_hit_event[:,0]))
-                else:
-                    totalNoise = np.sqrt(np.sum(noise_clst_event,axis=1))
-
-                preresults = {"signal": totalE, "noise": totalNoise}
-            except:
-                self.log.critical("Clustersize analysis of size: {} seems to have no entries skipping this clustersize. "
-                                  "Warning this is VERY uncommon please make sure the other data is correct!!!".format(size))
-                preresults = {"signal": np.zeros(1), "noise": np.zeros(0)}
+                totalNoise = np.sqrt(
+                    self.main.calibration.convert_ADC_to_e(np.sum(noise_clst_event, axis=1), channels_hit_event[:, 0]))
+            else:
+                totalE = np.absolute(signal_clst_event)
+                totalNoise = np.sqrt(np.sum(noise_clst_event, axis=1))
 
-            self.results_dict["Clustersize"].append(preresults)
+            results.append({"signal": np.sum(totalE, axis=1), "noise": totalNoise})
+        return results
 
-    def fit_langau(self, x, errors=np.array([]), bins=500, cut=0.33):
-        """Fits the langau to data"""
-        hist, edges = np.histogram(x, bins=bins)
-        # If no histogram could be made
-        if not hist.any():
-            self.log.critical("Insufficient data to make a histogram, langau fit aborted! ")
-            return [1, 1, 1, 1], None, [0], [0], [0,1]
+    def histogram(self, x, errors=np.array([])):
+        """Histograms the signals for the fit
+
+        :param x: The signals
+        :param errors: The errors of the signals (for the errors of the bins)
+        :return: hist, edges, binerror
+        """
+        hist, edges = np.histogram(x, bins=self.results_dict["bins"])
         if errors.any():
             binerror = self.calc_hist_errors(x, errors, edges)
         else:
             binerror = np.array([])
-
-        # Cut off noise part
-        lancut = np.max(hist) * cut  # Find maximum of hist and get the cut
-        # TODO: Bug when using optimized vs non optimized !!!
-        try:
-            ind_xmin = np.argwhere(hist > lancut)[0][0]
-            # Finds the first element which is higher as threshold optimized
-        except:
-            ind_xmin = np.argwhere(hist > lancut)
-            if ind_xmin.any():
-                ind_xmin[0]
-            else:
-                ind_xmin = 0
-            # Finds the first element which is higher as threshold non optimized
-
-        sigma = np.std(hist)
-        data_min = np.argwhere(hist > 100) # Finds the minimum bound for the fit
-        #print(data_min[-1])
-        mpv, eta, sigma, A = edges[ind_xmin], sigma, sigma, np.max(hist)
-        self.log.debug("Langau first guess: {} {} {} {}".format(mpv, eta, sigma, A))
-
-        # Fit with constrains
-        converged = False
-        it = 0
-        oldmpv = 0
-        diff = 100
-        while not converged:
-            it += 1
-            with warnings.catch_warnings():
-                warnings.simplefilter("ignore")
-                # create a text trap and redirect stdout
-                # Warning: astype(float) is important somehow, otherwise funny error happens one
-                # some machines where it tells you double_t and float are not possible
-                try:
-                    coeff, pcov = curve_fit(pylandau.langau, edges[ind_xmin:-1].astype(float),
-                                            hist[ind_xmin:].astype(float), absolute_sigma=False, p0=(mpv, eta, sigma, A),
-                                            #bounds=([150,1,1, np.max(hist)*0.5], [300,sigma*5,sigma*5, np.max(hist)*1.5]))
-                                            bounds=([data_min[-1],1,1, np.max(hist)*0.5], [edges[-1],sigma*2,sigma*2, np.max(hist)*1.5]))
-                except Exception as err:
-                    self.log.error("Langau fit did not converge with error: {}".format(err))
-                    return [1,1,1,1], None, hist, binerror, edges
-                self.log.debug("Langau coeff: {}".format(coeff))
-            if abs(coeff[0] - oldmpv) > diff:
-                mpv, eta, sigma, A = coeff
-                oldmpv = mpv
-            else:
-                converged = True
-            if it > 50:
-                converged = True
-                warnings.warn("Langau has not converged after 50 attempts!")
-
-        return coeff, pcov, hist, binerror, edges
+        return hist, edges, binerror
 
     def get_num_clusters(self, data, num_cluster):
         """
@@ -302,58 +356,229 @@ class Langau:
         for clus in num_cluster:
             events.append(
                 # Indizes of events with the desired clusternumbers
-                np.nonzero(data["base"]["Numclus"] == clus)[0])
+                np.nonzero(data["base"]["numclus"] == clus)[0])
         return events
 
     def calc_hist_errors(self, x, errors, bins):
-        """Calculates the errors for the bins in a histogram if error of simple point is known"""
-        errorBins = np.zeros(len(bins) - 1)
-        binsize = bins[1] - bins[0]
-
-        it = 0
-        for ind in bins:
-            if ind != bins[-1]:
-                ind_where_bin = np.where((x >= ind) & (x < (binsize + ind)))[0]
-                # mu, std = norm.fit(self.CMnoise)
-                if ind_where_bin.any():
-                    errorBins[it] = np.mean(np.take(errors, ind_where_bin))
-                it += 1
-
-        return errorBins
-
-    # depricated from multiprocessing
-    def langau_cluster(self, cls_ind, valid_events_Signal, valid_events_clusters,
-                       charge_cal, noise):
-        """Calculates the energy of events, clustersize independently"""
-        # for size in tqdm(clustersize_list, desc="(langau) Processing clustersize"):
-        totalE = np.zeros(len(cls_ind))
-        totalNoise = np.zeros(len(cls_ind))
-        # Loop over the clustersize to get total deposited energy
-        incrementor = 0
-        start = time()
-        #for ind in tqdm(cls_ind, desc="(langau) Processing event"):
-        def collector(ind, incrementor):
-            # Signal calculations
-            signal_clst_event = np.take(valid_events_Signal[ind],
-                                        valid_events_clusters[ind][0])
-            totalE[incrementor] = np.sum(
-                self.main.calibration.convert_ADC_to_e(signal_clst_event,
-                                                       charge_cal))
-
-            # Noise Calculations
-
-            # Get the Noise of an event
-            noise_clst_event = np.take(noise, valid_events_clusters[ind][0])
-            # eError is a list containing electron signal noise
-            totalNoise[incrementor] = np.sqrt(np.sum(
-                self.main.calibration.convert_ADC_to_e(noise_clst_event,
-                                                       charge_cal)))
-
-            incrementor += 1
-
-        Parallel(n_jobs=2, require='sharedmem')(delayed(collector)(ind, 0) for ind in cls_ind)
-
-        print("*********************************************" + time()-start)
-
-        preresults = {"signal": totalE, "noise": totalNoise}
-        return preresults
+        """Calculates the errors for the bins in a histogram if error of simple point is known
+        (mean of the errors of all points in the bin)"""
+        return binned_statistics(x, errors, bins)[1]
+
+
+class LangauFitter:
+    """LangauFitter fits the Landau-Gauss convolution to the histograms of the Langau analysis.
+
+    The start values of the fit are estimated from the shape of the histogram: The most probable
+    value and the amplitude from the highest bin, eta and sigma from the half widths left and right
+    of the maximum (the Landau is asymmetric, the Gauss not). If a spectrum with the same name was
+    fitted before (e.g. the previous run of a voltage scan), eta and sigma relative to the most
+    probable value are taken from this fit instead. The fit is repeated only as long as the most
+    probable value moves by more than one bin.
+
+    The results are cached by the histogram content, the start values (so the warm start) and the fit
+    configuration (cut and max_iterations), so identical fits (e.g. the reanalysis of a run) are not done again.
+
+    One fitter is shared by all Langau analyses of a process, which may run in parallel threads (see
+    PluginScheduler). The cache and the warm start results are only accessed under a lock.
+    """
+
+    def __init__(self, max_iterations=10, cache_size=100, logger=None):
+        """
+        :param max_iterations: Maximum number of fits per spectrum
+        :param cache_size: Number of fit results which are cached
+        :param logger: A specific logger if you want
+        """
+        self.log = logger or logging.getLogger(__class__.__name__)
+        self.max_iterations = max_iterations
+        self.cache_size = cache_size
+        self.cache = OrderedDict()
+        self.last_coeff = {}  # The last fit result of every spectrum, used for the warm start
+        self.lock = threading.Lock()
+
+    def fit(self, hist, edges, cut, spectrum="cluster", warm_start=True, use_cache=True):
+        """Fits the langau to the histogram
+
+        :param hist: The counts of the histogram
+        :param edges: The bin edges of the histogram
+        :param cut: Cut from maximum height of langau, at which the fit will start
+        :param spectrum: Name of the spectrum, for the warm start
+        :param warm_start: Use the last fit of this spectrum as start values
+        :param use_cache: Reuse the fit of an identical histogram and store this fit for reuse
+        :return: coeff, pcov, info (dict with time, iterations, cached and warm_start)
+        """
+        key, cached, p0, warm = self.prepare(hist, edges, cut, spectrum, warm_start, use_cache)
+        if cached is not None:
+            return cached
+        return self.finish(key, spectrum, warm, *fit_langau_histogram(hist, edges, cut, p0, self.max_iterations),
+                           use_cache=use_cache)
+
+    def prepare(self, hist, edges, cut, spectrum, warm_start=True, use_cache=True):
+        """Looks up the cache and calculates the start values of a fit
+
+        :return: key, cached result (or None), start values, warm started
+        """
+        start = time.time()
+        with self.lock:
+            last = self.last_coeff.get(spectrum) if warm_start else None
+
+        p0 = self.initial_guess(hist, edges)
+        warm = last is not None and last[0] > 0
+        if warm:
+            # Only the relative widths are taken from the last fit, the position and the amplitude
+            # change from run to run (e.g. with the voltage or the statistics)
+            p0[1:3] = np.asarray(last[1:3], dtype=float) * p0[0]/last[0]
+        self.log.debug("Langau first guess: {} {} {} {}".format(*p0))
+
+        key = (hashlib.sha1(np.ascontiguousarray(hist).tobytes() + np.ascontiguousarray(edges).tobytes()
+                            + p0.tobytes()).hexdigest(), float(cut), self.max_iterations)
+        with self.lock:
+            if use_cache and key in self.cache:
+                coeff, pcov = self.cache[key]
+                self.last_coeff[spectrum] = coeff
+                return key, (coeff, pcov, {"time": time.time()-start, "iterations": 0, "cached": True,
+                                           "warm_start": warm}), None, False
+        return key, None, p0, warm
+
+    def finish(self, key, spectrum, warm, coeff, pcov, iterations, fittime, error, use_cache=True):
+        """Stores the result of a fit for the cache (if use_cache) and the warm start
+
+        :return: coeff, pcov, info
+        """
+        info = {"time": fittime, "iterations": iterations, "cached": False, "warm_start": warm}
+        if error:
+            self.log.error("Langau fit did not converge with error: {}".format(error))
+            return [1,1,1,1], None, info
+        if iterations >= self.max_iterations:
+            self.log.warning("Langau has not converged after {} attempts!".format(self.max_iterations))
+
+        with self.lock:
+            self.last_coeff[spectrum] = coeff
+            if use_cache:
+                self.cache[key] = (coeff, pcov)
+                if len(self.cache) > self.cache_size:
+                    self.cache.popitem(last=False)
+        return coeff, pcov, info
+
+    @staticmethod
+    def initial_guess(hist, edges):
+        """Estimates the langau parameters (mpv, eta, sigma, A) from the histogram.
+        The half width left of the maximum is about 1.37 eta (Landau) plus the gauss, the right side is
+        about 1.3 eta wider than the left one."""
+        centers = (edges[:-1] + edges[1:])/2.
+        binwidth = edges[1]-edges[0]
+        # Smooth a little, otherwise single fluctuating bins are taken as maximum
+        smooth = np.convolve(hist, np.ones(3)/3., mode="same")
+        peak = np.argmax(smooth)
+        above = np.nonzero(smooth >= smooth[peak]/2.)[0]
+        left = max(centers[peak]-edges[above[0]], binwidth)
+        right = max(edges[above[-1]+1]-centers[peak], binwidth)
+        eta = max((right-left)/1.29, binwidth)
+        sigma = max(np.sqrt(max(left**2-(1.37*eta)**2, 0.))/1.18, binwidth)
+        return np.array([centers[peak], eta, sigma, np.max(hist)], dtype=float)
+
+
+class LangauFitScheduler:
+    """Runs the independent langau fits (e.g. all clusters, the clustersizes and the seed cut) of an
+    analysis on the process pool of the main analysis. Only the histograms are send to the workers,
+    the start values, the cache and the warm start are handled by the LangauFitter of this process.
+    Without a pool the fits are done directly when they are submitted.
+    """
+
+    def __init__(self, fitter, pool=None, warm_start=True, use_cache=True, logger=None):
+        """
+        :param fitter: The LangauFitter which prepares the fits and stores the results
+        :param pool: A multiprocessing pool, if None the fits are done in this process
+        :param warm_start: Start the fits from the last fit of the same spectrum
+        :param use_cache: Reuse the fits of identical histograms
+        :param logger: A specific logger if you want
+        """
+        self.log = logger or logging.getLogger(__class__.__name__)
+        self.fitter = fitter
+        self.pool = pool
+        self.warm_start = warm_start
+        self.use_cache = use_cache
+        self.pending = {}
+        self.results = {}
+
+    def submit(self, spectrum, hist, edges, cut):
+        """Submits the fit of a histogram
+
+        :param spectrum: Name of the spectrum, the results are returned with this name
+        :param hist: The counts of the histogram
+        :param edges: The bin edges of the histogram
+        :param cut: Cut from maximum height of langau, at which the fit will start
+        """
+        if not hist.any():
+            self.log.critical("Insufficient data to make a histogram for the {} spectrum, "
+                              "langau fit aborted! ".format(spectrum))
+            self.results[spectrum] = ([1, 1, 1, 1], None, {"time": 0., "iterations": 0, "cached": False,
+                                                           "warm_start": False})
+            return
+        key, cached, p0, warm = self.fitter.prepare(hist, edges, cut, spectrum, self.warm_start, self.use_cache)
+        if cached is not None:
+            self.results[spectrum] = cached
+        elif self.pool is None:
+            self.results[spectrum] = self.fitter.finish(
+                key, spectrum, warm, *fit_langau_histogram(hist, edges, cut, p0, self.fitter.max_iterations),
+                use_cache=self.use_cache)
+        else:
+            job = self.pool.apply_async(fit_langau_histogram, (hist, edges, cut, p0, self.fitter.max_iterations))
+            self.pending[spectrum] = (job, key, warm)
+
+    def collect(self):
+        """Waits for all submitted fits, the results are stored in the order the fits finish
+
+        :return: dict of spectrum: (coeff, pcov, info)
+        """
+        while self.pending:
+            for spectrum in [name for name, (job, _, _) in self.pending.items() if job.ready()]:
+                job, key, warm = self.pending.pop(spectrum)
+                self.results[spectrum] = self.fitter.finish(key, spectrum, warm, *job.get(), use_cache=self.use_cache)
+            if self.pending:
+                next(iter(self.pending.values()))[0].wait(0.01)
+        return self.results
+
+
+def fit_langau_histogram(hist, edges, cut, p0, max_iterations=10):
+    """Fits the langau to a histogram. The fit is repeated as long as the most probable value
+    moves by more than one bin. This is the job for the worker processes of the LangauFitScheduler.
+
+    :param hist: The counts of the histogram
+    :param edges: The bin edges of the histogram
+    :param cut: Cut from maximum height of langau, at which the fit will start
+    :param p0: The start values (mpv, eta, sigma, A)
+    :param max_iterations: Maximum number of fits
+    :return: coeff, pcov, iterations, time, error message (None if the fit succeeded)
+    """
+    start = time.time()
+    # Cut off noise part
+    lancut = np.max(hist) * cut  # Find maximum of hist and get the cut
+    ind_xmin = np.argwhere(hist > lancut)  # Finds the first element which is higher as threshold
+    ind_xmin = ind_xmin[0][0] if len(ind_xmin) else 0
+    # The mpv must be in the fitted range, eta and sigma not wider than the histogram
+    width = edges[-1] - edges[0]
+    lower = [edges[ind_xmin], width*1e-4, width*1e-4, np.max(hist)*0.5]
+    upper = [edges[-1], width, width, np.max(hist)*1.5]
+
+    # Fit with constrains
+    binwidth = edges[1]-edges[0]
+    coeff, pcov = p0, None
+    for it in range(1, max_iterations+1):
+        p0 = np.clip(coeff, lower, upper)
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore")
+            # Warning: astype(float) is important somehow, otherwise funny error happens one
+            # some machines where it tells you double_t and float are not possible
+            try:
+                coeff, pcov = curve_fit(pylandau.langau, edges[ind_xmin:-1].astype(float),
+                                        hist[ind_xmin:].astype(float), absolute_sigma=False, p0=p0,
+                                        bounds=(lower, upper), x_scale="jac")
+            except Exception as err:
+                return None, None, it, time.time()-start, str(err)
+        if abs(coeff[0] - p0[0]) <= binwidth:
+            break
+    return coeff, pcov, it, time.time()-start, None
+
+
+# One fitter for all runs of this process, this way a scan over several files is warm started
+LANGAU_FITTER = LangauFitter()
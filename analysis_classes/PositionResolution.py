@@ -14,7 +14,7 @@ class PositionResolution:
     """All functions concerning the position resolution performance testing
 
     How does it work:
-        - This analysis needs the ChargeSharing analysis already done to function correctly!!
+        - This analysis needs the ChargeSharing analysis, it is run before (and added if not configured)
         - With the eta/theta distribution already calculated, the first step is to apply a Savitzky-Golay
           fitler to the data to smooth out the fluctuations. (This is not necessary, but can be helpfull!!!)
         - Afterwards apply the eta-algorithm for hit position determination. This algorithm works best for small
@@ -31,6 +31,8 @@ class PositionResolution:
     Written by Dominic Bloech
 
     """
+    # The results this analysis reads (see PluginScheduler)
+    INPUTS = ("ChargeSharing",)
 
     def __init__(self, main_analysis, configs, logger=None):
         """
@@ -46,7 +48,7 @@ class PositionResolution:
 
         self.log = logger or logging.getLogger(__class__.__name__)
         self.main = main_analysis
-        self.data = self.main.outputdata.copy()
+        self.data = self.main.results_view()
 
         self.eta = self.data["ChargeSharing"]["eta"]
         self.theta = self.data["ChargeSharing"]["theta"]
@@ -72,7 +74,13 @@ class PositionResolution:
 
     def eta_algorithm(self, etas, N, etaedges):
         """This algorithm is for small angles. It uses the formula
-        x=Pitch* Int(dN/deta, deta 0, eta)/ Int(dN/deta, deta 0, 1)"""
+        x=Pitch* Int(dN/deta, deta 0, eta)/ Int(dN/deta, deta 0, 1)
+
+        :param etas: The eta (or theta) values of the clusters
+        :param N: The histogram of the etas
+        :param etaedges: The bin edges of the histogram
+        :return: positions, the (filtered) histogram
+        """
 
         if self.SavGol:
             params = self.SavGol_params
@@ -87,15 +95,14 @@ class PositionResolution:
         #csfullIntegrate = float(csderiv.integrate(etaedges[0],etaedges[-1]))
 
         # Todo: use trapezoid method to integrate???
+        # Cumulative integral of N up to every edge, the positions are interpolated linearly inside the bins
         diffs = np.diff(etaedges)
-        csfullIntegrate = np.sum(N*diffs)
+        integral = np.concatenate(([0.], np.cumsum(N*diffs)))
+        csfullIntegrate = integral[-1]
 
-        # Generate output array
-        positions = np.zeros(len(etas), dtype=np.float)
-        for i, eta in enumerate(etas):
-            endedge = np.nonzero(etaedges <= eta)[0]
-            #positions[i] = self.pitch*csderiv.integrate(0, etas[endedge[-1]])/csfullIntegrate
-            integ = np.sum(N[endedge-1]*diffs[endedge-1])
-            positions[i] = self.pitch*integ/csfullIntegrate
+        etas = np.asarray(etas)
+        bins = np.clip(np.searchsorted(etaedges, etas, side="right") - 1, 0, len(diffs) - 1)
+        inbin = np.clip((etas - etaedges[bins])/diffs[bins], 0., 1.)
+        positions = self.pitch*(integral[bins] + inbin*N[bins]*diffs[bins])/csfullIntegrate
 
-        return positions, N
\ No newline at end of file
+        return positions, N
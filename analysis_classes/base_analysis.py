@@ -2,7 +2,7 @@
 #pylint: disable=C0103
 import logging
 import numpy as np
-from analysis_classes.nb_analysis_funcs import parallel_event_processing
+from analysis_classes.nb_analysis_funcs import parallel_event_processing, merge_cluster_tables
 
 class BaseAnalysis:
     """BaseAnalysis handles the basic clustering analysis of all passed events.
@@ -46,19 +46,18 @@ class BaseAnalysis:
           dedicated function: nb_clustering
         - Finally all data has been processed and we have finished clustering
 
-        The data structure this algorithm returns you is as follows:
-
-        return is of type numpy.array:
-            [0] = processed signal: shape = (events, channels)
-            [1] = SN: shape = (events, channels)
-            [2] = CMN: shape = (events)
-            [3] = CMsig: shape = (events)
-            [4] = Hitmap: shape = (events, channels)
-            [5] = Channels hit: shape = (hitted channels)
-            [6] = Clusters: shape = (Channels hit shape = (channels in cluster))
-            [7] = Number of Clusters: shape = (events)
-            [8] = Clustersize: shape = (Channels hit: shape = (len(Clusters))
-            [9] = Timing: shape = (events)
+        The data structure this algorithm returns you is a columnar cluster table (dict), all
+        clusters and hits of all events are stored in flat arrays:
+            numclus, numhits, timing, cmn, cmsig: shape = (events)
+            signal, sn: shape = (events, channels) - only if keep_signal_matrix is set
+            event_offset: shape = (events+1) - clusters of event i are event_offset[i]:event_offset[i+1]
+            hit_offset: shape = (events+1) - hits of event i are hit_offset[i]:hit_offset[i+1]
+            cluster_event, cluster_size, cluster_charge, seed_channel: shape = (clusters)
+            cluster_offset: shape = (clusters+1) - channels of cluster j are cluster_offset[j]:cluster_offset[j+1]
+            cluster_channels, cluster_signal: shape = (channels in clusters)
+            hit_event, hit_channel, hit_signal: shape = (hits)
+            hitmap: shape = (channels)
+        For more details see build_cluster_table in the nb_analysis_funcs.py file.
 
 
         # Base Analysis specific params
@@ -70,12 +69,13 @@ class BaseAnalysis:
             - SN_cluster: float - Minimum SN of a cluster to be considered
             - numchan: int - Number of channels
             - max_cluster_size: int - maximum clustersize to look for
+            - keep_signal_matrix: bool - keep the signal and SN of all channels of every event
 
     Written by Dominic Bloech
 
     """
 
-    def __init__(self, main, events, timing, logger = None):
+    def __init__(self, main, events, timing, logger = None, accumulators=()):
         """
 
         :param main: MainAnalysis instance for additional paramerters if needed
@@ -83,46 +83,75 @@ class BaseAnalysis:
         :param timing: an array of all timing for every event (must be the same length
                        as events parameter!!!
         :param logger: If you want to pass a specific logger you can do so
+        :param accumulators: Objects with a method fill, which is called with the cluster
+                             table of every chunk (see PluginScheduler.accumulators)
         """
         self.log = logger or logging.getLogger(__class__.__name__)
         self.main = main
         self.events = events
         self.eventtiming = timing
+        self.accumulators = accumulators
         self.prodata = None
 
 
 
     def run(self):
-        """Does the actual event analysis and clustering in optimized python"""
-
-        # Get events with good timing and only process these events
-        gtime = np.nonzero(np.logical_and(self.eventtiming >= self.main.timingWindow[0],
-                                          self.eventtiming <= self.main.timingWindow[1]))
-        #self.eventtiming = self.eventtiming[gtime]
-
-        # Warning: If you have a RS and pulseshape recognition enabled the
-        # timing window has to be set accordingly
+        """Does the actual event analysis and clustering in optimized python.
+        The events are read and processed in chunks of chunk_size events, so the
+        memory needed for the raw and intermediate data only depends on the
+        chunk size. The results of all chunks are merged afterwards."""
+
+        numevents = len(self.eventtiming)
+        chunk_size = int(self.main.chunk_size or numevents) or 1
+        chunks = []
+        self.main.automasked_hit = 0
+        for start in range(0, numevents, chunk_size):
+            stop = min(start+chunk_size, numevents)
+            timing = self.eventtiming[start:stop]
+
+            # Get events with good timing and only process these events
+            gtime = np.nonzero(np.logical_and(timing >= self.main.timingWindow[0],
+                                              timing <= self.main.timingWindow[1]))
+            if not len(gtime[0]):
+                continue
+            events = np.array(self.events[start:stop], dtype=np.float32)
+
+            # Warning: If you have a RS and pulseshape recognition enabled the
+            # timing window has to be set accordingly
+            chunks.append(self.process_chunk(gtime, timing, events))
+            # Release the raw events of this chunk before the next one is read
+            del events
+
+        if not chunks:
+            self.log.warning("No events with good timing found!")
+            chunks.append(self.process_chunk((np.zeros(0, dtype=np.int64),), np.zeros(0, dtype=np.float32),
+                                             np.zeros((0, self.main.numChan), dtype=np.float32)))
+
+        self.prodata = merge_cluster_tables(chunks)
+        return self.prodata
 
-        # This should, in theory, use parallelization of the loop over event
-        # but i did not see any performance boost, maybe you can find the bug =)?
+    def process_chunk(self, gtime, timing, events):
+        """Clusters the events with good timing of one chunk
+        :return: cluster table of the chunk"""
         data, automasked_hits = parallel_event_processing(gtime,
-                                                              self.eventtiming,
-                                                              self.events,
-                                                              self.main.pedestal,
-                                                              np.mean(self.main.CMN),
-                                                              np.mean(self.main.CMsig),
-                                                              self.main.noise,
-                                                              self.main.numChan,
-                                                              self.main.SN_cut,
-                                                              self.main.SN_ratio,
-                                                              self.main.SN_cluster,
-                                                              max_clustersize=self.main.max_cluster_size,
-                                                              masking=self.main.automasking,
-                                                              material=self.main.material,
-                                                              poolsize=self.main.process_pool,
-                                                              Pool=self.main.Pool,
-                                                              noisy_strips=self.main.noise_analysis.noisy_strips)
-        self.prodata = data
-        self.main.automasked_hit = automasked_hits
-
-        return self.prodata
+                                                          timing,
+                                                          events,
+                                                          self.main.pedestal,
+                                                          np.mean(self.main.CMN),
+                                                          np.mean(self.main.CMsig),
+                                                          self.main.noise,
+                                                          self.main.numChan,
+                                                          self.main.SN_cut,
+                                                          self.main.SN_ratio,
+                                                          self.main.SN_cluster,
+                                                          max_clustersize=self.main.max_cluster_size,
+                                                          masking=self.main.automasking,
+                                                          material=self.main.material,
+                                                          poolsize=self.main.process_pool,
+                                                          Pool=self.main.Pool,
+                                                          noisy_strips=self.main.noise_analysis.noisy_strips,
+                                                          keep_signal_matrix=self.main.keep_signal_matrix)
+        self.main.automasked_hit += automasked_hits
+        for accumulator in self.accumulators:
+            accumulator.fill(data)
+        return data
@@ -0,0 +1,198 @@
+"""This file contains the executor which analyses several independent runs in parallel"""
+#pylint: disable=C0103,R0902,R0913
+import logging
+import os
+import traceback
+from multiprocessing import get_context
+from multiprocessing.connection import wait
+from time import time
+from .main_analysis import MainAnalysis
+
+# The signals are read as float32 (twice the int16 raw data), the signal and SN matrices are kept and the
+# clustering needs some working memory, so the peak memory of a run is a multiple of the file size
+RUN_MEMORY_FACTOR = 6
+
+def estimate_run_memory(path, configs):
+    """
+    Rough estimate of the peak memory of the analysis of a run
+
+    :param path: Path to the run file
+    :param configs: The configs of the run
+    :return: memory in bytes
+    """
+    size = os.path.getsize(path) if os.path.isfile(path) else 0
+    if configs.get("chunk_size", 0) and not configs.get("keep_signal_matrix", True):
+        # Only the cluster table is kept, the signals are processed chunk wise
+        return size
+    return size*RUN_MEMORY_FACTOR
+
+def analyse_run(path, configs):
+    """
+    Runs the main analysis of one run, this is the task of the batch workers
+
+    :param path: Path to the run file
+    :param configs: The configs of the run (including the calibration and noise analysis)
+    :return: outputdata of the MainAnalysis, runtime
+    """
+    start = time()
+    run_data = MainAnalysis(path, configs=configs)
+    return run_data.outputdata, time()-start
+
+def run_worker(connection, path, configs):
+    """
+    Analyses a run in a worker process and sends the result (or the traceback if it failed) back
+
+    :param connection: The sending end of the pipe to the BatchExecutor
+    :param path: Path to the run file
+    :param configs: The configs of the run
+    """
+    try:
+        result = analyse_run(path, configs)
+    except Exception:
+        result = traceback.format_exc()
+    connection.send(result)
+    connection.close()
+
+
+class BatchExecutor:
+    """BatchExecutor analyses independent runs (e.g. of a voltage or temperature scan) in parallel processes.
+
+    The runs are started in the order they were submitted, as long as the estimated memory of all running
+    runs stays within the memory budget (a run which alone exceeds the budget runs alone). Every finished run
+    is passed to a callback at once (e.g. to save its plots and results), so the results do not have to be
+    kept until the whole batch is done. A failing run is logged and reported in the summary, the other runs
+    go on.
+
+    Every run is analysed in a process of its own, which sends the result back through a pipe of its own
+    (so its memory is given back to the system afterwards). If the process dies (e.g. it is killed for lack
+    of memory) its pipe is closed, so the run is reported as failed and the other runs are not affected.
+
+    With one process the runs are analysed one after another in this process.
+    """
+
+    def __init__(self, processes=1, memory_budget=0, logger=None):
+        """
+        :param processes: Number of runs which are analysed at the same time (0 = number of cpu cores)
+        :param memory_budget: Maximum estimated memory of all running runs in GB (0 = no limit)
+        :param logger: A specific logger if you want
+        """
+        self.log = logger or logging.getLogger(__class__.__name__)
+        self.processes = int(processes) or os.cpu_count() or 1
+        self.memory_budget = memory_budget*1e9
+        self.tasks = []
+        self.summary = []
+
+    def submit(self, name, path, configs):
+        """
+        Adds a run to the batch
+
+        :param name: Name of the run (used in the summary)
+        :param path: Path to the run file
+        :param configs: The configs of the run (including the calibration and noise analysis)
+        """
+        memory = estimate_run_memory(path, configs)
+        if self.memory_budget and memory > self.memory_budget:
+            self.log.warning("The estimated memory of run %s (%.1f GB) exceeds the memory budget, "
+                             "it will run alone", name, memory/1e9)
+        if self.processes > 1 and configs.get("Processes", 1) > 1:
+            # The runs are the parallel part now, a pool in every worker would only compete for the cores
+            configs = dict(configs, Processes=1)
+        self.tasks.append((name, path, configs, memory))
+
+    def run(self, callback=None):
+        """
+        Analyses all submitted runs
+
+        :param callback: Function which is called with the name, the configs and the outputdata of every
+                         successful run as soon as the run is finished
+        :return: summary list of dicts with name, status, runtime, events and error of every run
+        """
+        self.summary = []
+        if self.processes > 1 and len(self.tasks) > 1:
+            self._run_pool(callback)
+        else:
+            for task in self.tasks:
+                try:
+                    result = analyse_run(task[1], task[2])
+                except Exception:
+                    result = traceback.format_exc()
+                self._finish(task, result, callback)
+        self.tasks = []
+        return self.summary
+
+    def _run_pool(self, callback):
+        """Runs the tasks in worker processes within the memory budget"""
+        context = get_context("spawn")
+        pending = list(enumerate(self.tasks))
+        running = {}  # receiving end of the pipe: index of the task, worker process
+        try:
+            while pending or running:
+                # Start as many runs as the free workers and the memory budget allow
+                while pending and len(running) < self.processes:
+                    index, (name, path, configs, memory) = pending[0]
+                    if running and self.memory_budget and \
+                            sum(self.tasks[i][3] for i, _ in running.values())+memory > self.memory_budget:
+                        break
+                    pending.pop(0)
+                    self.log.info("Starting the analysis of run %s", name)
+                    receiver, sender = context.Pipe(duplex=False)
+                    process = context.Process(target=run_worker, args=(sender, path, configs),
+                                              name="BatchExecutor-{}".format(index))
+                    try:
+                        process.start()
+                    except Exception:
+                        receiver.close()
+                        self._finish(self.tasks[index], traceback.format_exc(), callback)
+                        continue
+                    finally:
+                        sender.close()  # Only the worker may write, so the pipe is closed when it dies
+                    running[receiver] = (index, process)
+
+                # A pipe is ready when the result was sent or when the worker died
+                for receiver in wait(list(running)):
+                    index, process = running.pop(receiver)
+                    try:
+                        result = receiver.recv()
+                    except (EOFError, OSError):
+                        process.join()
+                        result = "The worker process died while analysing the run (exit code {}, killed e.g. " \
+                                 "for lack of memory or crashed)".format(process.exitcode)
+                    receiver.close()
+                    process.join()
+                    self._finish(self.tasks[index], result, callback)
+        finally:
+            for receiver, (_, process) in running.items():
+                process.terminate()
+                process.join()
+                receiver.close()
+
+    def _finish(self, task, result, callback):
+        """Passes the result of a run to the callback and adds it to the summary, the result is the
+        traceback if the run failed"""
+        name, _, configs, _ = task
+        if isinstance(result, str):
+            self.log.error("The analysis of run %s failed:\n%s", name, result)
+            self.summary.append({"name": name, "status": "failed", "runtime": 0., "events": 0,
+                                 "error": result.strip().splitlines()[-1]})
+            return
+        outputdata, runtime = result
+        entry = {"name": name, "status": "done", "runtime": runtime,
+                 "events": len(outputdata["base"]) if "base" in outputdata else 0, "error": ""}
+        if callback is not None:
+            try:
+                callback(name, configs, outputdata)
+            except Exception as err:
+                self.log.error("Processing the results of run %s failed: %s", name, err)
+                entry["status"] = "output failed"
+                entry["error"] = str(err)
+        self.summary.append(entry)
+
+    def report(self):
+        """Returns the summary of the last batch as printable table"""
+        lines = ["{:<40} {:<14} {:>10} {:>10}  {}".format("Run", "Status", "Time [s]", "Events", "Error")]
+        for entry in self.summary:
+            lines.append("{:<40} {:<14} {:>10.1f} {:>10}  {}".format(
+                entry["name"][-40:], entry["status"], entry["runtime"], entry["events"], entry["error"]))
+        failed = sum(entry["status"] != "done" for entry in self.summary)
+        lines.append("{} run(s) analysed, {} failed".format(len(self.summary), failed))
+        return "\n".join(lines)
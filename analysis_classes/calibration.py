@@ -24,6 +24,11 @@ class Calibration:
           defined as the gradient of the signal in ADCs vs. pulse height
           characteristic for each channel.
     """
+
+    # Config keys the results depend on (for the StageCache)
+    CONFIG_KEYS = ("isBinary", "use_gain_per_channel", "numChan", "charge_cal_polynom", "range_ADC_fit",
+                   "ADC_lookup_table", "calibrate_gain_to", "use_charge_cal", "Gain_params")
+
     def __init__(self, file_path="", Noise_calc=None,
                  configs=None, logger=None):
         """
@@ -54,6 +59,8 @@ class Calibration:
         self.numChan = configs.get("numChan", 256)
         self.degpoly = configs.get("charge_cal_polynom", 5)
         self.range = configs.get("range_ADC_fit", [])
+        self.ADC_lut_range = configs.get("ADC_lookup_table", 0)
+        self.ADC_lut = None
         self.offset = 0 # offset of adc to e conversion
         self.ADC_sig = None
         self.configs = configs
@@ -76,6 +83,19 @@ class Calibration:
         else:
             self.charge_calibration_calc(file_path)
 
+        # The lookup table makes the many conversions of the analysis nearly free
+        if self.ADC_lut_range:
+            self.ADC_lut = self.build_ADC_lookup_table(int(self.ADC_lut_range))
+
+    def __getstate__(self):
+        # The open files can not be stored and the configs may contain whole analysis objects
+        state = self.__dict__.copy()
+        state["charge_data"] = None
+        state["delay_data"] = None
+        state["configs"] = {key: value for key, value in self.configs.items()
+                            if key not in ("calibration", "noise_analysis")}
+        return state
+
     def use_predefined_cal_params(self):
         """Uses the predefined calibration parameters from the calibration file"""
         self.log.info("Using predefined gain parameters: %s", self.configs["Gain_params"])
@@ -83,6 +103,7 @@ class Calibration:
         self.ADC_sig = 1.
         self.charge_sig = 1.
         self.chargecoeff = [np.array(self.configs["Gain_params"]) for i in range(256)]
+        self.channel_coeff = np.tile(np.array(self.configs["Gain_params"], dtype=np.float64), (self.numChan, 1))
         #self.gain_calc()
         # So every strip has the same gain
 
@@ -145,36 +166,9 @@ class Calibration:
             # signals per pulse subtracted by pedestals and excluding noisy channels
             signals = np.array(self.charge_data["events"]["signal"][:]) - self.pedestal
             # signals = np.delete(signals, self.noisy_channels, axis=1)
-            # Calculate size of pulse group to obtain number of injected signals per pulse step
-            sigppulse = int(len(signals) / len(self.pulses))
-
-            start = 0
-
             # summarize signals of each pulse group by calculating the mean
             # signals of each pulse group per channel
-            for i in range(sigppulse, len(signals) + sigppulse, sigppulse):
-                raw_half = np.mean(signals[start:i][0::2], axis=0)
-                raw_half_std = np.std(signals[start:i][0::2], axis=0)
-                raw_half2 = np.mean(signals[start:i][1::2], axis=0)
-                raw_half2_std = np.std(signals[start:i][1::2], axis=0)
-
-                # Take only the correct polarity of pulses
-                if self.polarity == -1:
-                    meansig_neg_pulses = np.hstack(list(zip(raw_half[0::2], raw_half2[1::2])))
-                    std_neg_pulses = np.hstack(list(zip(raw_half_std[0::2], raw_half2_std[1::2])))
-                    self.meansig_charge.append(np.abs(meansig_neg_pulses))
-                    self.sig_std.append(std_neg_pulses)
-                elif self.polarity == 1:
-                    meansig_pos_pulses = np.hstack(list(zip(raw_half[1::2], raw_half2[0::2])))
-                    std_pos_pulses = np.hstack(list(zip(raw_half_std[1::2], raw_half2_std[0::2])))
-                    self.meansig_charge.append(np.abs(meansig_pos_pulses))
-                    self.sig_std.append(std_pos_pulses)
-                else:
-                    self.meansig_charge.append(np.mean(np.abs(signals[start:i]), axis=0))
-                    self.sig_std.append(np.std(np.abs(signals[start:i]), axis=0))
-                start = i
-            self.meansig_charge = np.array(self.meansig_charge)
-            self.sig_std = np.array(self.sig_std)
+            self.meansig_charge, self.sig_std = self.pulse_group_signals(signals, len(self.pulses))
 
             # For a pulse height of 0 one often finds non-zero values in meansig_charge
             # Use signals of 0 pulse as offset values and adjust rest accordingly
@@ -182,12 +176,6 @@ class Calibration:
             if np.mean(self.offset) > 5:
                 self.log.warning("Charge offset is greater then 5 ADC! This "
                                  "may be a result of bad calibration! Offset: {}".format(np.mean(self.offset)))
-            #self.meansig_charge = self.meansig_charge - offset
-            #for i, pul in enumerate(self.meansig_charge):
-            #    for j, val in enumerate(pul):
-            #        if val < 0:
-            #            self.meansig_charge[i][j] = 0
-
 
             # Calculate the mean over all channels for every pulse and then calc
             # a poly fit for the median gain curve
@@ -214,49 +202,92 @@ class Calibration:
             self.log.info("Mean fit coefficients over all channels are: %s", self.meancoeff)
 
             # Calculate the gain curve for EVERY channel-------------------------------------------
-            self.channel_coeff = np.zeros([self.numChan, self.degpoly+1])
-            for i in range(self.numChan):
-                if i not in self.noisy_channels:
-                    #self.log.debug("Fitting channel: {}".format(i))
-                    try:
-                        # Taking the correct channel from the means, this has the length of pulses, and the correct
-                        # polarity is already accored to. Warning first value will always be cutted away,
-                        # to ensure better convergence while fitting!!!
-                        mean_sig = self.meansig_charge[1:,i]
-                        sig_std = self.sig_std[1:, i]
-                        # Find the range for the fit
-                        if mean_sig[0] <= self.range[0] and mean_sig[-1] >= self.range[0]:
-                            xminarg = np.argwhere(mean_sig <= self.range[0])[-1][0]
-                            xmaxarg = np.argwhere(mean_sig <= self.range[1])[-1][0]
-                        else:
-                            self.log.error("Range for charge cal for channel {} may be poorly conditioned!!!".format(i))
-                            xminarg = 0
-                            xmaxarg = len(mean_sig)
-
-                        # In the beginning of the pulses the error can be huge. Therefore, check if std is small enough
-                        # Otherwise search for point, which has a low enough std
-                        std_ok = False
-                        while not std_ok:
-                            if xminarg == xmaxarg:
-                                # Todo: make it possible to run nontheless
-                                self.log.error("Could not find satisfying std value for charge cal in channel {}. This may happen"
-                                               " with bad calibration. Further calculations may fail! This channel"
-                                               " will be added to noisy channels!".format(i))
-                                self.noisy_channels = np.append(self.noisy_channels, [i])
-                            if mean_sig[xminarg]*0.4 <= sig_std[xminarg]:
-                                xminarg += 1
-                            else:
-                                std_ok = True
-                                break
-
-                        self.channel_coeff[i] = np.polyfit(mean_sig[xminarg:xmaxarg],
-                                                            self.pulses[xminarg:xmaxarg],
-                                                            deg=self.degpoly, full=False)
-                    except Exception as err:
-                        if "SVD did not converge" in str(err):
-                            self.log.error("SVD did not converge in Linear Least Squares for channel {}"
-                                           " this channel will be added to noisy channels!".format(i))
-                            self.noisy_channels = np.append(self.noisy_channels, i)
+            self.channel_coeff = self.channel_gain_fit(self.meansig_charge, self.sig_std)
+
+    def pulse_group_signals(self, signals, numpulses):
+        """Calculates the mean signal and its std of every pulse group for every channel. Only the pulses
+        with the selected polarity are taken into account. Alibava alternates the polarity of the injected
+        pulses per event and channel (e.g. channel 1 --> pos, channel 2 --> neg in the first event,
+        and the other way round in the next event).
+        :param signals: The pedestal corrected signals of the charge scan: shape = (events, channels)
+        :param numpulses: Number of pulse groups
+        :return: mean signal, std of the signal: shape = (pulses, channels)
+        """
+        # Reshape the signals into (pulses, injections, channels)
+        sigppulse = int(len(signals) / numpulses) # How many signals per pulses
+        signals = signals[:numpulses*sigppulse].reshape(numpulses, sigppulse, -1)
+
+        if not self.polarity:
+            return np.mean(np.abs(signals), axis=1), np.std(np.abs(signals), axis=1)
+
+        # Negative pulses are in the even events for even channels and in odd events for odd channels,
+        # positive pulses the other way round
+        even_channels = np.arange(signals.shape[2]) % 2 == 0
+        if self.polarity == 1:
+            even_channels = ~even_channels
+        meansig = np.where(even_channels, np.mean(signals[:, 0::2], axis=1), np.mean(signals[:, 1::2], axis=1))
+        sig_std = np.where(even_channels, np.std(signals[:, 0::2], axis=1), np.std(signals[:, 1::2], axis=1))
+        return np.abs(meansig), sig_std
+
+    def channel_gain_fit(self, meansig_charge, sig_std):
+        """Fits the gain curves (pulse vs. mean signal in ADC) of all channels at once.
+        The fit range is taken from the range_ADC_fit, the first value of every channel is always cut
+        away, to ensure better convergence while fitting. In the beginning of the pulses the error can be huge,
+        therefore, the fit starts at the first point with a small enough std. Channels for which no fit range
+        can be found are added to the noisy channels.
+        All polynomials are fitted as one batched least squares problem (same as numpy.polyfit per channel).
+        :param meansig_charge: Mean signal per pulse and channel: shape = (pulses, channels)
+        :param sig_std: Std of the signal per pulse and channel: shape = (pulses, channels)
+        :return: The polynomial coefficients per channel, highest power first: shape = (channels, degree+1)
+        """
+        mean_sig = meansig_charge[1:, :self.numChan]
+        sig_std = sig_std[1:, :self.numChan]
+        numpoints, numchan = mean_sig.shape
+        points = np.arange(numpoints)[:, None]
+
+        # Find the range for the fit
+        conditioned = np.logical_and(mean_sig[0] <= self.range[0], mean_sig[-1] >= self.range[0])
+        for ch in np.nonzero(~conditioned)[0]:
+            if ch not in self.noisy_channels:
+                self.log.error("Range for charge cal for channel {} may be poorly conditioned!!!".format(ch))
+        # Index of the last point below the range limits
+        xminarg = np.where(conditioned, numpoints-1-np.argmax((mean_sig <= self.range[0])[::-1], axis=0), 0)
+        xmaxarg = np.where(conditioned, numpoints-1-np.argmax((mean_sig <= self.range[1])[::-1], axis=0),
+                           numpoints)
+
+        # Search the first point in the range with a low enough std
+        std_ok = np.logical_and(mean_sig*0.4 > sig_std, points >= xminarg)
+        xminarg = np.where(std_ok.any(axis=0), np.argmax(std_ok, axis=0), numpoints)
+
+        # Channels with no points left can not be fitted
+        fitted = np.ones(numchan, dtype=bool)
+        fitted[np.asarray(self.noisy_channels, dtype=np.int64)] = False
+        for ch in np.nonzero(np.logical_and(fitted, xminarg >= xmaxarg))[0]:
+            # Todo: make it possible to run nontheless
+            self.log.error("Could not find satisfying std value for charge cal in channel {}. This may happen"
+                           " with bad calibration. Further calculations may fail! This channel"
+                           " will be added to noisy channels!".format(ch))
+            self.noisy_channels = np.append(self.noisy_channels, [ch])
+            fitted[ch] = False
+
+        # Batched least squares: Vandermonde matrices of all channels with the points outside of the fit range set
+        # to zero, these do not change the solution. Like numpy.polyfit the columns are scaled for a better condition
+        inrange = np.logical_and(np.logical_and(points >= xminarg, points < xmaxarg), fitted).T
+        lhs = np.power(mean_sig.T[:, :, None], np.arange(self.degpoly, -1, -1)) * inrange[:, :, None]
+        # Todo: The pulses are not shifted like the signals (first value cut away), this has always been the case
+        rhs = self.pulses[:numpoints] * inrange
+        scale = np.sqrt(np.sum(lhs*lhs, axis=1))
+        scale[scale == 0] = 1.
+        lhs /= scale[:, None, :]
+        U, S, Vt = np.linalg.svd(lhs, full_matrices=False)
+        # Singular values below the cutoff of numpy.polyfit are treated as zero
+        rcond = np.sum(inrange, axis=1)*np.finfo(float).eps
+        S_inv = np.divide(1., S, out=np.zeros_like(S), where=S > rcond[:, None]*S[:, :1])
+        coeff = np.einsum("cji,cj,ckj,ck->ci", Vt, S_inv, U, rhs)/scale
+
+        channel_coeff = np.zeros([self.numChan, self.degpoly+1])
+        channel_coeff[:numchan][fitted] = coeff[fitted]
+        return channel_coeff
 
     def convert_ADC_to_e(self, signals_adc, channels=(), use_mean=False, sub_offset=True):
         """
@@ -269,7 +300,7 @@ class Calibration:
         :param channels:  Optional parameter, it defines on which channel the corresponding ADC was aquired
         :param use_mean: Use the mean value instead
         :param sub_offset: Subtract the offset or not (I recommend to use the offset)
-        :return:
+        :return: The signals in electrons, in the same order as the passed signals
         """
 
         # Ensure that all signals are positive, since the cal is done with positive or flipped negative signals
@@ -279,31 +310,55 @@ class Calibration:
         if not self.use_gain_per_channel or use_mean:
             return np.absolute(np.polyval(self.meancoeff, signals_adc))
 
-        # Use gain per channel for calculations. Warning: order of results list is ordered per channel!!!
+        # Use gain per channel for calculations
         else:
             if len(signals_adc) != len(channels):
                 self.log.error("If you want to use gain_per_channel calculations please pass " \
                                                      "lists of same size. Passed lists did not have same length.")
                 return np.array([])
+            channels = np.asarray(channels).astype(np.int64)
 
-            result = np.array([])
-            unique_ch = np.unique(channels).astype(np.int)
-            signals_per_channel = []
-            # Order the signals per channel so calculations can be speed up
-            for ch in unique_ch:
-                signals_per_channel.append(np.take(signals_adc, np.nonzero(channels==ch)))
-
-            for sig, ch in zip(signals_per_channel, unique_ch):
-                result = np.append(result, np.polyval(self.channel_coeff[ch], sig))
+            if self.ADC_lut is not None:
+                result = self.lookup_ADC_to_e(signals_adc, channels)
+            else:
+                result = self.polyval_per_channel(signals_adc, channels)
 
             # Subtract the mean Offset to all calculated values if necessary
             #if sub_offset:
             #    offset = np.absolute(np.polyval(self.meancoeff, np.mean(self.offset)))
             #    result = result-offset
 
-
             return np.absolute(result)
 
+    def polyval_per_channel(self, signals_adc, channels):
+        """Evaluates the gain polynomial of the channel of every signal (Horner scheme)"""
+        result = np.zeros(np.shape(signals_adc))
+        for power in range(self.channel_coeff.shape[1]):
+            result = result*signals_adc + self.channel_coeff[channels, power]
+        return result
+
+    def build_ADC_lookup_table(self, max_adc):
+        """Precomputes the electrons for every integer ADC value from 0 to max_adc for every channel.
+        :param max_adc: Maximum ADC value of the table
+        :return: lookup table: shape = (channels, max_adc+1)
+        """
+        adc = np.arange(max_adc+1, dtype=np.float64)
+        lut = np.zeros((len(self.channel_coeff), max_adc+1))
+        for power in range(self.channel_coeff.shape[1]):
+            lut = lut*adc + self.channel_coeff[:, power, None]
+        return lut
+
+    def lookup_ADC_to_e(self, signals_adc, channels):
+        """Converts the signals with the lookup table, linear interpolated between the integer ADC values.
+        Signals outside of the table are calculated with the polynomial."""
+        index = np.floor(signals_adc).astype(np.int64)
+        intable = index < self.ADC_lut.shape[1]-1
+        index = np.where(intable, index, 0)
+        lower = self.ADC_lut[channels, index]
+        result = lower + (signals_adc-index)*(self.ADC_lut[channels, index+1]-lower)
+        if not intable.all():
+            result[~intable] = self.polyval_per_channel(signals_adc[~intable], channels[~intable])
+        return result
 
     def gain_calc(self, cut=1.5):
         """Calculates the gain per channel per pulse. Ignores values for
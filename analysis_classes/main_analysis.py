@@ -3,11 +3,14 @@ run data"""
 #pylint: disable=R0902,R0915,C0103,C0301
 
 import logging
-from multiprocessing import Pool
+from multiprocessing import get_context, resource_tracker
 from time import time
+from types import MappingProxyType
 import numpy as np
 from .base_analysis import BaseAnalysis
-from .utilities import Bdata, read_binary_Alibava, load_plugins
+from .utilities import Bdata, read_binary_Alibava, timing_profile
+from .plugin_scheduler import PluginScheduler
+from .results_store import HDF5ResultsWriter
 from .utilities import import_h5
 
 class MainAnalysis:
@@ -18,16 +21,25 @@ class MainAnalysis:
     It does not have any fancy algorithms in it.
 
     """
-    def __init__(self, path, configs, logger=None):
+    def __init__(self, path, configs, logger=None, saved_results=None):
         """MainAnalysis simply handles all logic to perform the complete analysis.
            It first conducts the BaseAnalysis - Preprocessing and Clustering
            Afterwards if conducts all analysis specified in the configs file.
            It does not have any fancy algorithms in it.
 
+           If the saved results of a run are passed (see results_store.py), the raw data is not read and the
+           clustering is not repeated. Only the additional analyses run on the saved base results.
+
         Config params:
             - isBinary: bool - Whether or not the input file is AliBaVa binary or HDF5
             - additional_analysis: list - containing the names of the analysises which should be done
             - Processes: int number of pool size for multiprocessing
+            - chunk_size: int - Number of events which are processed at once, 0 processes all events at once
+            - keep_signal_matrix: bool - Keep the signal and SN of all channels of every event (needs a lot of memory)
+            - Plugin_threads: int - Number of additional analyses which may run at the same time (0 = all)
+            - Timing_profile: dict - bins and yrange of the 2D histogram of the timing profile
+            - results_file: str - Path of a HDF5 file the results are written to, stage by stage (see results_store.py)
+            - Results_compression: str - Compression of the large arrays in the results file (gzip, lzf or None)
 
         """
 
@@ -35,11 +47,16 @@ class MainAnalysis:
         self.log = logger or logging.getLogger(__class__.__name__)
         self.start = time()
 
-        self.log.info("Loading event file(s): %s", path)
-        if not configs.get("isBinary", False):
+        self.saved_results = saved_results
+        if saved_results is not None:
+            self.log.info("Reanalysing the saved results: %s", path)
+            self.data = None
+        elif not configs.get("isBinary", False):
+            self.log.info("Loading event file(s): %s", path)
             self.data = import_h5(path)
         else:
-            self.data = read_binary_Alibava(path)
+            self.log.info("Loading event file(s): %s", path)
+            self.data = read_binary_Alibava(path, lazy=True)
 
         self.outputdata = {}
         self.results = self.outputdata
@@ -68,60 +85,110 @@ class MainAnalysis:
         else:
             self.material = 0  # Easier to handle
 
-        # Create a pool for multiprocessing
+        # Create a pool for multiprocessing, only if more than one process is needed
         self.process_pool = configs.get("Processes", 1)  # How many workers
-        self.Pool = Pool(processes=self.process_pool)
-
-        self.log.info("Processing file ...")
-        self.events = np.array(self.data["events"]["signal"][:], dtype=np.float32)
-        self.timing = np.array(self.data["events"]["time"][:], dtype=np.float32)
-
+        self.Pool = None
+        if self.process_pool > 1:
+            # Start the resource tracker before the workers, so all share the same one and the shared
+            # memory of the event processing is only released by the process which created it
+            resource_tracker.ensure_running()
+            # Warning: The workers are spawned not forked, forking a process which already used the
+            # parallel numba kernels can deadlock
+            self.Pool = get_context("spawn").Pool(processes=self.process_pool)
+
+        # The results file and the pool are closed in the end, also if the analysis fails
+        self.results_writer = None
         try:
-            file = str(self.data).split('"')[1].split('.')[0]
-        except:
-            file = str(self.data)
-
-        # Add the noise results to the final dict
-        self.outputdata["noise"] = {"pedestal": self.pedestal, "cmn": self.CMN, "cmnsig": self.CMsig,
-                                    "noise": self.noise}
-
-        # Start the base analysis with clustering
-        _object = BaseAnalysis(self, self.events, self.timing)
-        results = _object.run()
-
-        self.outputdata["base"] = Bdata(results,
-                                        labels=["Signal", "SN", "CMN", "CMsig",
-                                                "Hitmap", "Channel_hit",
-                                                "Clusters", "Numclus",
-                                                "Clustersize", "Timing"])
-
-        # Now process additional analysis stated in the config file
-        # Load all plugins
-        plugins = load_plugins(configs.get("additional_analysis", []))
-        for name, plugin in plugins.items():
-            self.log.info("Starting analysis: {}".format(name))
-            analysis = plugin(self, configs.get(name, {}))
-            self.outputdata[name] = analysis.run()
-
-        # In the end give a round up of all you have done
-        print(\
-            "*************************************************************************\n"
-            "            Analysis report:                                             \n"
-            "            ~~~~~~~~~~~~~~~~                                             \n"
-            "                                                                         \n"
-            "            Events processed:  {events!s}                                \n"
-            "            Total events:      42                          \n"
-            "            Time taken:        {time!s}                                  \n"
-            "                                                                         \n"
-            "*************************************************************************\n"\
-            .format(automasked=42,
-                    events=len(self.outputdata["base"]["Signal"]),
-                    time=round((time() - self.start), 1)))
-
-        # Close the pool
-        self.Pool.close()
-        self.Pool.join()
-
+            self.log.info("Processing file ...")
+            # The events are not loaded here, the BaseAnalysis reads them chunk
+            # wise from the file (all at once if chunk_size is 0)
+            self.chunk_size = configs.get("chunk_size", 0)
+            self.keep_signal_matrix = configs.get("keep_signal_matrix", True)
+            if saved_results is None:
+                self.events = self.data["events"]["signal"]
+                self.timing = np.array(self.data["events"]["time"][:], dtype=np.float32)
+            else:
+                # Only the events with good timing are in the saved results
+                self.events = None
+                self.timing = np.asarray(saved_results["base"]["timing"])
+
+            try:
+                file = str(self.data).split('"')[1].split('.')[0]
+            except:
+                file = str(self.data)
+
+            # The results are written stage by stage, so a file of an aborted analysis contains the finished stages
+            if configs.get("results_file", ""):
+                self.results_writer = HDF5ResultsWriter(configs["results_file"], configs.get("Results_compression", "gzip"))
+                self.results_writer.write_object("NoiseAnalysis", self.noise_analysis)
+                self.results_writer.write_object("Calibration", self.calibration)
+
+            # Add the noise results to the final dict
+            self.outputdata["noise"] = {"pedestal": self.pedestal, "cmn": self.CMN, "cmnsig": self.CMsig,
+                                        "noise": self.noise}
+
+            # The plugins are created here already, some of them fill their results while the events are clustered
+            self.plugin_scheduler = PluginScheduler(self, configs, configs.get("Plugin_threads", 0))
+            if saved_results is None:
+                # Start the base analysis with clustering
+                _object = BaseAnalysis(self, self.events, self.timing,
+                                       accumulators=self.plugin_scheduler.accumulators())
+                results = _object.run()
+                self.outputdata["base"] = Bdata(results)
+            else:
+                # The columns are read (or memory mapped) when they are accessed
+                self.outputdata["base"] = saved_results["base"]
+
+            # The timing profile of the seed signal, from the per event columns of the cluster table
+            profile_configs = configs.get("Timing_profile", {}) or {}
+            self.outputdata["timing_profile"] = timing_profile(self.outputdata["base"]["timing"],
+                                                               self.outputdata["base"]["seed_sum"],
+                                                               bins=profile_configs.get("bins", 30),
+                                                               yrange=profile_configs.get("yrange", [-250, -1]))
+            self.write_results("noise")
+            self.write_results("base")
+            self.write_results("timing_profile")
+
+            # The additional analyses only read the base results, so they share them without copies
+            self.outputdata["base"].set_readonly()
+
+            # Now process additional analysis stated in the config file, in the order of their dependencies
+            self.plugin_stats = self.plugin_scheduler.run(callback=lambda name, _: self.write_results(name))
+
+            # In the end give a round up of all you have done
+            print(\
+                "*************************************************************************\n"
+                "            Analysis report:                                             \n"
+                "            ~~~~~~~~~~~~~~~~                                             \n"
+                "                                                                         \n"
+                "            Events processed:  {events!s}                                \n"
+                "            Total events:      42                          \n"
+                "            Time taken:        {time!s}                                  \n"
+                "                                                                         \n"
+                "*************************************************************************\n"\
+                .format(automasked=42,
+                        events=len(self.outputdata["base"]),
+                        time=round((time() - self.start), 1)))
+        except BaseException:
+            if self.Pool is not None:
+                self.Pool.terminate()
+            raise
+        finally:
+            if self.results_writer is not None:
+                self.results_writer.close()
+            if self.Pool is not None:
+                self.Pool.close()
+                self.Pool.join()
+
+
+    def write_results(self, name):
+        """Writes the results of a finished stage to the results file (if there is one)"""
+        if self.results_writer is not None:
+            self.results_writer.write(name, self.outputdata[name])
+
+    def results_view(self):
+        """Returns a read only view of the results (no copy), for the additional analyses"""
+        return MappingProxyType(self.outputdata)
 
     def configure_configs(self, configs):
         """Takes every parent entry in the configs dict and makes a object for
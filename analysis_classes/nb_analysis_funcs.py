@@ -1,5 +1,6 @@
 """This files contains analysis function optimizes by numba jit capabilities"""
 #pylint: disable=E1111,C0103
+import numba
 from numba import jit, prange
 import numpy as np
 
@@ -8,82 +9,136 @@ gil = True # Use gil or not
 Fast = True # Use fastmath
 parallel = True # Use parallel execution
 
-jit(nogil=gil, cache=True, nopython=True, fastmath=Fast)
-def event_process_function_multithread(args):
-    """Just a small wrapper foe the multiprocessing function
-
-    Written by Dominic Bloech
-    """
-    events, pedestal, meanCMN, meanCMsig, noise, numchan, SN_cut, SN_ratio, SN_cluster, max_clustersize, masking, material, noisy_strips = args
-    return event_process_function(events, pedestal, meanCMN, meanCMsig, noise,
-                           numchan, SN_cut, SN_ratio, SN_cluster, max_clustersize,
-                           masking, material, noisy_strips)
-
-jit(nogil=gil, parallel=parallel, nopython=True, fastmath=Fast)
 def event_process_function(events, pedestal, meanCMN, meanCMsig, noise,
                            numchan, SN_cut, SN_ratio, SN_cluster, max_clustersize,
-                           masking, material, noisy_strips, event_timings):
+                           masking, material, noisy_strips, event_timings, keep_signal_matrix=True):
     """
-    This function simply handles the preprocessing of all events, like garbage clean up and then clustering
-    :param events:
-    :param pedestal:
-    :param meanCMN:
-    :param meanCMsig:
-    :param noise:
-    :param numchan:
-    :param SN_cut:
-    :param SN_ratio:
-    :param SN_cluster:
-    :param max_clustersize:
-    :param masking:
-    :param material:
-    :param noisy_strips:
-    :param event_timings:
-    :return:
+    This function simply handles the preprocessing of all events, like garbage clean up and then clustering.
+    All the work is done in the compiled kernels nb_preprocess_all_events and nb_clustering_all_events,
+    here only the results are brought into the cluster table (see build_cluster_table).
+    :param events: The events: shape = (events, channels)
+    :param pedestal: The pedestal: shape = (channels)
+    :param meanCMN: The mean CMN
+    :param meanCMsig: The mean CMNsig
+    :param noise: The noise per channel: shape = (channels)
+    :param numchan: Number of channels
+    :param SN_cut: The SN_cut from the config
+    :param SN_ratio: The SN_ratio from the config
+    :param SN_cluster: The SN_cluster from the config
+    :param max_clustersize: Maximum cluster size
+    :param masking: Bool, if you want masking of channels with false polarity
+    :param material: The base material of the sensor, needed for polarity check
+    :param noisy_strips: The noisy strips, these will be set to 0
+    :param event_timings: The timing of every event: shape = (events)
+    :param keep_signal_matrix: Bool, if the signal and SN of all channels should be kept in the table
+    :return: The cluster table (dict), number of automasked hits
 
     Written by Dominic Bloech
     """
 
-    # Generate the output array
-    prodata = np.zeros((len(events), 10), dtype=np.object)
-    index = 0
-    # Generate the hitmap
-    hitmap = np.zeros(numchan)
-
     # Preprocess all events for the clustering algorithm
-    signal, SN, CMN, CMsig = nb_preprocess_all_events(events, pedestal, meanCMN,
-                                                   meanCMsig, noise, numchan, noisy_strips)
+    signal, SN, CMN, CMsig = nb_preprocess_all_events(events, pedestal, meanCMN, meanCMsig, noise,
+                                                      numchan, np.asarray(noisy_strips, dtype=np.int64))
 
     # Pass all events to the clustering algorithm
-    for i in prange(0, len(events)):
-        channels_hit, clusters, numclus, clustersize, automasked_hits = nb_clustering(signal[i], SN[i], noise, SN_cut,
-                                                                                      SN_ratio, SN_cluster, numchan,
-                                                                                      max_clustersize=max_clustersize,
-                                                                                      masking=masking,
-                                                                                      material=material)
-        # Build the hitmap for this event
-        for channel in channels_hit:
-            hitmap[channel] += 1
-
-        # Add the results to the results array for every event
-        prodata[index]=np.array([
-            signal[i],
-            SN[i],
-            CMN,
-            CMsig,
-            hitmap,
-            channels_hit,
-            clusters,
-            numclus,
-            clustersize,
-            event_timings[i]])
-        index +=1
-    return prodata
-
-jit(nogil=gil, parallel=parallel, nopython=True, fastmath=Fast)
+    hit_offset, hit_channel, event_offset, cluster_size, cluster_offset, cluster_channels, hitmap, automasked = \
+        nb_clustering_all_events(signal, SN, noise, SN_cut, SN_ratio, SN_cluster, numchan,
+                                 max_clustersize, masking, material, numba.config.NUMBA_NUM_THREADS)
+
+    table = build_cluster_table(signal, SN, CMN, CMsig, event_timings, hit_offset, hit_channel,
+                                event_offset, cluster_size, cluster_offset, cluster_channels, hitmap,
+                                keep_signal_matrix)
+    return table, int(np.sum(automasked))
+
+def build_cluster_table(signal, SN, CMN, CMsig, event_timings, hit_offset, hit_channel, event_offset,
+                        cluster_size, cluster_offset, cluster_channels, hitmap, keep_signal_matrix=True):
+    """
+    Puts the results of the clustering into a columnar table. Instead of python lists per event
+    all clusters and hits are stored in flat arrays, which are indexed by offset arrays:
+
+        per event:   numclus, numhits, timing, cmn, cmsig
+                     seed_sum - sum of the signal of all hits (seeds) of the event
+                     event_offset - clusters of event i are event_offset[i]:event_offset[i+1]
+                     hit_offset - hits of event i are hit_offset[i]:hit_offset[i+1]
+                     signal, sn - shape = (events, channels), only if keep_signal_matrix
+        per cluster: cluster_event, cluster_size, cluster_charge (sum of the signal in ADC), seed_channel
+                     cluster_offset - channels of cluster j are cluster_offset[j]:cluster_offset[j+1]
+        per channel in cluster: cluster_channels, cluster_signal
+        per hit:     hit_event, hit_channel, hit_signal
+        hitmap - shape = (channels)
+
+    :return: dict containing the columns
+    """
+    numevents = len(event_timings)
+    numclus = np.diff(event_offset)
+    numhits = np.diff(hit_offset)
+    cluster_event = np.repeat(np.arange(numevents), numclus)
+    hit_event = np.repeat(np.arange(numevents), numhits)
+    hit_signal = signal[hit_event, hit_channel]
+
+    # Gather the signals of the channels in the clusters and of the seed hits
+    cluster_signal = signal[np.repeat(cluster_event, cluster_size), cluster_channels]
+    if len(cluster_size):
+        cluster_charge = np.add.reduceat(cluster_signal, cluster_offset[:-1])
+    else:
+        cluster_charge = np.zeros(0)
+
+    table = {"numclus": numclus,
+             "numhits": numhits,
+             "timing": np.asarray(event_timings, dtype=np.float32),
+             "cmn": CMN.astype(np.float32),
+             "cmsig": CMsig.astype(np.float32),
+             "seed_sum": np.bincount(hit_event, weights=hit_signal, minlength=numevents),
+             "event_offset": event_offset,
+             "hit_offset": hit_offset,
+             "cluster_event": cluster_event,
+             "cluster_size": cluster_size.astype(np.int32),
+             "cluster_offset": cluster_offset,
+             "cluster_charge": cluster_charge,
+             "seed_channel": cluster_channels[cluster_offset[:-1]].astype(np.int32),
+             "cluster_channels": cluster_channels.astype(np.int32),
+             "cluster_signal": cluster_signal,
+             "hit_event": hit_event,
+             "hit_channel": hit_channel.astype(np.int32),
+             "hit_signal": hit_signal,
+             "hitmap": hitmap}
+    if keep_signal_matrix:
+        table["signal"] = signal.astype(np.float32)
+        table["sn"] = SN.astype(np.float32)
+    return table
+
+# Columns of the cluster table which point into other columns and have to be shifted when tables are merged
+OFFSET_COLUMNS = ("event_offset", "hit_offset", "cluster_offset")
+EVENT_INDEX_COLUMNS = ("cluster_event", "hit_event")
+
+def merge_cluster_tables(tables):
+    """
+    Merges the cluster tables of consecutive event blocks (e.g. chunks) into one table,
+    as if all events had been processed at once.
+    :param tables: list of cluster tables
+    :return: merged cluster table
+    """
+    if len(tables) == 1:
+        return tables[0]
+    event_shifts = np.cumsum([0] + [len(table["numclus"]) for table in tables])
+    merged = {}
+    for key in tables[0]:
+        if key == "hitmap":
+            merged[key] = np.sum([table[key] for table in tables], axis=0)
+        elif key in OFFSET_COLUMNS:
+            shifts = np.cumsum([0] + [table[key][-1] for table in tables])
+            merged[key] = np.concatenate([tables[0][key][:1]] +
+                                         [table[key][1:] + shift for table, shift in zip(tables, shifts)])
+        elif key in EVENT_INDEX_COLUMNS:
+            merged[key] = np.concatenate([table[key] + shift for table, shift in zip(tables, event_shifts)])
+        else:
+            merged[key] = np.concatenate([table[key] for table in tables])
+    return merged
+
 def parallel_event_processing(goodtiming, timings, events, pedestal, meanCMN, meanCMsig, noise,
                               numchan, SN_cut, SN_ratio, SN_cluster, max_clustersize = 5,
-                              masking=True, material=1, poolsize = 1, Pool=None, noisy_strips = []):
+                              masking=True, material=1, poolsize = 1, Pool=None, noisy_strips = [],
+                              keep_signal_matrix=True):
     """
     This function handles all logic to distribute the event processing and clustering to several cores
     to speed up the calculations. It does not do anything complicated.
@@ -103,63 +158,137 @@ def parallel_event_processing(goodtiming, timings, events, pedestal, meanCMN, me
     :param poolsize: Poolsize of the multiprocessing
     :param Pool: The actual muzltiprocessing pool
     :param noisy_strips: All noisy/masked strips from the user
-    :return: The processed data
+    :param keep_signal_matrix: Bool, if the signal and SN of all channels should be kept
+    :return: The cluster table, number of automasked hits
 
     Written by Dominic Bloech
     """
 
-    # Get the number of how many good events there are
-    goodevents = goodtiming[0].shape[0]
-    automasked = 0
     # Slice out all good events
     events_good = events[goodtiming[0]].astype(np.float32)
     eventiming = timings[goodtiming[0]].astype(np.float32)
 
     # Do in the multiprocessed way if poolsize is greater as one
-    if poolsize > 1:
-        # Split data for the pools
-        splits = int(goodevents/poolsize) # you may loose the last event!!!
-        paramslist = []
-        start = 0
-        for i in range(poolsize):
-            end = splits*(i+1)
-            paramslist.append((events_good[start:end], pedestal, meanCMN, meanCMsig,
-                               noise, numchan, SN_cut, SN_ratio, SN_cluster, max_clustersize,
-                               masking, material, noisy_strips, eventiming[start:end]))
-            start=end+1
-
-        # Todo: Currently not working due to performance issues
-        #results = Parallel(n_jobs=poolsize, verbose=1, backend='threading', require="sharedmem")(map(delayed(event_process_function_multithread),
-        #                                                                                           paramslist))
-        results = []
-        for i in prange(poolsize):
-            results.append(event_process_function_multithread(paramslist[i]))
-
-        # Build the correct Hitmap which gets lost during calculations
-        hitmap = np.zeros(numchan)
-        for hmap in results:
-            hitmap += hmap[-1][4]
-        prodata = np.concatenate(results, axis=0)
-        # Set the last hit with the full hitmap # I know this is pretty shitty coding style.
-        prodata[-1][4] = hitmap
-        return prodata, automasked
+    if poolsize > 1 and Pool is not None:
+        return shared_event_processing(events_good, eventiming, pedestal, meanCMN, meanCMsig, noise,
+                                       numchan, SN_cut, SN_ratio, SN_cluster, max_clustersize,
+                                       masking, material, noisy_strips, keep_signal_matrix, poolsize, Pool)
 
     else:
         # If no multiprocessing is needed, simply call the event_process_function
-        prodata = event_process_function(events_good, pedestal, meanCMN,
-                                         meanCMsig, noise, numchan, SN_cut, SN_ratio, SN_cluster,
-                                         max_clustersize, masking, material, noisy_strips, eventiming)
-        return np.array(prodata), automasked
-
-@jit(nopython = True, cache=True, nogil=gil, fastmath=Fast)
-def nb_clustering(event, SN, noise, SN_cut, SN_ratio, SN_cluster, numchan, max_clustersize = 5,
-                  masking=True, material=1):
+        return event_process_function(events_good, pedestal, meanCMN,
+                                      meanCMsig, noise, numchan, SN_cut, SN_ratio, SN_cluster,
+                                      max_clustersize, masking, material, noisy_strips, eventiming,
+                                      keep_signal_matrix)
+
+def shared_event_processing(events, timings, pedestal, meanCMN, meanCMsig, noise, numchan,
+                            SN_cut, SN_ratio, SN_cluster, max_clustersize, masking, material,
+                            noisy_strips, keep_signal_matrix, poolsize, Pool):
+    """
+    Multiprocessing backend of the event processing. The events, timings, pedestal and noise are placed
+    once in shared memory, every worker clusters a disjoint range of events and writes the signal
+    and SN into shared output arrays. The cluster tables of the workers are merged in the end.
+    This way the memory needed stays close to the one of a single process.
+    For the parameters see parallel_event_processing.
+    :return: The cluster table, number of automasked hits
+    """
+    try:
+        from multiprocessing import shared_memory  # pylint: disable=unused-import
+    except ImportError:
+        raise ImportError("More than one process for the clustering needs python >= 3.8 "
+                          "(multiprocessing.shared_memory), set Processes to 1")
+    numevents = len(events)
+    # Disjoint ranges of events for every worker, without gaps
+    bounds = [i*numevents//poolsize for i in range(poolsize+1)]
+    inputs = {"events": events, "timings": timings, "pedestal": pedestal, "noise": noise}
+    outputs = ("signal", "sn") if keep_signal_matrix else ()
+
+    handles, arrays, specs = {}, {}, {}
+    try:
+        for key, array in inputs.items():
+            handles[key], arrays[key], specs[key] = create_shared_array(np.shape(array), np.asarray(array).dtype)
+            arrays[key][...] = array
+        for key in outputs:
+            handles[key], arrays[key], specs[key] = create_shared_array(events.shape, np.float32)
+
+        params = (meanCMN, meanCMsig, numchan, SN_cut, SN_ratio, SN_cluster, max_clustersize,
+                  masking, material, noisy_strips, keep_signal_matrix)
+        # Do not start more threads as cores are available
+        numthreads = max(1, numba.config.NUMBA_NUM_THREADS//poolsize)
+        paramslist = [(specs, bounds[i], bounds[i+1], params, numthreads) for i in range(poolsize)]
+        results = Pool.map(event_process_function_shared, paramslist, chunksize=1)
+
+        table = merge_cluster_tables([res[0] for res in results])
+        for key in outputs:
+            table[key] = np.array(arrays[key])
+        return table, sum(res[1] for res in results)
+    finally:
+        # All views on the shared memory have to be gone before it can be released
+        arrays.clear()
+        for handle in handles.values():
+            handle.close()
+            handle.unlink()
+
+def event_process_function_shared(args):
+    """Worker of the shared memory multiprocessing: Clusters the events in the range start:stop
+    and writes the signal and SN into the shared output arrays
+    """
+    specs, start, stop, params, numthreads = args
+    meanCMN, meanCMsig, numchan, SN_cut, SN_ratio, SN_cluster, max_clustersize, \
+        masking, material, noisy_strips, keep_signal_matrix = params
+    # Older numba versions (< 0.49) can not limit the threads
+    if hasattr(numba, "set_num_threads"):
+        numba.set_num_threads(numthreads)
+
+    handles, arrays = {}, {}
+    try:
+        for key, spec in specs.items():
+            handles[key], arrays[key] = attach_shared_array(spec)
+        table, automasked = event_process_function(arrays["events"][start:stop], np.array(arrays["pedestal"]),
+                                                   meanCMN, meanCMsig, np.array(arrays["noise"]), numchan,
+                                                   SN_cut, SN_ratio, SN_cluster, max_clustersize, masking,
+                                                   material, noisy_strips, np.array(arrays["timings"][start:stop]),
+                                                   keep_signal_matrix)
+        if keep_signal_matrix:
+            arrays["signal"][start:stop] = table.pop("signal")
+            arrays["sn"][start:stop] = table.pop("sn")
+        return table, automasked
+    finally:
+        arrays.clear()
+        for handle in handles.values():
+            handle.close()
+
+def create_shared_array(shape, dtype):
+    """Creates a numpy array in shared memory
+    :return: shared memory handle, array, spec to attach to the array from other processes"""
+    from multiprocessing import shared_memory
+    dtype = np.dtype(dtype)
+    handle = shared_memory.SharedMemory(create=True, size=max(int(np.prod(shape))*dtype.itemsize, 1))
+    array = np.ndarray(shape, dtype=dtype, buffer=handle.buf)
+    return handle, array, (handle.name, shape, dtype.str)
+
+def attach_shared_array(spec):
+    """Attaches to a numpy array in shared memory created by create_shared_array
+    :return: shared memory handle, array"""
+    from multiprocessing import shared_memory
+    name, shape, dtype = spec
+    handle = shared_memory.SharedMemory(name=name)
+    return handle, np.ndarray(shape, dtype=dtype, buffer=handle.buf)
+
+# Warning: No fastmath for the clustering, the noise of masked strips is NaN and these
+# comparisons must stay IEEE conform
+@jit(nopython=True, cache=True, nogil=gil, error_model="numpy")
+def nb_clustering(event, SN, noise, SN_cut, SN_ratio, SN_cluster, numchan, max_clustersize,
+                  masking, material, used_channels, channels, cluster_channels, cluster_sizes):
     """
     Tries to find clusters in the event:
     It uses the three-cut algorithm: 1) Apply seed cut
                                      2) Search for neighbouring channels above the SN_ratio
                                      3) Check if cluster has higher SN as specified
 
+    The results are written into the passed buffers (each of length numchan), so no memory
+    has to be allocated per event.
+
     :param event: The event: shape = (channels)
     :param SN: The SN: shape = (channels)
     :param noise: The noise: shape = (channels)
@@ -170,170 +299,185 @@ def nb_clustering(event, SN, noise, SN_cut, SN_ratio, SN_cluster, numchan, max_c
     :param max_clustersize: Maximum cluster size
     :param masking: Bool, if you want masking of channels with false polarity
     :param material: The base material of the sensor, needed for polarity check
-    :return:
+    :param used_channels: Buffer to keep track which channels have been used already
+    :param channels: Buffer for the channels above the SN cut
+    :param cluster_channels: Buffer for the channels of all clusters, one cluster after the other
+    :param cluster_sizes: Buffer for the sizes of the clusters
+    :return: number of hit channels, number of clusters, number of channels in clusters, automasked hits
 
     Written by Dominic Bloech
     """
 
     automasked_hit = 0
-    # To keep track which channel have been used already here ones due to valid channel calculations
-    used_channels = np.ones(numchan)
-    numclus = 0  # The number of found clusters
-    clusters_list = []
-    clustersize = []
-    strips = len(event)
-    absSN = np.abs(SN)
     # SN for neighbours of seed cut
     SNval = SN_cut * SN_ratio
     offset = int(max_clustersize * 0.5)
 
-    # Only channels which have a signal/Noise higher then the signal/Noise cut
-    channels = np.nonzero(np.abs(SN) > SN_cut)[0]
-
-    # Mask channels with the false polarity
-    if masking:
-        if material:
-            # So only negative values are considered aka. p-type sensors
-            masked_ind = np.nonzero(np.take(event, channels) > 0)[0]
-            valid_ind = np.nonzero(event < 0)[0]
-            automasked_hit += len(masked_ind)
+    # To keep track which channel have been used already here ones due to valid channel calculations
+    # Mask channels with the false polarity, so only negative values are considered aka. p-type sensors
+    # or only positive values aka. n-type sensors. If none is selected then all will be used
+    numhits = 0
+    for ch in range(numchan):
+        if masking:
+            if material:
+                used_channels[ch] = event[ch] >= 0
+            else:
+                used_channels[ch] = event[ch] <= 0
         else:
-            # So only positive values are considered aka. n-type sensors
-            masked_ind = np.nonzero(np.take(event, channels) < 0)[0]
-            valid_ind = np.nonzero(event > 0)[0]
-            automasked_hit += len(masked_ind)
-    else:
-        # If none is selected then all will be used
-        valid_ind = np.arange(strips)
+            used_channels[ch] = 0
 
-    # Set all channels in which we search for hits to 0 to make them valid
-    used_channels[valid_ind] = 0
-    # Update the hitted channels #TODO: delete the ones which are automasked, delte not working with numba
-    #channels = np.delete(channels, masked_ind) delete not supported by numba
+        # Only channels which have a signal/Noise higher then the signal/Noise cut
+        if abs(SN[ch]) > SN_cut:
+            channels[numhits] = ch
+            numhits += 1
+            if masking and ((material and event[ch] > 0) or (not material and event[ch] < 0)):
+                automasked_hit += 1
 
+    numclus = 0  # The number of found clusters
+    numclusch = 0  # The number of channels in all found clusters
     #Todo: misinterpretation of two very close clusters
-    for ch in channels:  # Loop over all left channels which are a hit, here from "left" to "right"
-            # Check if the channel has not been used so far
-            if not used_channels[ch]:
-                used_channels[ch] = 1  # Now the channel is used
-                cluster = [ch]  # Size we have no a cluster init it with the channel
-                size = 1 # The size of the cluster
-
-                # Now make a loop to find neighbouring hits of cluster, we must go into both directions
-                right_stop = 0
-                left_stop = 0
-                for i in range(1, offset+1):  # Search plus minus the channel found Todo: first entry useless
-                    # Define bounderis of the chip, so we do not count outside
-                    if 0 < ch-i and ch+i < numchan:
-                        chp = ch+i # Right side of channel
-                        chm = ch-i # Left side of channel
-
-                        # Look if the right neighbour is above the SN_ratio from the SN_cut
-                        if not right_stop:
-                            if absSN[chp] > SNval:
-                                if not used_channels[chp]:
-                                    cluster.append(chp)
-                                    used_channels[chp] = 1
-                                    size += 1
-                                else:
-                                    right_stop = 1
-                            else:
-                                right_stop = 1 # Prohibits search for to long clusters or already used channels
-
-                        # Look if the left neighbour is above the SN_ratio from the SN_cut
-                        if not left_stop:
-                            if absSN[chm] > SNval:
-                                if not used_channels[chm]:
-                                    cluster.append(chm)
-                                    used_channels[chm] = 1
-                                    size += 1
-                                else:
-                                    left_stop = 1
-                            else:
-                                left_stop = 1 # Prohibits search for to long clusters or already used channels
-
-                # Look if the cluster SN is big enough to be counted as clusters
-                Scluster = np.abs(np.sum(np.take(event, cluster))) # Signal
-                Ncluster = np.sqrt(np.abs(np.sum(np.take(noise, cluster)))) # Noise
-                SNcluster = np.divide(Scluster,Ncluster)  # Actual signal to noise of cluster
-                if SNcluster > SN_cluster:
-                    numclus = numclus+1
-                    clusters_list.append(cluster)
-                    clustersize.append(size)
-
-    return channels, clusters_list, numclus, np.array(clustersize), automasked_hit
-
-
-jit(nogil=gil, cache=True, nopython=True)
-def nb_noise_calc(events, pedestal, tot_noise=False):
+    for hit in range(numhits):  # Loop over all left channels which are a hit, here from "left" to "right"
+        ch = channels[hit]
+        # Check if the channel has not been used so far
+        if used_channels[ch]:
+            continue
+        used_channels[ch] = 1  # Now the channel is used
+        cluster_channels[numclusch] = ch  # Size we have no a cluster init it with the channel
+        size = 1 # The size of the cluster
+
+        # Now make a loop to find neighbouring hits of cluster, we must go into both directions
+        right_stop = False
+        left_stop = False
+        for i in range(1, offset+1):  # Search plus minus the channel found
+            # Define bounderis of the chip, so we do not count outside
+            if 0 < ch-i and ch+i < numchan:
+                chp = ch+i # Right side of channel
+                chm = ch-i # Left side of channel
+
+                # Look if the right neighbour is above the SN_ratio from the SN_cut
+                if not right_stop:
+                    if abs(SN[chp]) > SNval and not used_channels[chp]:
+                        cluster_channels[numclusch+size] = chp
+                        used_channels[chp] = 1
+                        size += 1
+                    else:
+                        right_stop = True # Prohibits search for to long clusters or already used channels
+
+                # Look if the left neighbour is above the SN_ratio from the SN_cut
+                if not left_stop:
+                    if abs(SN[chm]) > SNval and not used_channels[chm]:
+                        cluster_channels[numclusch+size] = chm
+                        used_channels[chm] = 1
+                        size += 1
+                    else:
+                        left_stop = True # Prohibits search for to long clusters or already used channels
+
+        # Look if the cluster SN is big enough to be counted as clusters
+        Scluster = 0. # Signal
+        Ncluster = 0. # Noise
+        for j in range(numclusch, numclusch+size):
+            Scluster += event[cluster_channels[j]]
+            Ncluster += noise[cluster_channels[j]]
+        SNcluster = abs(Scluster)/np.sqrt(abs(Ncluster))  # Actual signal to noise of cluster
+        if SNcluster > SN_cluster:
+            cluster_sizes[numclus] = size
+            numclus += 1
+            numclusch += size
+
+    return numhits, numclus, numclusch, automasked_hit
+
+@jit(nopython=True, cache=True, nogil=gil, parallel=parallel)
+def nb_clustering_all_events(signal, SN, noise, SN_cut, SN_ratio, SN_cluster, numchan, max_clustersize,
+                             masking, material, numblocks):
     """
-    Noise calculation, normal noise (NN) and common mode noise (CMN)
-    Uses numpy black magic
-    :param events: the events
-    :param pedestal: the pedestal
-    :param tot_noise: bool if you want the tot_noise
-    :return:
+    Clusters all events in parallel. The events are split into numblocks blocks, every block
+    is processed by one thread and has its own hitmap. The hitmaps are reduced in the end.
+    Since the number of clusters is not known beforehand, the events are clustered twice:
+    once for counting and once for filling the (flat) output arrays.
 
-    Written by Dominic Bloech
+    :param signal: The processed signal: shape = (events, channels)
+    :param SN: The SN: shape = (events, channels)
+    :param noise: The noise: shape = (channels)
+    :param SN_cut: float
+    :param SN_ratio: float
+    :param SN_cluster: float
+    :param numchan: Number of channels
+    :param max_clustersize: Maximum cluster size
+    :param masking: Bool, if you want masking of channels with false polarity
+    :param material: The base material of the sensor, needed for polarity check
+    :param numblocks: In how many blocks the events are split (usually the number of threads)
+    :return: hit_offset - hit channels of event i are hit_channel[hit_offset[i]:hit_offset[i+1]]
+             hit_channel - channels above the SN cut of all events
+             event_offset - clusters of event i are cluster_size[event_offset[i]:event_offset[i+1]]
+             cluster_size - size of all clusters
+             cluster_offset - channels of cluster j are cluster_channels[cluster_offset[j]:cluster_offset[j+1]]
+             cluster_channels - channels of all clusters
+             hitmap - hits per channel: shape = (channels)
+             automasked - automasked hits per event
     """
-    # Calculate the common mode noise for every channel
-    # Get the signal from event and subtract pedestal
-    cm = np.subtract(events, pedestal, dtype=np.float32)
-    # Calculate the common mode
-    keep = np.array(list(range(0,len(events))))
-    for i in range(3): # Go over 3 times to get even the less dominant outliers
-        CMsig = np.std(cm[keep], axis=1)
-        # Now calculate the mean from the cm to get the actual common mode noise
-        CMnoise = np.mean(cm[keep], axis=1)
-        # Find common mode which is lower/higher than 1 sigma
-        keep = np.where(np.logical_and(CMnoise<(CMnoise+2.5*CMsig), CMnoise>(CMnoise-2.5*CMsig)))[0]
-    # Calculate the noise of channels
-    # Subtract the common mode noise --> Signal[arraylike] - pedestal[arraylike] - Common mode
-    score = np.subtract(cm[keep], CMnoise[keep][:,None], dtype=np.float32)
-    # This is a trick with the dimensions of ndarrays, score = shape[ (x,y) - x,1 ]
-    # is possible otherwise a loop is the only way
-    noise = np.std(score, axis=0)
-    noiseNC = np.std(cm[keep], axis=0)
-    if tot_noise is False:
-        return noise, noiseNC, CMnoise, CMsig
-    # convert score matrix into an 1-d array --> np.concatenate(score, axis=0))
-    return noise, noiseNC, CMnoise, CMsig, np.concatenate(score, axis=0)
-
-#jit(nogil=gil, cache=True)
-#def nb_process_event(events, pedestal, meanCMN, meanCMsig, noise, numchan, noisy_strips):
-#    """Processes single events - This is an old version which has been replaces by"""
-#    #TODO: some elusive error happens here when using jit and njit
-#    # Calculate the common mode noise for every channel
-#    signal = events - pedestal  # Get the signal from event and subtract pedestal
-#
-#    signal[noisy_strips] = 0
-#
-#    # Remove channels which have a signal higher then 5*CMsig+CMN which are not representative
-#    removed = np.nonzero(signal < (5. * meanCMsig + meanCMN))
-#    prosignal = signal[removed]
-#
-#    if prosignal.any():
-#        cmpro = np.mean(prosignal)
-#        sigpro = np.std(prosignal)
-#
-#        corrsignal = signal - cmpro
-#        SN = corrsignal / noise
-#
-#        return corrsignal, SN, cmpro, sigpro
-#    else:
-#        return np.zeros(numchan), np.zeros(numchan), 0., 0.  # A default value return if everything fails
-
-jit(nogil=gil,cache=True, nopython=True, fastmath=Fast)
+    numevents = signal.shape[0]
+    numblocks = max(1, min(numblocks, numevents))
+    numhits = np.zeros(numevents, dtype=np.int64)
+    numclus = np.zeros(numevents, dtype=np.int64)
+    numclusch = np.zeros(numevents, dtype=np.int64)
+    automasked = np.zeros(numevents, dtype=np.int64)
+
+    # First pass: count hits, clusters and channels in clusters
+    for block in prange(numblocks):
+        used_channels = np.zeros(numchan, dtype=np.int8)
+        channels = np.zeros(numchan, dtype=np.int64)
+        cluster_channels = np.zeros(numchan, dtype=np.int64)
+        cluster_sizes = np.zeros(numchan, dtype=np.int64)
+        for i in range(block*numevents//numblocks, (block+1)*numevents//numblocks):
+            numhits[i], numclus[i], numclusch[i], automasked[i] = \
+                nb_clustering(signal[i], SN[i], noise, SN_cut, SN_ratio, SN_cluster, numchan,
+                              max_clustersize, masking, material, used_channels, channels,
+                              cluster_channels, cluster_sizes)
+
+    hit_offset = np.zeros(numevents+1, dtype=np.int64)
+    hit_offset[1:] = np.cumsum(numhits)
+    event_offset = np.zeros(numevents+1, dtype=np.int64)
+    event_offset[1:] = np.cumsum(numclus)
+    channel_offset = np.zeros(numevents+1, dtype=np.int64)
+    channel_offset[1:] = np.cumsum(numclusch)
+    hit_channel = np.zeros(hit_offset[-1], dtype=np.int64)
+    cluster_size = np.zeros(event_offset[-1], dtype=np.int64)
+    cluster_channels_all = np.zeros(channel_offset[-1], dtype=np.int64)
+    hitmaps = np.zeros((numblocks, numchan))
+
+    # Second pass: fill the output arrays and the hitmap of the block
+    for block in prange(numblocks):
+        used_channels = np.zeros(numchan, dtype=np.int8)
+        channels = np.zeros(numchan, dtype=np.int64)
+        cluster_channels = np.zeros(numchan, dtype=np.int64)
+        cluster_sizes = np.zeros(numchan, dtype=np.int64)
+        for i in range(block*numevents//numblocks, (block+1)*numevents//numblocks):
+            nb_clustering(signal[i], SN[i], noise, SN_cut, SN_ratio, SN_cluster, numchan,
+                          max_clustersize, masking, material, used_channels, channels,
+                          cluster_channels, cluster_sizes)
+            for j in range(numhits[i]):
+                hit_channel[hit_offset[i]+j] = channels[j]
+                hitmaps[block, channels[j]] += 1
+            for j in range(numclus[i]):
+                cluster_size[event_offset[i]+j] = cluster_sizes[j]
+            for j in range(numclusch[i]):
+                cluster_channels_all[channel_offset[i]+j] = cluster_channels[j]
+
+    cluster_offset = np.zeros(len(cluster_size)+1, dtype=np.int64)
+    cluster_offset[1:] = np.cumsum(cluster_size)
+    hitmap = np.zeros(numchan)
+    for block in range(numblocks):
+        hitmap += hitmaps[block]
+    return hit_offset, hit_channel, event_offset, cluster_size, cluster_offset, cluster_channels_all, \
+           hitmap, automasked
+
+@jit(nopython=True, cache=True, nogil=gil, parallel=parallel, error_model="numpy")
 def nb_preprocess_all_events(events, pedestal, meanCMN, meanCMsig, noise, numchan, noisy_strips):
     """
     Preprocesses all events and makes some clean-up on the signals.
     It calculates the SN for every events per channel and the CMN, CMNsig for every event.
     Furthermore it will return you the pure signal without pedestal, CMN etc.
-
-    Warning: This function uses numpy black magic, if you are confused how a calculate things here,
-             Please read a good introduction to numpy array operations =). But simply put I apply an
-             operation usually to a whole array divisions are such a things. Every value in both
-             arrays will be divided separately etc.
+    The events are processed in parallel.
 
     :param events: All events shape = (events, channels)
     :param pedestal: The pedestal: shape = (channels)
@@ -349,63 +493,34 @@ def nb_preprocess_all_events(events, pedestal, meanCMN, meanCMsig, noise, numcha
 
     Written by Dominic Bloech
     """
-    #Calculate the common mode noise for every channel
-    signal = events - pedestal  # Get the signal from event and subtract pedestal
-
-    # Remove channels which have a signal higher then 5*CMsig+CMN which are not representative
-    removed = np.nonzero(signal[:,] > (5. * meanCMsig + meanCMN))
-    signal[removed[0], removed[1]] = 0 # Set the signals to 0
-    prosignal = signal
-
-    if prosignal.any():
-        # Calculate the mean CMN and CMNsig
-        cmpro = np.mean(prosignal, axis=1)
-        sigpro = np.std(prosignal, axis=1)
+    numevents, numchan = events.shape
+    corrsignal = np.zeros((numevents, numchan))
+    SN = np.zeros((numevents, numchan))
+    cmpro = np.zeros(numevents)
+    sigpro = np.zeros(numevents)
+    # Channels which have a signal higher then 5*CMsig+CMN are not representative
+    threshold = 5. * meanCMsig + meanCMN
+
+    for i in prange(numevents):
+        # Get the signal from event and subtract pedestal, remove the not representative signals
+        signal = corrsignal[i]
+        for ch in range(numchan):
+            signal[ch] = events[i, ch] - pedestal[ch]
+            if signal[ch] > threshold:
+                signal[ch] = 0. # Set the signals to 0
+
+        # Calculate the CMN and CMNsig
+        cmpro[i] = np.mean(signal)
+        sigpro[i] = np.std(signal)
 
         # Subtract the CMN for all channels
-        corrsignal = signal - cmpro[:,None]
+        for ch in range(numchan):
+            signal[ch] -= cmpro[i]
         # Get rid of noisy strips by setting the signal to 0 which are not needed for further calculations
-        corrsignal[:, noisy_strips] = 0
+        for ch in noisy_strips:
+            signal[ch] = 0.
         # Calculate the actuall SN
-        SN = corrsignal / noise
-
-        return corrsignal, SN, cmpro, sigpro
-    else:
-        return np.zeros(numchan), np.zeros(numchan), 0., 0.  # A default value return if everything fails
-
+        for ch in range(numchan):
+            SN[i, ch] = signal[ch] / noise[ch]
 
-@jit(nopython=False, nogil=True, cache=True)
-def nb_process_cluster_size(args):
-    """get the events with the different clustersizes its the numba optimized version
-
-    Written by Dominic Bloech
-    """
-    size, valid_events_clustersize, valid_events_Signal, valid_events_clusters, noise, charge_cal, convert_ADC = args
-    ClusInd = [[], []]
-    for i, event in enumerate(valid_events_clustersize):
-             for j, clus in enumerate(event):
-                 if clus == size:
-                     ClusInd[0].extend([i])
-                     ClusInd[1].extend([j])
-
-    signal_clst_event = []
-    noise_clst_event = []
-    for i, ind in enumerate(ClusInd[0]):
-        y = ClusInd[1][i]
-        # Signal calculations
-        signal_clst_event.append(np.take(valid_events_Signal[ind], valid_events_clusters[ind][y]))
-        # Noise Calculations
-        noise_clst_event.append(
-            np.take(noise, valid_events_clusters[ind][y]))  # Get the Noise of an event
-
-    # totalE = np.sum(convert_ADC_to_e(signal_clst_event, charge_cal), axis=1)
-    totalE = np.sum(convert_ADC(signal_clst_event, charge_cal), axis=1)
-
-    # eError is a list containing electron signal noise
-    # totalNoise = np.sqrt(np.sum(convert_ADC_to_e(noise_clst_event, charge_cal),
-    #                             axis=1))
-    totalNoise = np.sqrt(np.sum(convert_ADC(noise_clst_event, charge_cal), axis=1))
-
-    preresults = {"signal": totalE, "noise": totalNoise}
-
-    return preresults
\ No newline at end of file
+    return corrsignal, SN, cmpro, sigpro
@@ -4,12 +4,16 @@ import logging
 from time import time
 import numpy as np
 from tqdm import tqdm
-from analysis_classes.nb_analysis_funcs import nb_noise_calc
 from analysis_classes.utilities import import_h5, read_binary_Alibava
+from analysis_classes.utilities import RunningMoments, HistogramAccumulator
 
 class NoiseAnalysis:
     """This class contains all calculations and data concerning pedestals in
 	ALIBAVA files"""
+
+    # Config keys the results depend on (for the StageCache)
+    CONFIG_KEYS = ("isBinary", "Noise_cut", "Chips", "numChan", "Manual_mask", "Noise_hist_bins")
+
     def __init__(self, path="", configs=None, logger=None):
         """
         :param path: Path to pedestal file
@@ -20,7 +24,7 @@ class NoiseAnalysis:
         if not configs["isBinary"]:
             self.data = import_h5(path)
         else:
-            self.data = read_binary_Alibava(path)
+            self.data = read_binary_Alibava(path, lazy=True)
 
         if self.data:
             # Some of the declaration may seem unecessary but it clears things
@@ -39,25 +43,24 @@ class NoiseAnalysis:
             self.max_channels = configs.get("numChan", 256)
             self.mask = configs.get("Manual_mask", [])
             self.goodevents = np.nonzero(self.data["events"]["time"][:] >= 0)
-            self.CMnoise = np.zeros(self.numchan, dtype=np.float32)
-            self.CMnoise_raw = np.zeros(self.numchan, dtype=np.float32)
-            self.CMsig = np.zeros(self.numchan, dtype=np.float32)
-            self.CMsig_raw = np.zeros(self.numchan, dtype=np.float32)
-            self.score = np.zeros((len(self.goodevents[0]), self.numchan),
-                                  dtype=np.float32)
+            self.chunk_size = int(configs.get("chunk_size", 0) or self.numevents) or 1
+            self.noise_hist_bins = configs.get("Noise_hist_bins", 500)
             self.median_noise = None
 
             # Calculate pedestal
             self.log.info("Calculating pedestal and Noise...")
-            # mean signal per channel over all events
-            self.pedestal = np.mean(self.data["events"]["signal"][0:], axis=0)
-            # complete signal matrix (event vs. channel)
-            self.signal = np.array(self.data["events"]["signal"][:], dtype=np.float32)
-
+            # First pass: pedestal (mean signal per channel over all events) and the
+            # covariance of all channels. The covariance is all we need to get the
+            # noise with and without common mode correction for any set of channels
+            moments = RunningMoments(self.numchan)
+            for chunk in self.iter_chunks():
+                moments.update(chunk)
+            self.pedestal = moments.mean
+            covariance = moments.covariance
 
             # First Noise calculation without masking to get an idea of the data
-            self.noise_raw, self.noiseNCM_raw, self.CMnoise_raw, self.CMsig_raw = \
-                    nb_noise_calc(self.signal, self.pedestal)
+            self.noiseNCM_raw = moments.std.astype(np.float32)
+            self.noise_raw = self.cm_corrected_noise(covariance, np.arange(self.numchan))
             self.noisy_strips, self.good_strips = \
                         self.detect_noisy_strips(self.noise_raw, self.noise_cut)
             # Mask chips of alibava
@@ -66,28 +69,67 @@ class NoiseAnalysis:
             # Redefine good strips and noisy strips
             self.good_strips = np.intersect1d(self.chip_selection, self.good_strips)
             self.noisy_strips = np.append(self.noisy_strips,self.masked_channels)
-            noise_corr, noiseNCM_corr, self.CMnoise, self.CMsig, self.total_noise = \
-                        nb_noise_calc(self.signal[:, self.good_strips],
-                                      self.pedestal[self.good_strips], True)
-
-            # self.noise is only the non masked strips long. Make it to the full 256 strips long array so we can use it
-            # Insert the correct noise for the masked strips and for all else insert np.nan --> This way it raises an error
-            # if someone tries to access and claculate with it
-            it = 0
-            for i in range(self.numchan):
-                if i in self.good_strips: # If its a good strip then add it and increase the it for tracking
-                    self.noise[i] = noise_corr[it]
-                    self.noiseNCM[i] = noiseNCM_corr[it]
-                    it += 1
-                else:
-                    self.noise[i] = np.nan
-                    self.noiseNCM[i] = np.nan
 
+            # self.noise is only calculated for the non masked strips. For all masked strips insert np.nan
+            # --> This way it raises an error if someone tries to access and claculate with it
+            self.noise = np.full(self.numchan, np.nan, dtype=np.float32)
+            self.noiseNCM = np.full(self.numchan, np.nan, dtype=np.float32)
+            self.noise[self.good_strips] = self.cm_corrected_noise(covariance, self.good_strips)
+            self.noiseNCM[self.good_strips] = self.noiseNCM_raw[self.good_strips]
 
+            # Second pass: common mode of every event (over all and over the good strips only)
+            # and the histogram of the common mode corrected signals of the good strips
+            self.CMnoise_raw, self.CMsig_raw, self.CMnoise, self.CMsig, self.total_noise = \
+                    self.common_mode_calc(self.good_strips)
 
         else:
             self.log.warning("No valid file, skipping pedestal run")
 
+    def __getstate__(self):
+        # The open file can not be stored, all results are calculated at this point
+        state = self.__dict__.copy()
+        state["data"] = None
+        return state
+
+    def iter_chunks(self):
+        """Reads the signals of the pedestal file chunk wise"""
+        signal = self.data["events"]["signal"]
+        for start in range(0, self.numevents, self.chunk_size):
+            yield np.array(signal[start:start+self.chunk_size], dtype=np.float32)
+
+    def cm_corrected_noise(self, covariance, channels):
+        """Calculates the noise of the channels after the common mode (mean over channels)
+        of every event has been subtracted, directly from the covariance matrix:
+        var(x_i - cm) = cov_ii - 2*mean_j(cov_ij) + mean_jk(cov_jk) with j, k in channels
+        :param covariance: Covariance matrix of the signals of all channels
+        :param channels: The channels the common mode is calculated from
+        :return: noise of the passed channels
+        """
+        cov = covariance[np.ix_(channels, channels)]
+        var = np.diag(cov) - 2*np.mean(cov, axis=1) + np.mean(cov)
+        return np.sqrt(np.clip(var, 0, None)).astype(np.float32)
+
+    def common_mode_calc(self, good_strips):
+        """Calculates the common mode and its std for every event, once over all channels and once
+        over the good strips only. Furthermore the common mode corrected signals of the good strips
+        are filled into a histogram (total noise)
+        :param good_strips: The good strips
+        :return: CMnoise_raw, CMsig_raw, CMnoise, CMsig, total noise HistogramAccumulator
+        """
+        width = 10*max(np.max(self.noise[good_strips]), 1.) if len(good_strips) else 10.
+        total_noise = HistogramAccumulator(self.noise_hist_bins, (-width, width))
+        CMnoise_raw, CMsig_raw, CMnoise, CMsig = [], [], [], []
+        for chunk in self.iter_chunks():
+            cm = np.subtract(chunk, self.pedestal, dtype=np.float32)
+            CMnoise_raw.append(np.mean(cm, axis=1))
+            CMsig_raw.append(np.std(cm, axis=1))
+            cm = cm[:, good_strips]
+            CMnoise.append(np.mean(cm, axis=1))
+            CMsig.append(np.std(cm, axis=1))
+            total_noise.fill(cm - CMnoise[-1][:, None])
+        return np.concatenate(CMnoise_raw), np.concatenate(CMsig_raw), \
+               np.concatenate(CMnoise), np.concatenate(CMsig), total_noise
+
     def mask_alibava_chips(self, chips_to_keep=(1,2), max_channels = 256):
         """Defines which chips should be considered"""
         final_channels = np.array([], dtype=np.int)
@@ -0,0 +1,174 @@
+"""This file contains the scheduler for the additional analysis plugins"""
+#pylint: disable=C0103,R0902
+import logging
+import threading
+import traceback
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from time import time
+from .utilities import load_plugins
+
+
+class PluginScheduler:
+    """PluginScheduler runs the additional analysis plugins in the order of their dependencies.
+
+    Every plugin declares the results it reads in the class attribute INPUTS (default ("base",)), these
+    are either "base" or the names of other plugins. The results of a plugin are stored under its name. From
+    this the scheduler builds a dependency graph: A plugin is started as soon as all its inputs are there, so
+    independent plugins (e.g. Langau and ChargeSharing) run at the same time in threads (the heavy parts are
+    numpy, numba and the fit pool, which do not hold the GIL). Plugins which are needed by others but are
+    not in the config are added.
+
+    The plugins get a read only view of the results (see MainAnalysis.results_view), no copies.
+    Plugins which only read the base results can fill their results while the events are clustered, see
+    accumulators.
+    For every plugin the runtime and the peak memory it allocated (traced with tracemalloc, numpy arrays
+    included) are recorded in the stats. The traced memory is the one of the whole process, so if plugins run
+    at the same time the peak of a plugin contains the allocations of the others running next to it.
+    If a plugin fails, the error is logged and the plugins depending on it are skipped.
+    """
+
+    def __init__(self, main_analysis, configs, threads=0, logger=None):
+        """
+        :param main_analysis: The main analysis, the results are stored in its outputdata
+        :param configs: The configs, containing the plugin names (additional_analysis) and their parameters
+        :param threads: Number of plugins which may run at the same time (0 = all)
+        :param logger: A specific logger if you want
+        """
+        self.log = logger or logging.getLogger(__class__.__name__)
+        self.main = main_analysis
+        self.configs = configs
+        self.plugins = self.resolve(load_plugins(configs.get("additional_analysis", []) or []))
+        self.threads = int(threads) or max(len(self.plugins), 1)
+        self.stats = {}
+        self.memory = {}
+        self.lock = threading.Lock()
+        self.instances = {}  # Plugins which are created before the base analysis
+
+    @staticmethod
+    def inputs(plugin):
+        """Returns the results a plugin reads"""
+        return tuple(getattr(plugin, "INPUTS", ("base",)))
+
+    def resolve(self, plugins):
+        """Adds the plugins other plugins depend on and checks the graph for cycles
+
+        :param plugins: dict of name: plugin class
+        :return: dict of name: plugin class, in an order in which they could run one after another
+        """
+        for name in [name for name, plugin in plugins.items() if plugin is None]:
+            self.log.error("The analysis %s could not be loaded, skipping it", name)
+            del plugins[name]
+        missing = [name for plugin in plugins.values() for name in self.inputs(plugin)
+                   if name != "base" and name not in plugins]
+        while missing:
+            name = missing.pop()
+            if name in plugins:
+                continue
+            plugin = load_plugins([name]).get(name)
+            if plugin is None:
+                raise ValueError("The analysis {} is needed by another analysis, but does not exist".format(name))
+            self.log.info("Adding the analysis %s, other analyses depend on it", name)
+            plugins[name] = plugin
+            missing.extend(dep for dep in self.inputs(plugin) if dep != "base" and dep not in plugins)
+
+        ordered, done = {}, {"base"}
+        while len(ordered) < len(plugins):
+            ready = [name for name, plugin in plugins.items()
+                     if name not in ordered and set(self.inputs(plugin)) <= done]
+            if not ready:
+                raise ValueError("The analyses {} depend on each other".format(
+                    ", ".join(name for name in plugins if name not in ordered)))
+            for name in ready:
+                ordered[name] = plugins[name]
+                done.add(name)
+        return ordered
+
+    def accumulators(self):
+        """Creates the plugins which fill their results while the base analysis clusters the events, these
+        plugins have a static method accumulates(configs) and a method fill, which gets the cluster table of
+        every chunk (see BaseAnalysis.process_chunk). The same instances are run afterwards.
+
+        :return: list of the plugins
+        """
+        for name, plugin in self.plugins.items():
+            configs = self.configs.get(name, {})
+            if self.inputs(plugin) == ("base",) and hasattr(plugin, "accumulates") and plugin.accumulates(configs):
+                self.instances[name] = plugin(self.main, configs)
+        return list(self.instances.values())
+
+    def run(self, callback=None):
+        """Runs all plugins and stores their results in the outputdata of the main analysis
+
+        :param callback: Function which is called (in this thread) with the name and the results of every
+                         plugin as soon as it is finished
+        :return: The stats (runtime, peak memory and status) of every plugin
+        """
+        self.stats = {}
+        self.memory = {}
+        tracing = tracemalloc.is_tracing()
+        if not tracing:
+            tracemalloc.start()
+        waiting = dict(self.plugins)
+        running = {}
+        with ThreadPoolExecutor(max_workers=self.threads) as executor:
+            while waiting or running:
+                for name, plugin in list(waiting.items()):
+                    inputs = set(self.inputs(plugin)) - {"base"}
+                    if any(self.stats.get(dep, {}).get("status") in ("failed", "skipped") for dep in inputs):
+                        self.log.error("Skipping the analysis %s, a analysis it depends on failed", name)
+                        self.stats[name] = {"status": "skipped", "runtime": 0., "memory": 0}
+                        del waiting[name]
+                    elif all(dep in self.main.outputdata for dep in inputs) and len(running) < self.threads:
+                        running[executor.submit(self.run_plugin, name, plugin)] = name
+                        del waiting[name]
+                if not running:
+                    continue
+                finished, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    name = running.pop(future)
+                    self.stats[name] = future.result()
+                    if callback is not None and self.stats[name]["status"] == "done":
+                        callback(name, self.main.outputdata[name])
+        if not tracing:
+            tracemalloc.stop()
+        return self.stats
+
+    def track_memory(self, started=None, finished=None):
+        """Updates the memory peaks of the running plugins, is called when a plugin starts or finishes
+
+        :param started: Name of the plugin which starts now
+        :param finished: Name of the plugin which is finished now
+        :return: The peak memory the finished plugin allocated in bytes
+        """
+        with self.lock:
+            current, peak = tracemalloc.get_traced_memory()
+            for memory in self.memory.values():
+                memory["peak"] = max(memory["peak"], peak)
+            # Without reset_peak (python < 3.9) the peak is the one since the start of the tracing
+            if hasattr(tracemalloc, "reset_peak"):
+                tracemalloc.reset_peak()
+            if started is not None:
+                self.memory[started] = {"start": current, "peak": current}
+            if finished is not None:
+                memory = self.memory.pop(finished)
+                return max(memory["peak"] - memory["start"], 0)
+        return 0
+
+    def run_plugin(self, name, plugin):
+        """Runs one plugin and stores its results, returns the stats of the plugin"""
+        self.log.info("Starting analysis: {}".format(name))
+        self.track_memory(started=name)
+        start = time()
+        try:
+            instance = self.instances.pop(name, None) or plugin(self.main, self.configs.get(name, {}))
+            results = instance.run()
+        except Exception:
+            self.log.error("The analysis %s failed:\n%s", name, traceback.format_exc())
+            return {"status": "failed", "runtime": time()-start, "memory": self.track_memory(finished=name)}
+        runtime = time()-start
+        self.main.outputdata[name] = results
+        stats = {"status": "done", "runtime": runtime, "memory": self.track_memory(finished=name)}
+        self.log.info("Analysis %s took %.2f s, its peak memory was %.1f MB", name, stats["runtime"],
+                      stats["memory"]/1e6)
+        return stats
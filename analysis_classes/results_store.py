@@ -0,0 +1,244 @@
+"""This file contains the HDF5 store for the results of the analysis"""
+#pylint: disable=C0103,R0902
+import logging
+import os
+from collections.abc import Mapping
+import numpy as np
+import h5py
+from .utilities import Bdata, HistogramAccumulator
+
+# Arrays with less elements are stored contiguous, chunking and compression do not pay off for them
+MIN_COMPRESSED_SIZE = 1024
+
+# Attributes of the pedestal and calibration objects which are not stored (file handles, configs, loggers)
+SKIPPED_ATTRIBUTES = ("data", "charge_data", "delay_data", "configs", "log")
+
+
+class HDF5ResultsWriter:
+    """Writes the results of the analysis to a HDF5 file, every stage as soon as it is finished.
+
+    Every result dict is a group, numpy arrays (the cluster table, histograms, fit coefficients, ...)
+    are datasets. Large arrays are chunked and compressed (compression = "gzip", "lzf" or None). Without
+    compression large arrays are stored contiguous, so the loader can memory map them.
+    Bdata objects, histograms (HistogramAccumulator), lists, tuples, strings, scalars and None are stored as
+    well and are restored by HDF5Results, other objects are skipped.
+    """
+
+    def __init__(self, filepath, compression="gzip", logger=None):
+        """
+        :param filepath: Path to the HDF5 file, an existing file is overwritten
+        :param compression: Compression of the large arrays ("gzip", "lzf" or None)
+        :param logger: A specific logger if you want
+        """
+        self.log = logger or logging.getLogger(__class__.__name__)
+        self.filepath = os.path.normpath(filepath)
+        if str(compression).lower() in ("none", "false", ""):
+            compression = None
+        self.compression = compression
+        self.file = h5py.File(self.filepath, "w")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        """Closes the file"""
+        if self.file:
+            self.file.close()
+            self.file = None
+
+    def write(self, name, obj):
+        """Writes the results of a stage, existing results with the same name are replaced
+
+        :param name: Name of the stage (e.g. "base", "Langau")
+        :param obj: The results
+        """
+        if name in self.file:
+            del self.file[name]
+        self._write(self.file, str(name), obj)
+        self.file.flush()
+
+    def write_object(self, name, obj):
+        """Writes the state (all attributes which can be stored) of an object, e.g. the NoiseAnalysis"""
+        self.write(name, {key: value for key, value in vars(obj).items() if key not in SKIPPED_ATTRIBUTES})
+
+    def _write(self, parent, name, obj):
+        """Writes obj with the name into the parent group"""
+        if isinstance(obj, Bdata):
+            group = parent.create_group(name)
+            group.attrs["__type__"] = "Bdata"
+            for key, column in obj.data.items():
+                self._write(group, key, column)
+        elif isinstance(obj, HistogramAccumulator):
+            group = parent.create_group(name)
+            group.attrs["__type__"] = "HistogramAccumulator"
+            group.attrs["range"] = obj.range
+            self._write(group, "counts", obj.counts)
+            self._write(group, "sums", obj.sums)
+        elif isinstance(obj, Mapping):
+            group = parent.create_group(name)
+            group.attrs["__type__"] = "dict"
+            for key, value in obj.items():
+                self._write(group, str(key), value)
+        elif isinstance(obj, (list, tuple)):
+            array = np.asarray(obj) if obj and all(np.isscalar(item) for item in obj) else None
+            if array is not None and array.dtype.kind in "biuf":
+                self._write_array(parent, name, array).attrs["__type__"] = type(obj).__name__
+            else:
+                group = parent.create_group(name)
+                group.attrs["__type__"] = type(obj).__name__
+                group.attrs["length"] = len(obj)
+                for i, item in enumerate(obj):
+                    self._write(group, str(i), item)
+        elif obj is None:
+            parent.create_group(name).attrs["__type__"] = "None"
+        elif isinstance(obj, str):
+            parent.create_dataset(name, data=obj).attrs["__type__"] = "str"
+        elif isinstance(obj, (bool, int, float, np.generic)):
+            dataset = parent.create_dataset(name, data=obj)
+            dataset.attrs["__type__"] = "scalar" if isinstance(obj, (bool, int, float)) else "array"
+        elif isinstance(obj, np.ndarray) and obj.dtype.kind in "biufcV":
+            self._write_array(parent, name, obj).attrs["__type__"] = "array"
+        else:
+            self.log.debug("Results %s of type %s can not be stored in HDF5, skipping it", name, type(obj).__name__)
+
+    def _write_array(self, parent, name, array):
+        """Writes a numpy array as dataset, large arrays are chunked and compressed"""
+        array = np.ascontiguousarray(array)
+        if array.size >= MIN_COMPRESSED_SIZE and self.compression:
+            # The fastest gzip level, the higher levels take several times longer for a few percent
+            options = 1 if self.compression == "gzip" else None
+            return parent.create_dataset(name, data=array, chunks=True, compression=self.compression,
+                                         compression_opts=options, shuffle=True)
+        return parent.create_dataset(name, data=array)
+
+
+class HDF5Results(Mapping):
+    """Read access to a results file written by HDF5ResultsWriter.
+
+    The results are read lazily: Groups are only opened, arrays are only read when they are accessed (and then
+    kept). Arrays which are stored contiguous and uncompressed are memory mapped instead of being read.
+    Bdata objects, histograms, lists and so on are restored as they were written.
+    """
+
+    def __init__(self, group, memory_map=True):
+        """
+        :param group: The h5py group (or file) of the results
+        :param memory_map: Memory map contiguous arrays instead of reading them
+        """
+        self.group = group
+        self.memory_map = memory_map
+        self.cache = {}
+
+    def __getitem__(self, key):
+        if key not in self.cache:
+            self.cache[key] = load_hdf5_item(self.group[key], self.memory_map)
+        return self.cache[key]
+
+    def __iter__(self):
+        return iter(self.group.keys())
+
+    def __len__(self):
+        return len(self.group)
+
+    def __repr__(self):
+        return "HDF5Results({}: {})".format(self.group.name, ", ".join(self.group.keys()))
+
+    def close(self):
+        """Closes the file of the results"""
+        self.group.file.close()
+
+
+class LazyColumns(Mapping):
+    """The columns of a stored Bdata object, a column is read (or memory mapped) when it is accessed"""
+
+    def __init__(self, group, memory_map=True):
+        self.group = group
+        self.memory_map = memory_map
+        self.columns = {}
+
+    def __getitem__(self, key):
+        if key not in self.columns:
+            self.columns[key] = read_dataset(self.group[key], self.memory_map)
+        return self.columns[key]
+
+    def __iter__(self):
+        return iter(self.group.keys())
+
+    def __len__(self):
+        return len(self.group)
+
+
+def read_dataset(dataset, memory_map=True):
+    """Reads a dataset as read only array, contiguous uncompressed arrays are memory mapped"""
+    if memory_map and dataset.shape and dataset.size and dataset.chunks is None:
+        offset = dataset.id.get_offset()
+        if offset is not None:
+            return np.memmap(dataset.file.filename, dtype=dataset.dtype, mode="r",
+                             offset=offset, shape=dataset.shape)
+    array = dataset[()]
+    if isinstance(array, np.ndarray):
+        array.setflags(write=False)
+    return array
+
+def load_hdf5_item(item, memory_map=True):
+    """Restores an item (dataset or group) of a results file"""
+    kind = item.attrs.get("__type__", "dict" if isinstance(item, h5py.Group) else "array")
+    if isinstance(item, h5py.Dataset):
+        if kind == "str":
+            return item.asstr()[()]
+        if kind == "scalar":
+            return item[()].item()
+        value = read_dataset(item, memory_map)
+        if kind == "list":
+            return value.tolist()
+        if kind == "tuple":
+            return tuple(value.tolist())
+        return value
+    if kind == "None":
+        return None
+    if kind == "Bdata":
+        return Bdata(LazyColumns(item, memory_map))
+    if kind == "HistogramAccumulator":
+        histogram = HistogramAccumulator(len(item["counts"]), item.attrs["range"])
+        histogram.counts = item["counts"][()]
+        histogram.sums = item["sums"][()]
+        return histogram
+    if kind in ("list", "tuple"):
+        items = [load_hdf5_item(item[str(i)], memory_map) for i in range(item.attrs["length"])]
+        return items if kind == "list" else tuple(items)
+    return HDF5Results(item, memory_map)
+
+def restore_object(cls, results):
+    """
+    Restores an object (e.g. the NoiseAnalysis) from the state written by HDF5ResultsWriter.write_object,
+    without calling its __init__ (so no files are read and nothing is calculated again)
+
+    :param cls: The class of the object
+    :param results: The stored state (HDF5Results)
+    :return: The object
+    """
+    obj = cls.__new__(cls)
+    obj.__dict__.update({attribute: None for attribute in SKIPPED_ATTRIBUTES})
+    obj.__dict__.update({key: results[key] for key in results})
+    obj.configs = {}
+    obj.log = logging.getLogger(cls.__name__)
+    return obj
+
+def save_dict_as_hdf5(data, dirr, base_name, compression="gzip"):
+    """Saves a results dict to the HDF5 file base_name.hdf5 in the folder dirr"""
+    with HDF5ResultsWriter(os.path.join(os.path.normpath(dirr), "{}.hdf5".format(base_name)), compression) as writer:
+        for name, value in data.items():
+            writer.write(name, value)
+
+def load_hdf5_results(filepath, memory_map=True):
+    """
+    Opens a results file written by HDF5ResultsWriter
+
+    :param filepath: Path to the HDF5 file
+    :param memory_map: Memory map contiguous uncompressed arrays instead of reading them
+    :return: HDF5Results, a read only dict like object of all results
+    """
+    return HDF5Results(h5py.File(os.path.normpath(filepath), "r"), memory_map)
@@ -17,6 +17,8 @@ import matplotlib.pyplot as plt
 from matplotlib.backends.backend_pdf import PdfPages
 import scipy.integrate as integrate
 import json
+import hashlib
+from collections.abc import Mapping
 from copy import deepcopy
 
 def read_meas_files(cfg):
@@ -129,9 +131,223 @@ def get_xy_data(data, header=0):
             np2Darray[i-header] = np.array(list_data)
     return np2Darray
 
-#@jit(nopython=False)
-def read_binary_Alibava(filepath):
-    """Reads binary alibava files"""
+# Both byte orders of the 0xcafe0002 data block marker are accepted
+ALIBAVA_BLOCK_MARKERS = (b'\x02\x00\xfe\xca', b'\xca\xfe\x00\x02')
+# Minimum size of the payload of a data block, everything after is ignored
+ALIBAVA_MIN_BLOCKSIZE = 594
+
+def alibava_block_dtype(blocksize=ALIBAVA_MIN_BLOCKSIZE, block_header=True):
+    """
+    Returns the numpy structured dtype describing one data block of an ALiBaVa
+    binary file. The payload of a block is laid out as:
+
+        [0:12]    3 x uint32, the last one is the clock
+        [12:16]   uint32 coded time
+        [16:18]   uint16 temperature
+        [18:50]   garbage/padding
+        [50:306]  128 x int16 signal of chip 1
+        [306:338] garbage/padding
+        [338:594] 128 x int16 signal of chip 2
+
+    :param blocksize: The size of the block payload in bytes
+    :param block_header: If True the 0xcafe0002 marker and the blocksize (2 x uint32)
+                         preceding every payload are part of the dtype
+    :return: numpy.dtype
+    """
+    shift = 8 if block_header else 0
+    names = ["clock", "coded_time", "temperature", "chip1", "chip2"]
+    formats = ["<u4", "<u4", "<u2", ("<i2", 128), ("<i2", 128)]
+    offsets = [shift+8, shift+12, shift+16, shift+50, shift+338]
+    if block_header:
+        names = ["marker", "blocksize"] + names
+        formats = ["<u4", "<u4"] + formats
+        offsets = [0, 4] + offsets
+    return np.dtype({"names": names, "formats": formats,
+                     "offsets": offsets, "itemsize": shift+blocksize})
+
+def _uniform_alibava_blocks(raw):
+    """Tries to interpret the data part of an ALiBaVa binary file as a
+    contiguous sequence of equally sized data blocks. Returns the structured
+    array (a view on raw) or None if the file does not look like that."""
+    if len(raw) < 8 or raw[0:4].tobytes() not in ALIBAVA_BLOCK_MARKERS:
+        return None
+    blocksize = int(raw[4:8].view("<u4")[0])
+    if blocksize < ALIBAVA_MIN_BLOCKSIZE or len(raw) % (blocksize+8):
+        return None
+    blocks = raw.view(alibava_block_dtype(blocksize))
+    markers = [np.frombuffer(m, dtype="<u4")[0] for m in ALIBAVA_BLOCK_MARKERS]
+    if not np.all(np.isin(blocks["marker"], markers)) or np.any(blocks["blocksize"] != blocksize):
+        return None
+    return blocks
+
+def alibava_block_offsets(raw):
+    """
+    Scans the data part of an ALiBaVa binary file block by block and returns the
+    offsets of the payload of every valid data block. If a block header is not
+    the 0xcafe0002 marker, the scan resynchronizes by advancing 4 bytes until
+    the next marker is found.
+
+    :param raw: The data part of the file as uint8 array
+    :return: np.array of payload offsets (int64)
+    """
+    offsets = []
+    pos = 0
+    size = len(raw)
+    while pos + 4 <= size:
+        blockheader = raw[pos:pos+4].tobytes()  # should be 0xcafe002
+        if blockheader in ALIBAVA_BLOCK_MARKERS and pos + 8 <= size:
+            blocksize = int(raw[pos+4:pos+8].view("<u4")[0])
+            if pos + 8 + blocksize > size:
+                LOG.info("Warning: Data block {} is truncated and will be "
+                         "skipped".format(len(offsets)))
+                break
+            if blocksize >= ALIBAVA_MIN_BLOCKSIZE:
+                offsets.append(pos+8)
+            else:
+                LOG.info("Warning: Data block {} is too small ({} bytes) "
+                         "and will be skipped".format(len(offsets), blocksize))
+            pos += 8 + blocksize
+        else:
+            LOG.info("Warning: While reading data Block {}. "
+                     "Header was not the 0xcafe0002 it was {!s}"\
+                     .format(len(offsets), str(blockheader)))
+            pos += 4
+    LOG.info("Persumably end of binary file reached. "
+             "Events read: {}".format(len(offsets)))
+    return np.array(offsets, dtype=np.int64)
+
+def gather_alibava_blocks(raw, offsets, chunksize=10000):
+    """Gathers the payloads at the passed offsets into one structured array
+    (without block headers). Done in chunks, to keep the index arrays small."""
+    dtype = alibava_block_dtype(ALIBAVA_MIN_BLOCKSIZE, block_header=False)
+    blocks = np.zeros(len(offsets), dtype=dtype)
+    payload = np.arange(ALIBAVA_MIN_BLOCKSIZE)
+    for start in range(0, len(offsets), chunksize):
+        ind = offsets[start:start+chunksize, None] + payload
+        blocks[start:start+chunksize] = np.ascontiguousarray(raw[ind]).view(dtype)[:, 0]
+    return blocks
+
+ALIBAVA_EVENT_FIELDS = {"signal": ((256,), np.float32),
+                         "time": ((), np.float32),
+                         "clock": ((), np.float32),
+                         "temperature": ((), np.float32)}
+
+def decode_alibava_field(blocks, field):
+    """
+    Decodes one event quantity from a structured array of ALiBaVa data blocks
+    (see alibava_block_dtype).
+
+    :param blocks: structured array of data blocks
+    :param field: One of signal, time, clock or temperature
+    :return: np.array, signal has the shape (events, 256)
+    """
+    if field == "signal":
+        signal = np.empty((len(blocks), 256), dtype=np.float32)
+        signal[:, :128] = blocks["chip1"]
+        signal[:, 128:] = blocks["chip2"]
+        return signal
+    if field == "time":
+        coded_time = blocks["coded_time"].astype(np.int64)
+        ipart = (coded_time & 0xFFFF0000) >> 16
+        fpart = np.sign(ipart)*(coded_time & 0xFFFF)
+        return (100*ipart+fpart).astype(np.float32)
+    if field == "clock":
+        return blocks["clock"].astype(np.float32)
+    if field == "temperature":
+        return (0.12*blocks["temperature"]-39.8).astype(np.float32)
+    raise KeyError("Unknown ALiBaVa event field: {}".format(field))
+
+def decode_alibava_blocks(blocks):
+    """
+    Decodes a structured array of ALiBaVa data blocks (see alibava_block_dtype)
+    into the event quantities.
+
+    :param blocks: structured array of data blocks
+    :return: dict with signal (events, 256), time, clock and temperature
+    """
+    return {field: decode_alibava_field(blocks, field) for field in ALIBAVA_EVENT_FIELDS}
+
+class AlibavaBlocks:
+    """Memory-mapped access to the data blocks of an ALiBaVa binary file.
+
+    If all blocks have the same size the file is mapped as an array of the
+    block dtype directly, otherwise a block offset table is built once and the
+    payloads are gathered from a byte map on access. Either way only the blocks
+    which are accessed are decoded.
+
+    The marker and size of every block header are checked once when the file is
+    opened, so corrupt blocks are skipped in the same way as by the eager reader."""
+
+    def __init__(self, filepath, data_start):
+        self.filepath = os.path.normpath(filepath)
+        self.offsets = None
+        self.raw = np.memmap(self.filepath, dtype=np.uint8, mode="r", offset=data_start)
+        # Checks all block headers (strided, only 8 bytes of every block are compared)
+        self.blocks = _uniform_alibava_blocks(self.raw)
+        if self.blocks is None:
+            LOG.info("Data blocks of binary file are not uniform, building block offset table...")
+            self.offsets = alibava_block_offsets(self.raw)
+
+    def __len__(self):
+        if self.blocks is None:
+            return len(self.offsets)
+        return len(self.blocks)
+
+    def __getitem__(self, rows):
+        """Returns the structured array of the data blocks selected by rows"""
+        if self.blocks is None:
+            return gather_alibava_blocks(self.raw, self.offsets[rows])
+        return self.blocks[rows]
+
+class AlibavaEventDataset:
+    """Lazy view on one event quantity (signal, time, clock or temperature)
+    of an ALiBaVa binary file. Behaves like a (read only) h5py dataset, the
+    blocks are only decoded when sliced, e.g. data["events"]["signal"][0:100]."""
+
+    def __init__(self, blocks, field):
+        self.blocks = blocks
+        self.field = field
+        shape, self.dtype = ALIBAVA_EVENT_FIELDS[field]
+        self.shape = (len(blocks),) + shape
+        self.ndim = len(self.shape)
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, key):
+        rows, rest = (key[0], key[1:]) if isinstance(key, tuple) else (key, ())
+        if isinstance(rows, (int, np.integer)):
+            # Keep the row axis while decoding and drop it afterwards
+            rows = slice(rows, rows+1 if rows != -1 else None)
+            rest = (0,) + rest
+        else:
+            rest = (slice(None),) + rest
+        data = decode_alibava_field(self.blocks[rows], self.field)
+        return data[rest]
+
+    def __array__(self, dtype=None, copy=None):
+        data = self[:]
+        return data if dtype is None else data.astype(dtype)
+
+    def __repr__(self):
+        return "<ALiBaVa binary dataset \"{}\": shape {}, type {}>".format(
+            self.field, self.shape, np.dtype(self.dtype))
+
+def read_binary_Alibava(filepath, lazy=False):
+    """Reads binary alibava files.
+
+    The data blocks are decoded in one go by interpreting the file as an array
+    of numpy structured dtypes (see alibava_block_dtype). Only if the file
+    contains corrupt blocks or blocks of different size, the blocks are located
+    block-by-block with resynchronization on the 0xcafe0002 marker.
+
+    :param filepath: Path to the binary file
+    :param lazy: If True the file is memory mapped and the event quantities
+                 are returned as AlibavaEventDataset objects, which only decode
+                 the events which are sliced. Otherwise all events are decoded
+                 into numpy arrays.
+    :return: dict with the same structure as an ALiBaVa hdf5 file
+    """
     with open(os.path.normpath(filepath), "rb") as f:
         header = f.read(16)
         Starttime = struct.unpack("II", header[0:8])[0]  # Is a uint32
@@ -141,80 +357,50 @@ def read_binary_Alibava(filepath):
         Header = struct.unpack("{}s".format(Headerlength[0]), header)[0].decode("Utf-8")
         Pedestal = np.array(struct.unpack("d" * 256, f.read(8 * 256)), dtype=np.float32)
         Noise = np.array(struct.unpack("d" * 256, f.read(8 * 256)), dtype=np.float32)
-        byteorder = sys.byteorder
 
         # Data Blocks
-        # Read all data Blocks
         # Warning Alibava Binary calibration files have no indicatior how many events are really inside the file
         # The eventnumber corresponds to the pulse number -->
         # Readout of files have to be done until end of file is reached
         # and the eventnumber must be calculated --> Advantage: Damaged files can be read as well
-        #events = Header.split("|")[1].split(";")[0]
-        event_data = []
-        events = 0
-        eof = False
-        #for event in range(int(events)):
-        while not eof:
-            blockheader = f.read(4)  # should be 0xcafe002
-            if blockheader == b'\x02\x00\xfe\xca' or blockheader == b'\xca\xfe\x00\x02':
-                events += 1
-                blocksize = struct.unpack("I", f.read(4))
-                event_data.append(f.read(blocksize[0]))
-            else:
-                LOG.info("Warning: While reading data Block {}. "
-                         "Header was not the 0xcafe0002 it was {!s}"\
-                         .format(events, str(blockheader)))
-                if not blockheader:
-                    LOG.info("Persumably end of binary file reached. "
-                             "Events read: {}".format(events))
-                    eof = True
-        dic = {"header": {"noise": Noise,
-                          "pedestal": Pedestal,
-                          "Attribute:setup": None},
-               "events": {"header": Header,
-                          "signal": np.zeros((int(events),256), dtype=np.float32),
-                          "temperature": np.zeros(int(events), dtype=np.float32),
-                          "time": np.zeros(int(events), dtype=np.float32),
-                          "clock": np.zeros(int(events), dtype=np.float32)},
-               "scan": {"start": Starttime,
-                        "end": None,
-                        "value": None, # Values of cal files for example. eg. 32 pulses for a charge scan steps should be here
-                        "attribute:scan_definition": None}}
-        # Disect the header for the correct informations for values
-        points = Header.split("|")[1].split(";")
-        params = [x.strip("\x00") for x in points]
-
-        # Alibava binary have (unfortunately) a non consistend header format
-        # Therefore, we have to distinguish between the two formats --> len(params) = 4 --> Calibration
-        # len(params) = 2 --> Eventfile
-
-        if len(params) >= 4: # Cal file
-            dic["scan"]["value"] = np.arange(int(params[1]), int(params[2]), int(params[3]))  # aka xdata
-        elif len(params) == 2: # Events file
-            dic["scan"]["value"] = np.arange(0, int(params[0]),step=1)  # aka xdata
-
-        shift1 = int.from_bytes(b'0xFFFF0000',byteorder=byteorder)
-        shift2 = int.from_bytes(b'0xFFFF',byteorder=byteorder)
-        # decode data from data Blocks
-        for i, event in enumerate(event_data):
-            dic["events"]["clock"][i] = struct.unpack("III", event[0:12])[-1]
-            coded_time = struct.unpack("I", event[12:16])[0]
-            #coded_time = event[12:16]
-            ipart = (coded_time & shift1)>>16
-            fpart = (np.sign(ipart))*(coded_time & shift2)
-            time = 100*ipart+fpart
-            dic["events"]["time"][i] = time
-            dic["events"]["temperature"][i] = 0.12*struct.unpack("H", event[16:18])[0]-39.8
-
-            # There seems to be garbage data which needs to be cut out
-            padding = 18+32
-            part1 = list(struct.unpack("h"*128, event[padding:padding+2*128]))
-            padding += 2*130+28
-            part2 = list(struct.unpack("h" * 128, event[padding:padding + 2*128]))
-            part1.extend(part2)
-            dic["events"]["signal"][i] = np.array(part1)
-            #dict["events"]["signal"][i] =struct.unpack("H"*256, event[18:18+2*256])
-            #extra = struct.unpack("d", event[18+2*256:18+2*256+4])[0]
+        if lazy:
+            data_start = f.tell()
+        else:
+            raw = np.fromfile(f, dtype=np.uint8)
+
+    if lazy:
+        blocks = AlibavaBlocks(filepath, data_start)
+        events = {field: AlibavaEventDataset(blocks, field) for field in ALIBAVA_EVENT_FIELDS}
+    else:
+        blocks = _uniform_alibava_blocks(raw)
+        if blocks is None:
+            LOG.info("Data blocks of binary file are not uniform, reading block by block...")
+            blocks = gather_alibava_blocks(raw, alibava_block_offsets(raw))
+        else:
+            LOG.info("End of binary file reached. Events read: {}".format(len(blocks)))
+        events = decode_alibava_blocks(blocks)
+    events["header"] = Header
+
+    dic = {"header": {"noise": Noise,
+                      "pedestal": Pedestal,
+                      "Attribute:setup": None},
+           "events": events,
+           "scan": {"start": Starttime,
+                    "end": None,
+                    "value": None, # Values of cal files for example. eg. 32 pulses for a charge scan steps should be here
+                    "attribute:scan_definition": None}}
+    # Disect the header for the correct informations for values
+    points = Header.split("|")[1].split(";")
+    params = [x.strip("\x00") for x in points]
+
+    # Alibava binary have (unfortunately) a non consistend header format
+    # Therefore, we have to distinguish between the two formats --> len(params) = 4 --> Calibration
+    # len(params) = 2 --> Eventfile
+
+    if len(params) >= 4: # Cal file
+        dic["scan"]["value"] = np.arange(int(params[1]), int(params[2]), int(params[3]))  # aka xdata
+    elif len(params) == 2: # Events file
+        dic["scan"]["value"] = np.arange(0, int(params[0]),step=1)  # aka xdata
 
     return dic
 
@@ -323,47 +509,284 @@ def save_configs(configs, name, path):
     except OSError as err:
         LOG.error("Failed to save configs.", exc_info=True)
 
+class RunningMoments:
+    """Running mean and covariance of vectors (e.g. the signals of all channels
+    of an event), which can be updated chunk wise and merged with other
+    instances (Welford/Chan algorithm). Its numerically stable and needs only
+    O(dim^2) memory, no matter how many events are accumulated."""
+
+    def __init__(self, dim):
+        self.count = 0
+        self.mean = np.zeros(dim)
+        self.comoment = np.zeros((dim, dim))
+
+    def update(self, data):
+        """Adds a chunk of data of shape (entries, dim)"""
+        data = np.asarray(data, dtype=np.float64)
+        chunk = RunningMoments(data.shape[1])
+        chunk.count = len(data)
+        chunk.mean = np.mean(data, axis=0)
+        centered = data - chunk.mean
+        chunk.comoment = np.dot(centered.T, centered)
+        return self.merge(chunk)
+
+    def merge(self, other):
+        """Merges the moments of another RunningMoments object into this one"""
+        if not other.count:
+            return self
+        count = self.count + other.count
+        delta = other.mean - self.mean
+        self.comoment += other.comoment + np.outer(delta, delta)*self.count*other.count/count
+        self.mean = self.mean + delta*other.count/count
+        self.count = count
+        return self
+
+    @property
+    def covariance(self):
+        """The (population) covariance matrix"""
+        return self.comoment/max(self.count, 1)
+
+    @property
+    def std(self):
+        """The (population) standard deviation of every component"""
+        return np.sqrt(np.diag(self.covariance))
+
+class HistogramAccumulator:
+    """A histogram with fixed binning, which can be filled incrementally and
+    merged with other histograms of the same binning. Use this instead of
+    keeping all values, if only the distribution is needed."""
+
+    def __init__(self, bins, range):
+        self.bins = int(bins)
+        self.range = (float(range[0]), float(range[1]))
+        self.edges = np.linspace(self.range[0], self.range[1], self.bins+1)
+        self.counts = np.zeros(self.bins, dtype=np.int64)
+        self.sums = np.zeros(self.bins)  # Sum of the weights per bin
+
+    def fill(self, values, weights=None):
+        """Adds the values to the histogram, values outside the range are ignored.
+        If weights are passed, their sum per bin is accumulated as well (see mean)"""
+        self.counts += np.histogram(values, bins=self.bins, range=self.range)[0]
+        if weights is not None:
+            self.sums += np.histogram(values, bins=self.bins, range=self.range, weights=weights)[0]
+        return self
+
+    def merge(self, other):
+        """Adds the counts of another histogram with the same binning"""
+        if self.bins != other.bins or self.range != other.range:
+            raise ValueError("Only histograms with the same binning can be merged")
+        self.counts += other.counts
+        self.sums += other.sums
+        return self
+
+    @property
+    def mean(self):
+        """The mean weight per bin (0 for empty bins)"""
+        return np.divide(self.sums, self.counts, out=np.zeros(self.bins), where=self.counts > 0)
+
+    @property
+    def centers(self):
+        """The centers of the bins"""
+        return 0.5*(self.edges[1:]+self.edges[:-1])
+
+def binned_statistics(x, values, edges):
+    """Calculates the statistics of values binned in x in one pass over the data
+    (like a histogram with weights). The bins follow np.histogram, the last bin
+    includes its right edge and values outside of the edges are ignored.
+
+    :param x: The positions which define the bin of every value
+    :param values: The values of which the statistic should be calculated
+    :param edges: The bin edges (monotonically increasing)
+    :return: count, mean and sum of squares of the values per bin (mean is 0 for empty bins)
+    """
+    x = np.asarray(x).ravel()
+    values = np.asarray(values, dtype=np.float64).ravel()
+    edges = np.asarray(edges)
+    nbins = len(edges) - 1
+    ind = np.searchsorted(edges, x, side="right") - 1
+    ind[x == edges[-1]] = nbins - 1
+    inrange = (ind >= 0) & (ind < nbins)
+    ind, values = ind[inrange], values[inrange]
+
+    count = np.bincount(ind, minlength=nbins)
+    total = np.bincount(ind, weights=values, minlength=nbins)
+    sumsq = np.bincount(ind, weights=values*values, minlength=nbins)
+    mean = np.divide(total, count, out=np.zeros(nbins), where=count > 0)
+    return count, mean, sumsq
+
+def survival_function(values, thresholds):
+    """Calculates the fraction of the values above every threshold (the empirical survival function)
+    with one sort and a binary search per threshold.
+
+    :param values: The values (e.g. the seed signals)
+    :param thresholds: The thresholds
+    :return: The fraction of the values > threshold for every threshold
+    """
+    values = np.sort(np.asarray(values).ravel())
+    thresholds = np.asarray(thresholds)
+    if not len(values):
+        return np.zeros(len(thresholds))
+    return (len(values) - np.searchsorted(values, thresholds, side="right"))/len(values)
+
+def threshold_index(efficiency, aim_eff):
+    """Returns the index of the highest threshold at which the efficiency is still >= aim_eff
+    (binary search, the efficiency has to decrease with the threshold). -1 if the
+    efficiency is never reached."""
+    return int(np.searchsorted(-np.asarray(efficiency), -aim_eff, side="right")) - 1
+
+def efficiency_curve(thresholds, efficiency, aim_eff, events):
+    """Packs an efficiency vs. threshold curve into a dict and finds the highest threshold
+    with an efficiency of at least aim_eff ("aim_threshold", nan if never reached)"""
+    ind = threshold_index(efficiency, aim_eff)
+    return {"threshold": thresholds, "efficiency": efficiency, "aim_eff": aim_eff,
+            "aim_threshold": thresholds[ind] if ind >= 0 else np.nan, "events": events}
+
+def timing_profile(timing, seed_sum, bins=30, yrange=(-250, -1)):
+    """Calculates the timing profile of a run from the per event columns of the cluster table.
+    The mean seed signal is calculated in 1ns bins, bin i contains the events with a timing
+    in [i, i+1). The 2D histogram of timing and seed signal spans the timing range 0 to
+    the maximum timing.
+
+    :param timing: The timing of every event
+    :param seed_sum: The summed signal of all seed hits of every event
+    :param bins: The number of bins of the 2D histogram (int or [xbins, ybins])
+    :param yrange: The seed signal range of the 2D histogram
+    :return: dict with "time", "counts", "mean_signal" (1D profile) and
+             "hist2d", "xedges", "yedges" (2D histogram)
+    """
+    timing = np.asarray(timing, dtype=np.float64)
+    seed_sum = np.asarray(seed_sum, dtype=np.float64)
+    if not len(timing):
+        empty = np.zeros(0)
+        return {"time": empty, "counts": np.zeros(0, dtype=np.int64), "mean_signal": empty,
+                "hist2d": np.zeros((0, 0)), "xedges": empty, "yedges": empty}
+    max_time = int(np.max(timing)+1)
+    valid = timing >= 0
+    ind = np.floor(timing[valid]).astype(np.int64)
+    counts = np.bincount(ind, minlength=max_time)
+    sums = np.bincount(ind, weights=seed_sum[valid], minlength=max_time)
+    mean_signal = np.divide(sums, counts, out=np.zeros(len(counts)), where=counts > 0)
+    hist2d, xedges, yedges = np.histogram2d(timing, seed_sum, bins=bins,
+                                            range=[[0, np.max(timing)], list(yrange)])
+    return {"time": np.arange(len(counts)), "counts": counts, "mean_signal": mean_signal,
+            "hist2d": hist2d, "xedges": xedges, "yedges": yedges}
+
 class Bdata:
-    """Creates an object which can handle numpy arrays. By passing lables you
-    can get the columns of the multidimensional array. Its like a pandas array
-    but with way less overhead.
+    """Creates an object which can handle the columnar results of the base analysis.
+    Its like a pandas array but with way less overhead. The data is a dict of
+    columns (numpy arrays), for the cluster table see build_cluster_table in
+    nb_analysis_funcs.py.
     If you store a Bdata object you can get columns by accessing it via Bdata['label']
-    Not passing an argument results in """
 
-    def __init__(self, data = np.array([]), labels = None):
+    For old code the per event labels "Signal", "SN", "CMN", "CMsig", "Hitmap",
+    "Channel_hit", "Clusters", "Numclus", "Clustersize" and "Timing" are still
+    available. These are build from the table when they are accessed the first time."""
 
-        # Has nothing to do here, this is a Data type not a typical class
-        #self.log = logging.getLogger(__class__.__name__)
-        #self.log.setLevel(logging.DEBUG)
-        #if self.log.hasHandlers() is False:
-        #    format_string = '%(asctime)s - %(levelname)s - %(name)s - %(message)s'
-        #    formatter = logging.Formatter(format_string)
-        #    console_handler = logging.StreamHandler()
-        #    console_handler.setFormatter(formatter)
-        #    self.log.addHandler(console_handler)
+    LEGACY_LABELS = ["Signal", "SN", "CMN", "CMsig", "Hitmap", "Channel_hit",
+                     "Clusters", "Numclus", "Clustersize", "Timing"]
 
-        self.data = data
-        self.labels = labels
+    def __init__(self, data = None, labels = None):
+        """
+        :param data: dict of columns or (old style) an array with one column per label
+        :param labels: The labels of the columns, only needed if data is an array
+        """
         self.log = LOG
-
-        if len(self.data) != len(self.labels):
-            self.log.warning("Data missmatch!")
+        if data is None:
+            data = {}
+        if not isinstance(data, Mapping):
+            if len(data) and len(data[0]) != len(labels):
+                self.log.warning("Data missmatch!")
+            data = {label: data[:, i] for i, label in enumerate(labels)}
+        self.data = data
+        self._legacy = {}
 
     def __getitem__(self, arg=None):
         # COMMENT: else returns 'None' is correct?
         if arg:
             return self.get(arg)
 
+    def __getstate__(self):
+        # The legacy columns can be rebuild at any time, so do not store them
+        state = self.__dict__.copy()
+        state["_legacy"] = {}
+        return state
+
+    def __len__(self):
+        if "numclus" in self.data:
+            return len(self.data["numclus"])
+        return len(next(iter(self.data.values()), []))
+
+    def __contains__(self, label):
+        return label in self.data or label in self.keys()
+
     def __repr__(self):
-        return repr(self.data)
+        return "Bdata({} events, columns: {})".format(len(self), ", ".join(self.data))
+
+    def set_readonly(self):
+        """Makes all columns read only, so they can be shared without copies"""
+        if not isinstance(self.data, dict):
+            return  # Lazily loaded columns (see results_store.py) are read only already
+        for column in self.data.values():
+            if isinstance(column, np.ndarray):
+                column.setflags(write=False)
+
+    @property
+    def labels(self):
+        """Returns the labels of all stored columns"""
+        return list(self.data.keys())
 
     def keys(self):
         """Returns the keys list"""
-        return self.labels
+        legacy = [label for label in self.LEGACY_LABELS if label not in self.data] if "numclus" in self.data else []
+        return self.labels + legacy
 
     def get(self, label):
-        """DOC of function"""
-        return self.data[:,self.labels.index(label)]
+        """Returns the column with the label"""
+        if label in self.data:
+            return self.data[label]
+        if label not in self._legacy:
+            self._legacy[label] = self._build_legacy(label)
+        return self._legacy[label]
+
+    def _build_legacy(self, label):
+        """Builds the old per event columns from the cluster table"""
+        data = self.data
+        if label not in self.LEGACY_LABELS or "numclus" not in data:
+            raise KeyError(label)
+        if label == "Numclus":
+            return data["numclus"]
+        if label == "Timing":
+            return data["timing"]
+        if label == "CMN":
+            return data["cmn"]
+        if label == "CMsig":
+            return data["cmsig"]
+        if label == "Hitmap":
+            return np.broadcast_to(data["hitmap"], (len(self), len(data["hitmap"])))
+        if label in ("Signal", "SN"):
+            column = label.lower()
+            if column not in data:
+                raise KeyError("{} is not available, the analysis was done without keep_signal_matrix".format(label))
+            return _object_array(data[column])
+        if label == "Channel_hit":
+            return _object_array(_split(data["hit_channel"], data["hit_offset"]))
+        if label == "Clustersize":
+            return _object_array(_split(data["cluster_size"], data["event_offset"]))
+        # Clusters
+        clusters = [cluster.tolist() for cluster in _split(data["cluster_channels"], data["cluster_offset"])]
+        offsets = data["event_offset"]
+        return _object_array([clusters[offsets[i]:offsets[i+1]] for i in range(len(self))])
+
+def _split(values, offsets):
+    """Splits a flat array into the parts given by the offsets: shape = (parts+1)"""
+    return [values[offsets[i]:offsets[i+1]] for i in range(len(offsets)-1)]
+
+def _object_array(items):
+    """Returns an object array with one entry per item"""
+    array = np.empty(len(items), dtype=object)
+    for i, item in enumerate(items):
+        array[i] = item
+    return array
 
 def save_dict(di_, filepath_, name_, type_):
     """
@@ -383,6 +806,12 @@ def save_dict(di_, filepath_, name_, type_):
             LOG.info("Saving pickle to file...")
             pickle.dump(di_, f)
 
+    if type_.lower() == "hdf5":
+        # Columnar, see results_store.py
+        from .results_store import save_dict_as_hdf5
+        LOG.info("Saving HDF5 file...")
+        save_dict_as_hdf5(di_, filepath_, name_)
+
 class NumpyEncoder(json.JSONEncoder):
     def default(self, obj):
         if isinstance(obj, np.ndarray):
@@ -409,6 +838,88 @@ def load_dict(filename_):
         ret_di = pickle.load(f)
     return ret_di
 
+class StageCache:
+    """Memoizes the results of analysis stages, e.g. the NoiseAnalysis and Calibration of a pedestal and
+    charge scan file which are shared by all runs of a voltage scan. The results are keyed by the stage,
+    the file (path, size and modification time) and the config keys the stage depends on, so a changed
+    file or config is calculated again.
+
+    If a folder is passed, the results are additionally pickled to it and are reused by later analyses.
+    """
+
+    def __init__(self, folder="", logger=None):
+        """
+        :param folder: Folder for the pickled results, empty for an in memory cache only
+        :param logger: A specific logger if you want
+        """
+        self.log = logger or logging.getLogger(__class__.__name__)
+        self.folder = os.path.normpath(folder) if folder else ""
+        self.results = {}
+        self.hits = 0
+        self.misses = 0
+        if self.folder and not os.path.exists(self.folder):
+            os.makedirs(self.folder)
+
+    @staticmethod
+    def key(stage, path, configs, config_keys, *depends):
+        """
+        Generates the key of a stage result
+
+        :param stage: Name of the stage
+        :param path: The file the stage analyses
+        :param configs: The config dict
+        :param config_keys: The config keys the stage depends on
+        :param depends: Keys of other stages the result depends on (e.g. the pedestal of a calibration)
+        :return: str
+        """
+        path = os.path.abspath(os.path.normpath(path)) if path else ""
+        if path and os.path.isfile(path):
+            stat = os.stat(path)
+            fileinfo = [path, stat.st_size, stat.st_mtime_ns]
+        else:
+            fileinfo = [path, None, None]
+        description = json.dumps([stage, fileinfo, [[key, configs.get(key)] for key in config_keys], list(depends)],
+                                 sort_keys=True, default=str)
+        return "{}_{}".format(stage, hashlib.sha1(description.encode()).hexdigest()[:20])
+
+    def get(self, key, compute):
+        """
+        Returns the result of the key, the result is only calculated if it is neither in memory nor on disk
+
+        :param key: The key of the result (see key)
+        :param compute: Function without arguments which calculates the result
+        :return: The result
+        """
+        if key in self.results:
+            self.hits += 1
+            self.log.info("Using the cached result %s", key)
+            return self.results[key]
+
+        filepath = os.path.join(self.folder, "{}.pickle".format(key)) if self.folder else ""
+        if filepath and os.path.exists(filepath):
+            try:
+                self.results[key] = load_dict(filepath)
+                self.hits += 1
+                self.log.info("Loaded the cached result %s from disk", key)
+                return self.results[key]
+            except Exception as err:
+                self.log.warning("Could not load the cached result %s, calculating it again. Error: %s", key, err)
+
+        self.misses += 1
+        self.results[key] = compute()
+        if filepath:
+            # Write to a temporary file first, so no half written results can be loaded
+            tmpfile = "{}.{}.tmp".format(filepath, os.getpid())
+            try:
+                with open(tmpfile, "wb") as f:
+                    pickle.dump(self.results[key], f)
+                os.replace(tmpfile, filepath)
+            except Exception as err:
+                self.log.warning("Could not save the result %s to disk. Error: %s", key, err)
+                if os.path.exists(tmpfile):
+                    os.remove(tmpfile)
+        return self.results[key]
+
 # Here the logger will be initialized!
 init_logger(path='logger.yml')
 
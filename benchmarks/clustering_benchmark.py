@@ -0,0 +1,49 @@
+"""Measures the throughput (events/s) of the event preprocessing and clustering on a synthetic run"""
+import os
+import sys
+from argparse import ArgumentParser
+from time import time
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from analysis_classes.nb_analysis_funcs import event_process_function  # pylint: disable=C0413
+
+
+def synthetic_run(numevents, numchan=256, seed=0):
+    """Random events with noise and up to three clusters of negative signal per event"""
+    rng = np.random.default_rng(seed)
+    pedestal = rng.uniform(480, 520, numchan)
+    noise = rng.uniform(3, 6, numchan)
+    events = pedestal + rng.normal(0, 1, (numevents, numchan))*noise
+    seeds = rng.integers(0, numchan-4, (numevents, 3))
+    for k in range(4):
+        events[np.arange(numevents)[:, None], seeds+k] -= rng.uniform(0, 100, (numevents, 3))
+    return events.astype(np.float32), pedestal, noise
+
+
+def main(args):
+    """Runs the benchmark"""
+    events, pedestal, noise = synthetic_run(args.events)
+    timing = np.zeros(len(events), dtype=np.float32)
+    params = (pedestal, 0., 5., noise, events.shape[1], 5., 0.5, 6., 5, True, 1, np.zeros(0, dtype=np.int64))
+
+    # The first call compiles the kernels (or loads them from the cache)
+    start = time()
+    event_process_function(events[:100], *params, timing[:100])
+    print("Compilation: {:.2f} s".format(time()-start))
+
+    runtimes = []
+    for _ in range(args.repeat):
+        start = time()
+        table, _ = event_process_function(events, *params, timing, keep_signal_matrix=False)
+        runtimes.append(time()-start)
+    best = min(runtimes)
+    print("Events: {}, clusters: {}, best of {}: {:.3f} s, {:.0f} events/s".format(
+        len(events), len(table["cluster_size"]), args.repeat, best, len(events)/best))
+
+
+if __name__ == "__main__":
+    PARSER = ArgumentParser()
+    PARSER.add_argument("--events", help="Number of synthetic events", type=int, default=100000)
+    PARSER.add_argument("--repeat", help="Number of timed runs", type=int, default=3)
+    main(PARSER.parse_args())
@@ -178,7 +178,9 @@ class PlotData:
         excluding the "ungaussian" parts of the distribution"""
         data = obj["NoiseAnalysis"]
         plot = handle_sub_plots(fig, cfg)
-        n, bins, _ = plot.hist(data.total_noise, bins=500, density=False,
+        # The total noise is already accumulated as histogram by the NoiseAnalysis
+        n, bins, _ = plot.hist(data.total_noise.centers, bins=data.total_noise.edges,
+                               weights=data.total_noise.counts, density=False,
                                alpha=0.4, color="b", label="Noise")
         plot.set_yscale("log", nonposy='clip')
         plot.set_ylim(1.)
@@ -282,7 +284,7 @@ class PlotData:
         numclusters_plot = handle_sub_plots(fig, cfg)
 
         # Plot Number of clusters
-        bins, counts = np.unique(data["Numclus"],
+        bins, counts = np.unique(data["numclus"],
                                  return_counts=True)
         numclusters_plot.bar(bins, counts, alpha=0.4, color="b")
         numclusters_plot.set_xlabel('Number of clusters [#]')
@@ -296,7 +298,7 @@ class PlotData:
         data = obj["MainAnalysis"]["base"]
         clusters_plot = handle_sub_plots(fig, cfg)
 
-        bins, counts = np.unique(np.concatenate(data["Clustersize"]),
+        bins, counts = np.unique(data["cluster_size"],
                                  return_counts=True)
         clusters_plot.bar(bins, counts, alpha=0.4, color="b")
         clusters_plot.set_xlabel('Clustersize [#]')
@@ -330,19 +332,15 @@ class PlotData:
         # Plot the different clustersizes
         colour = ['green', 'red', 'orange', 'cyan', 'black', 'pink', 'magenta']
 
-        # Get only events with one cluster inside
-        ind_only_one_cluster = np.nonzero(data["Numclus"] == 1)
-        clusters_raw = np.take(data["Clustersize"], ind_only_one_cluster)
-        clusters_flattend = np.concatenate(clusters_raw[0]).ravel()
+        # Get only clusters of events with one cluster inside
+        only_one_cluster = data["numclus"][data["cluster_event"]] == 1
         max_cluster = self.cfg["hitmap_max_clustersize"]
 
 
         for clus in range(1, max_cluster+1):
-            # Get clusters
-            indizes_clustersize = np.nonzero(clusters_flattend == clus)
-            indizes = np.take(ind_only_one_cluster, indizes_clustersize)[0]
-            hitted = np.take(data["Clusters"], indizes)
-            hitted_flatten = np.concatenate(hitted).ravel()
+            # Get the channels of the clusters with this clustersize
+            selected = np.logical_and(only_one_cluster, data["cluster_size"] == clus)
+            hitted_flatten = data["cluster_channels"][np.repeat(selected, data["cluster_size"])]
 
             hit_plot.hist(hitted_flatten, range=(0, 256), bins=256,
                         alpha=0.3, color=colour[clus-1],
@@ -358,8 +356,8 @@ class PlotData:
         data = obj["MainAnalysis"]["base"]
         hitmap_plot = handle_sub_plots(fig, cfg)
         hitmap_plot.set_title("Event Hitmap")
-        hitmap_plot.bar(np.arange(len(data["Hitmap"][0])),
-                        data["Hitmap"][len(data["Hitmap"]) - 1],
+        hitmap_plot.bar(np.arange(len(data["hitmap"])),
+                        data["hitmap"],
                         1.,
                         alpha=0.4,
                         color="b")
@@ -375,8 +373,8 @@ class PlotData:
         data = obj["MainAnalysis"]["base"]
         eventnum = self.cfg["Plot_single_event"]
         channel_plot = handle_sub_plots(fig, cfg)
-        channel_plot.bar(np.arange(len(data["Signal"][0])),
-                         data["Signal"][eventnum], 1.,
+        channel_plot.bar(np.arange(len(data["signal"][0])),
+                         data["signal"][eventnum], 1.,
                          alpha=0.4, color="b")
         channel_plot.set_xlabel('channel [#]')
         channel_plot.set_ylabel('Signal [ADC]')
@@ -388,8 +386,8 @@ class PlotData:
         data = obj["MainAnalysis"]["base"]
         eventnum = self.cfg["Plot_single_event"]
         SN_plot = handle_sub_plots(fig, cfg)
-        SN_plot.bar(np.arange(len(data["Signal"][0])),
-                    data["SN"][eventnum], 1.,
+        SN_plot.bar(np.arange(len(data["sn"][0])),
+                    data["sn"][eventnum], 1.,
                     alpha=0.4, color="b")
         SN_plot.set_xlabel('channel [#]')
         SN_plot.set_ylabel('Signal/Noise [ADC]')
@@ -397,6 +395,15 @@ class PlotData:
         # fig.subplots_adjust(top=0.88)
         return SN_plot
 
+    def langau_hist(self, plot, data, signal_key, histogram_key, **kwargs):
+        """Plots a spectrum of the Langau analysis, either from the signals or (in accumulate mode)
+        from the already filled histogram"""
+        if histogram_key in data:
+            histogram = data[histogram_key]
+            return plot.hist(histogram.centers, bins=histogram.edges, weights=histogram.counts,
+                             density=False, **kwargs)
+        return plot.hist(data[signal_key], bins=data["bins"], density=False, **kwargs)
+
     def plot_langau_per_clustersize(self, cfg, obj, fig=None):
         """Plots the data calculated so the energy data and the langau"""
         data = obj["MainAnalysis"]["Langau"]
@@ -406,8 +413,7 @@ class PlotData:
         plot = handle_sub_plots(fig, cfg)
         plot.set_title("Signals of different cluster sizes")
         # hist, edges = np.histogram(data["signal"], bins=data.bins)
-        plot.hist(data["signal"], bins=data["bins"], density=False,
-                  alpha=0.4, color="b", label="All clusters")
+        self.langau_hist(plot, data, "signal", "histogram", alpha=0.4, color="b", label="All clusters")
         #plot.errorbar(edges[:-1], hist, xerr=data["data_error"], fmt='o', markersize=1, color="red")
         if fit_langau:
             plot.plot(data["langau_data"][0], data["langau_data"][1], "r--",
@@ -433,9 +439,8 @@ class PlotData:
         colour = ['green', 'red', 'orange', 'cyan', 'black', 'pink', 'magenta']
         for i, cls in enumerate(data["Clustersize"]):
             if i < 7:
-                plot.hist(cls["signal"], bins=data["bins"], density=False,
-                          alpha=0.3, color=colour[i],
-                          label="Clustersize: {!s}".format(i + 1))
+                self.langau_hist(plot, dict(cls, bins=data["bins"]), "signal", "histogram",
+                                 alpha=0.3, color=colour[i], label="Clustersize: {!s}".format(i + 1))
             else:
                 self.log.warning(
                     "To many histograms for this plot. "
@@ -473,9 +478,7 @@ class PlotData:
             # Plot Seed cut langau
             plot = handle_sub_plots(fig, cfg)
             # indizes = np.nonzero(data["signal_SC"] > 0)[0]
-            plot.hist(data["signal_SC"],
-                      bins=data["bins"], density=False,
-                      alpha=0.4, color="b", label="Signals")
+            self.langau_hist(plot, data, "signal_SC", "histogram_SC", alpha=0.4, color="b", label="Signals")
             if fit_langau:
                 plot.plot(data["langau_data_SC"][0], data["langau_data_SC"][1],
                           "r--", color="g",
@@ -514,28 +517,14 @@ class PlotData:
         But if you have pulse shape recognition activated the sampling starts at different timings
         for each event. If the algorithm misjudges the rising edge du to noise etc. the timing profile can
         differ. With this plot you can check this."""
-        data = obj["MainAnalysis"]["base"]
         configs = self.cfg.get("Timing2Dhist", {})
         timing_plot = handle_sub_plots(fig, cfg)
         timing_plot.set_xlabel('timing [ns]')
         timing_plot.set_ylabel('average signal [ADC]')
         timing_plot.set_title('Average timing signal of seed hits')
-        signal = data["Signal"]
-        channels_hit = data["Channel_hit"]
-        time = data["Timing"].astype(np.float32)
-        sum_singal = np.zeros(len(signal))
-        for i, sig, chan in zip(np.arange(len(signal)), signal, channels_hit):
-            sum_singal[i] = np.sum(sig[chan])
-        max_time = int(np.max(time)+1)
-        timing_data = np.zeros(max_time)
-        # var_timing_data = np.zeros(150)
-        for timing in range(1, max_time):  # Timing of ALiBaVa
-            timing_in = np.nonzero(np.logical_and(time >= timing - 1, time < timing))
-            if len(timing_in[0]):
-                timing_data[timing - 1] = np.mean(sum_singal[timing_in[0]])
-            # var_timing_data[timing-1] = np.std(sum_singal[timing_in[0]])
-
-        timing_plot.bar(np.arange(0, max_time), timing_data, alpha=0.4, color="b")  # , yerr=var_timing_data)
+        profile = obj["MainAnalysis"]["timing_profile"]
+
+        timing_plot.bar(profile["time"], profile["mean_signal"], alpha=0.4, color="b")
         if configs.get("invertY", False):
             timing_plot.invert_yaxis()
 
@@ -550,31 +539,21 @@ class PlotData:
         timing_hist_plot.set_ylabel('count [#]')
         timing_hist_plot.set_title('Histogram of timings')
 
-        timing_hist_plot.hist(data["Timing"].astype(np.float32), 150, alpha=0.4, color="b")
+        timing_hist_plot.hist(data["timing"], 150, alpha=0.4, color="b")
 
     def plot_2d_timing_profile(self, cfg, obj, fig=None):
         """Plots the 2D histogram of the timing profile.
         Warning: No averaging done here!!!
         It considers only the hitted channels and sums up the ADC for clusters"""
 
-        data = obj["MainAnalysis"]["base"]
         configs = self.cfg["Timing2Dhist"]
         plot = handle_sub_plots(fig, cfg)
         plot.set_xlabel('timing [ns]')
         plot.set_ylabel('ADC [#]')
         plot.set_title('2D Histogram of timings with signal')
+        profile = obj["MainAnalysis"]["timing_profile"]
 
-        signal = data["Signal"]
-        channels_hit = data["Channel_hit"]
-        time = data["Timing"].astype(np.float32)
-        sum_singal = np.zeros(len(signal))
-        for i, sig, chan in zip(np.arange(len(signal)), signal, channels_hit):
-            sum_singal[i] = np.sum(sig[chan])
-
-
-        counts, xedges, yedges, im = plot.hist2d(time, sum_singal,
-                                                 bins=configs.get("bins", 30),
-                                                 range=[[0, np.max(time)], configs.get("yrange",[-250, -1])])
+        im = plot.pcolormesh(profile["xedges"], profile["yedges"], profile["hist2d"].T)
         fig.colorbar(im)
         if configs.get("invertY", False):
             plot.invert_yaxis()
@@ -642,28 +621,19 @@ class PlotData:
         """Plot efficiency of seed signals vs. applied threshold and
         show the maximum threshold for aim_eff"""
 
-        if "Langau" in obj["MainAnalysis"]:
+        # The curve is calculated by the Langau analysis (with seed_cut_langau), see its Efficiency config
+        if "Langau" in obj["MainAnalysis"] and "efficiency_SC" in obj["MainAnalysis"]["Langau"]:
             plot = handle_sub_plots(fig, cfg)
-            data = obj["MainAnalysis"]["Langau"]
-
-            aim_eff = self.cfg["Efficiency_plot"]["aim_eff"]
-            max_range = self.cfg["Efficiency_plot"]["max_range"]
-            step_size = self.cfg["Efficiency_plot"]["step_size"]
-
-
-            step_lst = np.arange(0, max_range+step_size, step_size)
-            eff_lst = np.zeros(len(step_lst), dtype=np.float)
-            tot_len = len(data["signal_SC"])
-            # In principal its a survival function what we calculate here
-            # Todo: Use the scipy version for the survival function rv_continuous.sf
-            for i, step in enumerate(step_lst):
-                eff_lst[i] = np.count_nonzero(data["signal_SC"] > step)/tot_len
+            efficiency = obj["MainAnalysis"]["Langau"]["efficiency_SC"]
+            step_lst, eff_lst = efficiency["threshold"], efficiency["efficiency"]
+            aim_eff, tot_len = efficiency["aim_eff"], efficiency["events"]
             plot.plot(step_lst, eff_lst, "r--", label="Efficiency")
-            index = np.where(eff_lst >= aim_eff)[0][-1]
-            if step_lst[index] >= max_range:
-                threshold = "> {}".format(max_range)
+            if np.isnan(efficiency["aim_threshold"]):
+                threshold = "not reached"
+            elif efficiency["aim_threshold"] >= step_lst[-1]:
+                threshold = "> {}".format(step_lst[-1])
             else:
-                threshold = str(step_lst[index])
+                threshold = str(efficiency["aim_threshold"])
             textstr = '\n'.join((
                 "Sth @ %s = %s" %(str(aim_eff), threshold),
                 "Events = %.f" %(tot_len)))
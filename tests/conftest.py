@@ -0,0 +1,5 @@
+"""Makes the analysis modules importable in the tests"""
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,123 @@
+"""Compares the compiled clustering kernels with a plain python version of the three-cut clustering"""
+import numpy as np
+import pytest
+from analysis_classes.nb_analysis_funcs import event_process_function, nb_clustering_all_events
+from analysis_classes.utilities import Bdata
+
+NUMCHAN = 256
+SN_CUT = 5.
+SN_RATIO = 0.5
+SN_CLUSTER = 6.
+MAX_CLUSTERSIZE = 5
+
+
+def reference_preprocessing(events, pedestal, meanCMN, meanCMsig, noise, noisy_strips):
+    """The event preprocessing done with numpy on all events at once"""
+    signal = events - pedestal
+    signal[signal > 5. * meanCMsig + meanCMN] = 0
+    cmn = np.mean(signal, axis=1)
+    cmsig = np.std(signal, axis=1)
+    signal = signal - cmn[:, None]
+    signal[:, noisy_strips] = 0
+    return signal, signal / noise, cmn, cmsig
+
+
+def reference_clustering(event, SN, noise, masking, material):
+    """The three-cut clustering of one event, channel by channel in plain python
+    :return: hit channels, clusters (list of channel lists), automasked hits"""
+    channels = [ch for ch in range(NUMCHAN) if abs(SN[ch]) > SN_CUT]
+    automasked = 0
+    used = [False]*NUMCHAN
+    if masking:
+        for ch in range(NUMCHAN):
+            used[ch] = event[ch] >= 0 if material else event[ch] <= 0
+        automasked = sum(1 for ch in channels if (event[ch] > 0 if material else event[ch] < 0))
+
+    clusters = []
+    for ch in channels:
+        if used[ch]:
+            continue
+        used[ch] = True
+        cluster = [ch]
+        right_stop = left_stop = False
+        for i in range(1, int(MAX_CLUSTERSIZE*0.5)+1):
+            if not (0 < ch-i and ch+i < NUMCHAN):
+                continue
+            for neighbour, stop in ((ch+i, "right"), (ch-i, "left")):
+                if (right_stop if stop == "right" else left_stop):
+                    continue
+                if abs(SN[neighbour]) > SN_CUT*SN_RATIO and not used[neighbour]:
+                    cluster.append(neighbour)
+                    used[neighbour] = True
+                elif stop == "right":
+                    right_stop = True
+                else:
+                    left_stop = True
+        SNcluster = abs(np.sum(event[cluster]))/np.sqrt(abs(np.sum(noise[cluster])))
+        if SNcluster > SN_CLUSTER:
+            clusters.append(cluster)
+    return channels, clusters, automasked
+
+
+def synthetic_run(numevents, seed=0):
+    """Random events with noise and clusters of one to four strips of negative signal"""
+    rng = np.random.default_rng(seed)
+    pedestal = rng.uniform(480, 520, NUMCHAN)
+    noise = rng.uniform(3, 6, NUMCHAN)
+    events = pedestal + rng.normal(0, 1, (numevents, NUMCHAN))*noise + rng.normal(0, 2, (numevents, 1))
+    for i in range(numevents):
+        for _ in range(rng.integers(0, 4)):
+            seed_channel = rng.integers(0, NUMCHAN-4)
+            size = rng.integers(1, 5)
+            events[i, seed_channel:seed_channel+size] -= rng.uniform(20, 120, size)
+    return events.astype(np.float32), pedestal, noise
+
+
+@pytest.mark.parametrize("masking,material", [(True, 1), (True, 0), (False, 1)])
+@pytest.mark.parametrize("numblocks", [1, 3])
+def test_clustering_kernel_matches_reference(masking, material, numblocks):
+    events, pedestal, noise = synthetic_run(300)
+    signal, SN, _, _ = reference_preprocessing(events.astype(np.float64), pedestal, 0., 5., noise, [])
+    if not material:
+        signal, SN = -signal, -SN  # p-in-n sensors have positive signals
+
+    hit_offset, hit_channel, event_offset, cluster_size, cluster_offset, cluster_channels, hitmap, automasked = \
+        nb_clustering_all_events(signal, SN, noise, SN_CUT, SN_RATIO, SN_CLUSTER, NUMCHAN, MAX_CLUSTERSIZE,
+                                 masking, material, numblocks)
+
+    expected_hitmap = np.zeros(NUMCHAN)
+    numclusters = 0
+    for i in range(len(events)):
+        channels, clusters, masked = reference_clustering(signal[i], SN[i], noise, masking, material)
+        assert hit_channel[hit_offset[i]:hit_offset[i+1]].tolist() == channels
+        assert automasked[i] == masked
+        found = [cluster_channels[cluster_offset[j]:cluster_offset[j+1]].tolist()
+                 for j in range(event_offset[i], event_offset[i+1])]
+        assert found == clusters
+        assert cluster_size[event_offset[i]:event_offset[i+1]].tolist() == [len(c) for c in clusters]
+        expected_hitmap[channels] += 1
+        numclusters += len(clusters)
+    np.testing.assert_array_equal(hitmap, expected_hitmap)
+    assert numclusters > 100  # The synthetic run really has clusters
+
+
+def test_event_processing_matches_reference():
+    events, pedestal, noise = synthetic_run(500, seed=1)
+    noisy_strips = np.array([10, 200])
+    noise[noisy_strips] = np.nan  # Masked strips have no noise
+    timing = np.linspace(0, 100, len(events), dtype=np.float32)
+
+    table, _ = event_process_function(events, pedestal, 0., 5., noise, NUMCHAN, SN_CUT, SN_RATIO, SN_CLUSTER,
+                                      MAX_CLUSTERSIZE, True, 1, noisy_strips, timing)
+    data = Bdata(table)
+
+    signal, SN, cmn, cmsig = reference_preprocessing(events.astype(np.float64), pedestal, 0., 5., noise,
+                                                     noisy_strips)
+    np.testing.assert_allclose(data["Signal"].tolist(), signal, rtol=1e-5, atol=1e-4)
+    np.testing.assert_allclose(data["CMN"], cmn, rtol=1e-5, atol=1e-5)
+    np.testing.assert_allclose(data["CMsig"], cmsig, rtol=1e-5, atol=1e-5)
+    for i in range(len(events)):
+        channels, clusters, _ = reference_clustering(signal[i], SN[i], noise, True, 1)
+        assert data["Channel_hit"][i].tolist() == channels
+        assert data["Clusters"][i] == clusters
+        assert data["Numclus"][i] == len(clusters)